@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+# pcr2binstack is Free software, see below:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+syntax:
+    pcr2binstack -I mapstack_folder -N mapstackname [-N mapstackname] [-S first] [-E last]
+
+    -I input mapstack folder (e.g. inmaps)
+    -N Mapstack-name (prefix). You can specify multiple mapstacks
+       e.g. -N P -N TEMP -N PET
+    -S first timestep to convert (default: first map found)
+    -E last timestep to convert (default: last map found)
+
+Converts pcraster mapstacks to binary mapstacks (one .wfbs file per mapstack, e.g.
+inmaps/P.wfbs). If a binary mapstack is present next to the mapstack the wflow
+framework reads the forcing from the memory-mapped binary file instead of opening
+a pcraster map for each timestep.
+"""
+
+import getopt
+import sys
+import os
+import logging
+import wflow.pcrut as _pcrut
+from wflow.wf_binstack import mapstack2binstack, mapstackfiles, binstackextension
+
+
+def usage(*args):
+    sys.stdout = sys.stderr
+    for msg in args: print msg
+    print __doc__
+    sys.exit(0)
+
+
+def main(argv=None):
+    """
+    Perform command line execution of the conversion.
+    """
+    mapstackfolder = "inmaps"
+    mapstackname = []
+    first = None
+    last = None
+
+    if argv is None:
+        argv = sys.argv[1:]
+        if len(argv) == 0:
+            usage()
+            return
+
+    try:
+        opts, args = getopt.getopt(argv, 'I:N:S:E:')
+    except getopt.error, msg:
+        usage(msg)
+
+    for o, a in opts:
+        if o == '-I': mapstackfolder = a
+        if o == '-N': mapstackname.append(a)
+        if o == '-S': first = int(a)
+        if o == '-E': last = int(a)
+
+    logger = _pcrut.setlogger('pcr2binstack.log','pcr2binstack', thelevel = logging.DEBUG)
+
+    for name in mapstackname:
+        stack = os.path.join(mapstackfolder,name)
+        # Use the first map of the stack as clone
+        maps = mapstackfiles(stack)
+        if len(maps) == 0:
+            logger.error("No maps found for mapstack: " + stack)
+            continue
+        _pcrut.setclone(maps[min(maps)])
+        mapstack2binstack(stack,stack + binstackextension,logger,first=first,last=last)
+
+
+if __name__ == "__main__":
+    main()
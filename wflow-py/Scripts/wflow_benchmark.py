@@ -0,0 +1,267 @@
+#!/usr/bin/python
+
+# wflow_benchmark is Free software, see below:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+syntax:
+    wflow_benchmark [-D wflowdir] [-O results.json] [-b name [-b name]] [-A spec] [-l]
+    wflow_benchmark [-t threshold] -K old.json new.json
+
+    -D root of the wflow checkout that holds the examples directory (default: current directory)
+    -O file to save the results to (default: benchmark.json)
+    -b name of a benchmark to run. You can specify multiple benchmarks. Default: all
+    -A add a benchmark: name,module,case,inifile,steps[,clonemap] e.g.
+       -A w3ra,wflow.wflow_W3RA,/data/w3ra_case,wflow_W3RA.ini,365
+       (the case directory is relative to the -D directory)
+    -l list the available benchmarks
+    -K compare two result files. Prints the ratios (new/old) and exits with
+       status 1 if the steps/second of a benchmark dropped more than the threshold
+    -t threshold for -K in percent (default 10)
+
+Runs the wflow models on the example cases for a fixed number of timesteps
+(fewer if the run in the ini file of the case is shorter) and reports the startup time, steps/second, peak memory and bytes written per
+step. Each benchmark runs in a separate python process so the memory
+use is that of the single model run. The output is written to the
+"benchmark" runId of each case.
+"""
+
+import getopt
+import sys
+import os
+import time
+import json
+import shutil
+import socket
+import platform
+import subprocess
+import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# name: (module, case directory relative to the wflow checkout, ini file, number of steps, clone map)
+benchmarks = {
+    'sceleton': ('wflow.wflow_sceleton', 'wflow-py/UnitTests/wflow_sceleton', 'wflow_sceleton.ini', 10, 'wflow_catchment.map'),
+    'sbm_rhine': ('wflow.wflow_sbm', 'examples/wflow_rhine_sbm', 'wflow_sbm.ini', 50, 'wflow_subcatch.map'),
+    'routing_rhine': ('wflow.wflow_routing', 'examples/wflow_rhine_sbm', 'wflow_routing.ini', 50, 'wflow_subcatch.map'),
+    'hbv_rhine': ('wflow.wflow_hbv', 'examples/wflow_rhine_hbv', 'wflow_hbv.ini', 50, 'wflow_subcatch.map'),
+    'sbm_mini': ('wflow.wflow_sbm', 'examples/wflow_mini', 'wflow_sbm.ini', 50, 'wflow_subcatch.map'),
+    'gr4_mini': ('wflow.wflow_gr4', 'examples/wflow_mini', 'wflow_gr4.ini', 50, 'wflow_subcatch.map'),
+}
+
+runId = "benchmark"
+resultmarker = "WFLOWBENCHMARK "
+
+
+def usage(*args):
+    sys.stdout = sys.stderr
+    for msg in args: print msg
+    print __doc__
+    sys.exit(0)
+
+
+def peakrss():
+    """
+    :return: peak resident memory of this process in Mb (0 if not available)
+    """
+    if resource is None:
+        return 0.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss/1048576.0
+    return rss/1024.0
+
+
+def dirsize(directory):
+    """
+    :return: total size in bytes of all files in directory
+    """
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            total = total + os.path.getsize(os.path.join(root, f))
+    return total
+
+
+def gitrevision(wflowdir):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=wflowdir).strip()
+    except Exception:
+        return "unknown"
+
+
+def runsingle(name, spec, wflowdir):
+    """
+    Runs one benchmark in this process
+
+    :return: dictionary with the results
+    """
+    module, case, inifile, steps, clonemap = spec
+    caseName = os.path.abspath(os.path.join(wflowdir, case))
+    if os.path.exists(os.path.join(caseName, runId)):
+        shutil.rmtree(os.path.join(caseName, runId))
+
+    t0 = time.time()
+    wf = __import__(module, fromlist=['WflowModel'])
+    t1 = time.time()
+    myModel = wf.WflowModel(clonemap, caseName, runId, inifile)
+    dynModelFw = wf.wf_DynamicFramework(myModel, steps, 1)
+    dynModelFw.createRunId(NoOverWrite=False, logfname="wflow_benchmark.log")
+    dynModelFw._runInitial()
+    dynModelFw._runResume()
+    # the run times in the ini file can limit the number of steps
+    first = dynModelFw._d_firstTimestep
+    last = min(first + steps - 1, dynModelFw._d_lastTimestep)
+    nrsteps = last - first + 1
+    t2 = time.time()
+    dynModelFw._runDynamic(first, last)
+    t3 = time.time()
+    dynModelFw._runSuspend()
+    dynModelFw._wf_shutdown()
+    t4 = time.time()
+
+    written = dirsize(os.path.join(caseName, runId))
+
+    return {'name': name, 'module': module, 'case': case, 'inifile': inifile, 'steps': nrsteps,
+            'import_s': t1 - t0, 'startup_s': t2 - t1, 'dynamic_s': t3 - t2, 'shutdown_s': t4 - t3,
+            'steps_per_s': nrsteps / (t3 - t2) if t3 > t2 else 0.0,
+            'peakrss_mb': peakrss(), 'bytes_written': written, 'bytes_per_step': written / float(nrsteps)}
+
+
+def runbenchmark(name, spec, wflowdir):
+    """
+    Runs one benchmark in a separate python process
+
+    :return: dictionary with the results (with an error entry if the run failed)
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '-D', wflowdir, '-J', name + ',' + ','.join([str(a) for a in spec])]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    for line in output.splitlines():
+        if line.startswith(resultmarker):
+            return json.loads(line[len(resultmarker):])
+
+    print output
+    return {'name': name, 'module': spec[0], 'case': spec[1], 'error': "run failed with exit code " + str(proc.returncode)}
+
+
+def compare(oldfile, newfile, threshold):
+    """
+    Compares two result files and prints the new/old ratios
+
+    :return: number of benchmarks that are slower than the threshold
+    """
+    old = json.load(open(oldfile))
+    new = json.load(open(newfile))
+    oldres = dict([(r['name'], r) for r in old['results'] if 'error' not in r])
+    regressions = 0
+
+    print "%-16s %12s %12s %8s %10s %10s %10s" % ('benchmark', 'old steps/s', 'new steps/s', 'ratio',
+                                                   'startup', 'peakrss', 'bytes/step')
+    for r in new['results']:
+        if 'error' in r or r['name'] not in oldres:
+            continue
+        o = oldres[r['name']]
+        ratio = r['steps_per_s'] / o['steps_per_s'] if o['steps_per_s'] > 0 else 0.0
+        flag = ""
+        if ratio < 1.0 - threshold / 100.0:
+            flag = " SLOWER"
+            regressions = regressions + 1
+        print "%-16s %12.2f %12.2f %8.3f %10.3f %10.3f %10.3f%s" % (
+            r['name'], o['steps_per_s'], r['steps_per_s'], ratio,
+            r['startup_s'] / o['startup_s'] if o['startup_s'] > 0 else 0.0,
+            r['peakrss_mb'] / o['peakrss_mb'] if o['peakrss_mb'] > 0 else 0.0,
+            r['bytes_per_step'] / o['bytes_per_step'] if o['bytes_per_step'] > 0 else 0.0, flag)
+
+    return regressions
+
+
+def main(argv=None):
+    """
+    Perform command line execution of the benchmarks.
+    """
+    wflowdir = os.getcwd()
+    resultfile = "benchmark.json"
+    torun = []
+    single = None
+    comparefiles = None
+    threshold = 10.0
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    try:
+        opts, args = getopt.getopt(argv, 'D:O:b:A:lK:t:J:h')
+    except getopt.error, msg:
+        usage(msg)
+
+    for o, a in opts:
+        if o == '-h': usage()
+        if o == '-D': wflowdir = os.path.abspath(a)
+        if o == '-O': resultfile = a
+        if o == '-b': torun.append(a)
+        if o == '-A':
+            spec = a.split(',')
+            benchmarks[spec[0]] = (spec[1], spec[2], spec[3], int(spec[4]), spec[5] if len(spec) > 5 else 'wflow_subcatch.map')
+            torun.append(spec[0])
+        if o == '-l':
+            for name in sorted(benchmarks):
+                print name + ": " + str(benchmarks[name])
+            return
+        if o == '-K': comparefiles = [a] + args[:1]
+        if o == '-t': threshold = float(a)
+        if o == '-J': single = a.split(',')
+
+    if comparefiles is not None:
+        if len(comparefiles) != 2:
+            usage("-K needs two result files")
+        sys.exit(1 if compare(comparefiles[0], comparefiles[1], threshold) > 0 else 0)
+
+    if single is not None:
+        spec = (single[1], single[2], single[3], int(single[4]), single[5])
+        print resultmarker + json.dumps(runsingle(single[0], spec, wflowdir))
+        return
+
+    if len(torun) == 0:
+        torun = sorted(benchmarks)
+
+    results = []
+    for name in torun:
+        if name not in benchmarks:
+            print "Unknown benchmark: " + name
+            continue
+        print "Running benchmark: " + name
+        res = runbenchmark(name, benchmarks[name], wflowdir)
+        if 'error' in res:
+            print name + ": " + res['error']
+        else:
+            print "%s: %.2f steps/s, startup %.2f s, peak memory %.1f Mb, %.0f bytes/step" % (
+                name, res['steps_per_s'], res['startup_s'], res['peakrss_mb'], res['bytes_per_step'])
+        results.append(res)
+
+    info = {'date': datetime.datetime.now().isoformat(), 'revision': gitrevision(wflowdir),
+            'host': socket.gethostname(), 'platform': platform.platform(), 'python': platform.python_version()}
+    fp = open(resultfile, 'w')
+    json.dump({'info': info, 'results': results}, fp, indent=1)
+    fp.close()
+
+
+if __name__ == "__main__":
+    main()
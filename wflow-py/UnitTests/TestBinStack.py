@@ -0,0 +1,43 @@
+__author__ = 'schelle'
+
+import unittest
+import os
+import tempfile
+import logging
+import numpy
+import pcraster
+import wflow.wf_binstack as wf_binstack
+"""
+Convert the sceleton TEMP mapstack to a binary mapstack and check if the maps match
+"""
+
+class MyTest(unittest.TestCase):
+
+    def testbinstack(self):
+        logger = logging.getLogger("TestBinStack")
+        stack = "wflow_sceleton/inmaps/TEMP"
+        pcraster.setclone("wflow_sceleton/staticmaps/wflow_catchment.map")
+        binname = os.path.join(tempfile.mkdtemp(),"TEMP" + wf_binstack.binstackextension)
+
+        nr = wf_binstack.mapstack2binstack(stack,binname,logger)
+        self.assertEquals(10,nr)
+
+        bstack = wf_binstack.binstackinput(binname,logger)
+        for ts in range(1,11):
+            org = pcraster.pcr2numpy(pcraster.readmap("wflow_sceleton/inmaps/TEMP0000.%03d" % ts),bstack.mv)
+            self.assertTrue(numpy.allclose(org,bstack.gettimestep(ts)))
+
+        self.assertEquals(None,bstack.gettimestep(11))
+
+    def testmapstackfiles(self):
+        folder = tempfile.mkdtemp()
+        for fname in ["P0000000.001","P0000000.002","PET00000.001","P2000001.001","P.tss"]:
+            open(os.path.join(folder,fname),'w').close()
+
+        found = wf_binstack.mapstackfiles(os.path.join(folder,"P"))
+        self.assertEquals([1,2],sorted(found.keys()))
+        self.assertEquals(os.path.join(folder,"P0000000.002"),found[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
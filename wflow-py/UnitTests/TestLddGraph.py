@@ -0,0 +1,112 @@
+__author__ = 'schelle'
+
+import unittest
+import numpy
+import pcraster
+import wflow.wflow_lib as wflow_lib
+import wflow.wflow_funcs as wflow_funcs
+"""
+Compare the numpy drainage network operators and kinematic wave of the lddgraph
+with the pcraster functions on an ldd derived from the sceleton dem
+"""
+
+class MyTest(unittest.TestCase):
+
+    def setUp(self):
+        pcraster.setclone("wflow_sceleton/staticmaps/wflow_catchment.map")
+        dem = pcraster.readmap("wflow_sceleton/staticmaps/wflow_dem.map")
+        self.ldd = pcraster.lddcreate(dem,1E35,1E35,1E35,1E35)
+        self.graph = wflow_lib.getlddgraph(self.ldd)
+        self.material = pcraster.uniform(pcraster.boolean(self.ldd)) * 10.0
+
+    def compare(self,pcrmap,npmap):
+        a = pcraster.pcr2numpy(pcrmap,-999.0)
+        b = pcraster.pcr2numpy(npmap,-999.0)
+        self.assertTrue(numpy.allclose(a,b,rtol=1E-5))
+
+    def testoperators(self):
+        self.assertTrue(self.graph is wflow_lib.getlddgraph(self.ldd))
+        self.compare(pcraster.upstream(self.ldd,self.material),self.graph.upstream(self.material))
+        self.compare(pcraster.downstream(self.ldd,self.material),self.graph.downstream(self.material))
+        self.compare(pcraster.accuflux(self.ldd,self.material),self.graph.accuflux(self.material))
+        self.compare(pcraster.catchmenttotal(self.material,self.ldd),self.graph.catchmenttotal(self.material))
+        flux, state = self.graph.accucapacity(self.material,5.0)
+        self.compare(pcraster.accucapacityflux(self.ldd,self.material,5.0),flux)
+        self.compare(pcraster.accucapacitystate(self.ldd,self.material,5.0),state)
+        points = pcraster.pit(self.ldd) != 0
+        self.compare(pcraster.ldddist(self.ldd,points,1.0),self.graph.ldddist(points,1.0))
+
+    def testgraphcache(self):
+        # smaller networks: only the cells with more than nr upstream cells
+        for nr in range(1,wflow_lib._lddgraphcachesize + 3):
+            wflow_lib.getlddgraph(pcraster.lddrepair(pcraster.ifthen(pcraster.accuflux(self.ldd,1) > nr,self.ldd)))
+        self.assertEqual(len(wflow_lib._lddgraphcache),wflow_lib._lddgraphcachesize)
+        self.assertTrue(self.graph is not wflow_lib.getlddgraph(self.ldd))
+
+    def testkinematic(self):
+        Q = self.material
+        q = self.material / 1000.0
+        pcrq = pcraster.kinematic(self.ldd,Q,q,1.5,0.6,2,86400,1000.0)
+        npq = wflow_funcs.kinematic_numpy(self.graph,Q,q,1.5,0.6,2,86400,1000.0)
+        self.compare(pcrq,npq)
+
+    def testupdater(self):
+        dem = pcraster.readmap("wflow_sceleton/staticmaps/wflow_dem.map")
+        updater = wflow_lib.lddupdater(maxchanged=0.5)
+        first = updater.update(dem)
+        self.compare(pcraster.scalar(self.ldd),pcraster.scalar(first))
+        self.assertTrue(updater.update(dem) is first)
+        self.assertEqual(updater.nrunchanged,1)
+        # lower one cell (the first, away from filled depressions, for which the update is
+        # done without lddcreate). Outside the locked cells this must give the ldd of lddcreate.
+        demarr = pcraster.pcr2numpy(dem,-9999.0)
+        candidates = numpy.transpose(numpy.nonzero(~updater.locked & (updater.raw != 5) & (updater.raw > 0)))
+        newldd = None
+        for row, col in candidates:
+            for drop in [0.1,0.5,2.0]:
+                newarr = demarr.copy()
+                newarr[row,col] = newarr[row,col] - drop
+                newdem = pcraster.numpy2pcr(pcraster.Scalar,newarr,-9999.0)
+                trial = wflow_lib.lddupdater(maxchanged=0.5)
+                trial.ldd, trial.raw, trial.locked, trial.lddmap = updater.ldd, updater.raw, updater.locked, updater.lddmap
+                result = trial.update(newdem)
+                if trial.nrupdates == 1:
+                    newldd = result
+                    break
+            if newldd is not None:
+                break
+
+        self.assertTrue(newldd is not None)
+        self.assertTrue(numpy.any(trial.ldd != updater.ldd))
+        a = pcraster.pcr2numpy(pcraster.scalar(pcraster.lddcreate(newdem,1E35,1E35,1E35,1E35)),0)
+        b = pcraster.pcr2numpy(pcraster.scalar(newldd),0)
+        self.assertTrue(numpy.array_equal(a[~updater.locked],b[~updater.locked]))
+        wflow_lib.lddgraph(newldd)
+
+    def testsparsedynamicwave(self):
+        dem = pcraster.readmap("wflow_sceleton/staticmaps/wflow_dem.map")
+        const = lambda value: pcraster.spatial(pcraster.scalar(value))
+        wave = wflow_funcs.sparsedynamicwave(self.graph,dem,const(1000.0),const(10.0),const(2.0),const(1.0),const(50.0))
+        n = self.graph.nrcells
+        h = numpy.ones(n) * 0.5
+        qlat = numpy.ones(n) * 0.1
+        rough = numpy.ones(n) * 0.03
+        bound = numpy.empty(n)
+        bound.fill(numpy.nan)
+        dt = 10.0
+        # mass balance of one implicit step: storage change = lateral inflow - outflow at the pits
+        area, width, radius = wave.geometry(h)
+        surface = numpy.maximum(width,0.1) * wave.L
+        hnew, Qnew = wave.step(h,numpy.zeros(n),qlat,rough,rough,dt,bound)
+        storage = numpy.sum(surface * (hnew - h))
+        self.assertTrue(numpy.allclose(storage,(numpy.sum(qlat) - numpy.sum(Qnew[wave.pits])) * dt,rtol=1E-6))
+
+        Qmap, hmap, nrsteps, maxcourant = wave.run(self.graph.tomap(h),const(0.0),self.graph.tomap(qlat),const(0.03),const(0.05),3600.0)
+        self.assertTrue(nrsteps >= 1)
+        self.assertTrue(maxcourant <= wave.maxcourant + 1E-6 or nrsteps * wave.mintimestep >= 3600.0)
+        self.assertTrue(numpy.all(numpy.isfinite(self.graph.values(Qmap))))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
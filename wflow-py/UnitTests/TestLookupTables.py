@@ -0,0 +1,53 @@
+__author__ = 'schelle'
+
+import unittest
+import os
+import numpy
+import pcraster
+import wflow.wflow_lib as wflow_lib
+"""
+Compare the numpy lookuptables with pcraster lookupscalar for a table with
+single values and ranges
+"""
+
+tbl = """1 <,50] 1.5
+1 <50,> 2.5
+[2,4> <,> 3.0
+<,> 100 4.0
+<,> <,> 9.0
+"""
+
+class MyTest(unittest.TestCase):
+
+    def setUp(self):
+        pcraster.setclone("wflow_sceleton/staticmaps/wflow_catchment.map")
+        self.subcatch = pcraster.ordinal(pcraster.readmap("wflow_sceleton/staticmaps/wflow_subcatch.map"))
+        self.dem = pcraster.ordinal(pcraster.roundoff(pcraster.readmap("wflow_sceleton/staticmaps/wflow_dem.map")))
+        self.tblname = "wflow_sceleton/test_lookup.tbl"
+        fp = open(self.tblname,'w')
+        fp.write(tbl)
+        fp.close()
+
+    def tearDown(self):
+        os.remove(self.tblname)
+
+    def testlookup(self):
+        tables = wflow_lib.lookuptables(self.subcatch,self.dem)
+        a = pcraster.pcr2numpy(pcraster.lookupscalar(self.tblname,self.subcatch,self.dem),-999.0)
+        b = pcraster.pcr2numpy(tables.lookupscalar(self.tblname),-999.0)
+        self.assertTrue(numpy.allclose(a,b))
+
+        twice = pcraster.pcr2numpy(tables.lookupscalar(self.tblname,self.tblname),-999.0)
+        self.assertTrue(numpy.allclose(numpy.where(a == -999.0,-999.0,a * a),twice))
+
+    def testreadlookuptable(self):
+        fp = open(self.tblname,'w')
+        fp.write("# comment\n[2, 4> <,14] 3.0\n")
+        fp.close()
+        rows = wflow_lib.readlookuptable(self.tblname,2)
+        self.assertEqual(rows,[([(2.0,4.0,True,False),(-numpy.inf,14.0,False,True)],3.0)])
+        self.assertRaises(ValueError,wflow_lib.readlookuptable,self.tblname,3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+__author__ = 'schelle'
+
+import unittest
+import logging
+import multiprocessing
+import wflow.wf_parallel as wf_parallel
+"""
+Run a chain of pipeline workers that pass more data through their queues than
+fits in a pipe buffer with a single worker slot. A worker can only exit after
+its data has been read by the next worker, so this blocks if the slot is only
+given up when the worker exits.
+"""
+
+steps = 5
+payload = 200000
+
+
+def headwater(outqueue,done):
+    for ts in range(1,steps + 1):
+        outqueue.put((ts,[1.0] * payload))
+    done.set()
+
+
+def middle(inqueue,outqueue,done):
+    for ts in range(1,steps + 1):
+        step, values = inqueue.get()
+        outqueue.put((step,[v + 1.0 for v in values]))
+    done.set()
+
+
+def outlet(inqueue,resqueue,done):
+    total = 0.0
+    for ts in range(1,steps + 1):
+        step, values = inqueue.get()
+        total = total + sum(values)
+    resqueue.put(total)
+    done.set()
+
+
+class MyTest(unittest.TestCase):
+
+    def testpipeline(self):
+        logger = logging.getLogger("TestParallel")
+        queues = [multiprocessing.Queue() for i in range(0,3)]
+        done = [multiprocessing.Event() for i in range(0,3)]
+        workers = [multiprocessing.Process(target=headwater,name="headwater",args=(queues[0],done[0])),
+                   multiprocessing.Process(target=middle,name="middle",args=(queues[0],queues[1],done[1])),
+                   multiprocessing.Process(target=outlet,name="outlet",args=(queues[1],queues[2],done[2]))]
+        result = wf_parallel.runpipeline(workers,done,1,logger)
+        self.assertEqual(result,[0,0,0])
+        self.assertEqual(queues[2].get(timeout=10),2.0 * payload * steps)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,6 +15,7 @@ from pcraster import *
 from pcraster.framework import *
 import logging
 import logging.handlers
+from wflow.wflow_lib import lookuptables
 
 
   
@@ -191,15 +192,17 @@ def interpolategauges(inputmap,method):
 
 _tableToMap_LastTbl = {}
 _tableToMap_LastMap = {}
+_tableToMap_Tables = {}
 
 
-def tableToMapSparse (step, table, map):
+def tableToMapSparse (step, table, map, tblengine='pcraster'):
     """Reads a pcraster.tbl file for step and assigns using the map in map.
     The behaviour of is a bit similar to the timeinputSparse
     command but in this case for both the tbl file and the map file.
    
     Input: step (int), table (string, path, without the .tbl extension), map
-          (ordinal map, without the .map extension)
+          (ordinal map, without the .map extension), tblengine (pcraster or
+          numpy, see the tblengine setting of the framework)
 
     How to create your maps/tables:
     if the maps for the timstep is not found the
@@ -218,11 +221,14 @@ def tableToMapSparse (step, table, map):
     - LAI10.map will be used between 10 and 119
     etc....
     The same holds for the tables.
-    
-    
+
+    With tblengine=numpy the class maps are only read again if the file changes
+    and the values of a table are kept (see wflow_lib.lookuptables) until the
+    table changes.
     """
     global _tableToMap_LastTbl
     global _tableToMap_LastMap
+    global _tableToMap_Tables
     global debug
     
     # construct filenames
@@ -249,7 +255,13 @@ def tableToMapSparse (step, table, map):
 	    fname_map = map + str(_tableToMap_LastMap[map]) + ".map"
         
     
-    rmat = lookupscalar(str(fname_tbl),str(fname_map))
+    if tblengine == 'numpy':
+        mtime = os.path.getmtime(fname_map)
+        if fname_map not in _tableToMap_Tables or _tableToMap_Tables[fname_map][0] != mtime:
+            _tableToMap_Tables[fname_map] = (mtime,lookuptables(readmap(str(fname_map))))
+        rmat = _tableToMap_Tables[fname_map][1].lookupscalar(str(fname_tbl))
+    else:
+        rmat = lookupscalar(str(fname_tbl),str(fname_map))
 
     return rmat
 
@@ -28,12 +28,21 @@ import datetime
 import ConfigParser
 
 from wflow.wf_netcdfio import *
+from wflow.wf_binstack import binstackinput, binstackextension, mapstackfiles
 #from wf_Timeoutput import *
 import pcrut
 import glob
 import traceback
 from wflow_adapt import getStartTimefromRuninfo, getEndTimefromRuninfo
-from collections import namedtuple
+from collections import namedtuple, deque, OrderedDict
+import operator
+import re
+import json
+import hashlib
+import threading
+import Queue
+import osgeo.gdal as gdal
+import pcraster
 
 
 logging = None
@@ -42,6 +51,11 @@ from pcraster.framework import *
 from wflow_lib import *
 import time
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 def log_uncaught_exceptions(ex_cls, ex, tb):
     global logging
     logging.error(''.join(traceback.format_tb(tb)))
@@ -102,61 +116,218 @@ class wf_exchnageVariables():
                     return 1
         return 1   
 
+checkpointname = "wflow_states.npz"
+checkpointmv = 1E31
+checkpointvaluescales = {'Boolean': Boolean, 'Nominal': Nominal, 'Ordinal': Ordinal,
+                         'Scalar': Scalar, 'Directional': Directional, 'Ldd': Ldd}
+
+def checkpointvaluescale(pcrmap):
+    """
+    Returns the name of the valuescale of a pcraster map (used in the checkpoint files)
+    """
+    for name, vs in checkpointvaluescales.iteritems():
+        if pcrmap.dataType() == vs:
+            return name
+
+    return 'Scalar'
+
+
 class wf_sumavg():
 
-    def __init__(self,varname,mode='sum',filename=None):
+    def __init__(self,varname,mode='sum',filename=None,params=[]):
         """
         Class to hold variable in the usermodel that must be averaged summed etc.
+        The statistics are accumulated in place in float64 numpy arrays (one value
+        per cell) so no new maps are made during the run.
+
+        varname: name of the variable in the usermodel (without self.)
+        mode: one of availtypes
+        filename: map to save the result to
+        params: extra parameters of the mode:
+            - count: threshold (number of steps the variable is above the threshold)
+            - perc: percentile (0-100), lower and upper bound of the histogram, number of bins (default 100)
+
+        The percentiles are approximated from a histogram with fixed bins. If the
+        bounds are not given they are taken from the first timestep (0 .. 2 * max)
+        and values outside the bounds are counted in the first or last bin.
         """
         if filename == None:
             filename=varname
         self.mode = mode
         self.varname = varname
+        self.getter = operator.attrgetter(varname) if varname != None else None
         self.filename = filename
-        self.data = []
+        self.params = params
         self.count = 0
         self.result = []
-        self.availtypes =['sum','avg','min','max']
+        self.availtypes =['sum','avg','min','max','var','std','count','timeofmax','perc']
+        self.shape = None
+        self.data = None
+
+        if mode == 'count' and len(params) < 1:
+            raise ValueError("summary_count needs a threshold: " + str(varname))
+        if mode == 'perc' and len(params) not in [1,3,4]:
+            raise ValueError("summary_perc needs a percentile and optionally lower, upper bound and nr of bins: " + str(varname))
 
 
-    def add_one(self,data):
+    def _asarray(self,data):
         """
-        Ad a map (timmestep)
+        Returns the data as a flat float numpy array (a view of the map if possible).
+        Missing values are NaN.
         """
-        if self.count == 0:
-            self.data = data
+        if hasattr(data,'isSpatial'):
+            if not data.isSpatial():
+                data = spatial(data)
+            if data.dataType() != Scalar:
+                data = scalar(data)
+            return pcr_as_numpy(data).ravel()
         else:
-            if self.mode == 'sum' or self.mode == 'avg':
-                self.data = self.data + data
-            if self.mode == 'max':
-                self.data = max(self.data,data)
-            if self.mode == 'min':
-                self.data = min(self.data,data)
+            return numpy.float64(data)
+
+
+    def _setup(self,values):
+        """
+        Allocates the accumulator and work arrays at the first timestep
+        """
+        self.shape = (getrows(),getcols())
+        size = self.shape[0] * self.shape[1]
+        self.data = numpy.zeros(size,dtype=numpy.float64)
+        self.work = numpy.zeros(size,dtype=numpy.float64)
+        self.mask = numpy.zeros(size,dtype=numpy.bool_)
+
+        if self.mode == 'min' or self.mode == 'max':
+            self.data[:] = values
+        if self.mode == 'var' or self.mode == 'std':
+            self.m2 = numpy.zeros(size,dtype=numpy.float64)
+            self.work2 = numpy.zeros(size,dtype=numpy.float64)
+        if self.mode == 'timeofmax':
+            self.maxval = numpy.empty(size,dtype=numpy.float64)
+            self.maxval[:] = -numpy.inf
+        if self.mode == 'perc':
+            self.nbins = int(self.params[3]) if len(self.params) > 3 else 100
+            if len(self.params) > 1:
+                self.lower = float(self.params[1])
+                self.upper = float(self.params[2])
+            else:
+                self.lower = 0.0
+                self.upper = 2.0 * float(numpy.nanmax(values))
+                if not self.upper > self.lower:
+                    self.upper = self.lower + 1.0
+            self.hist = numpy.zeros(size * self.nbins,dtype=numpy.int32)
+            self.binbase = numpy.arange(size,dtype=numpy.int64) * self.nbins
+            self.binindex = numpy.zeros(size,dtype=numpy.int64)
+            self.valid = numpy.ones(size,dtype=numpy.bool_)
+
+
+    def add_one(self,data,timestep=None):
+        """
+        Ad a map (timmestep)
+
+        data: map or value to add
+        timestep: timestep of the map (used for timeofmax). Defaults to the number of
+                  maps added so far.
+        """
+        values = self._asarray(data)
+        if self.data is None:
+            self._setup(values)
         self.count = self.count + 1
+        if timestep is None:
+            timestep = self.count
+
+        if self.mode == 'sum' or self.mode == 'avg':
+            numpy.add(self.data,values,out=self.data)
+        elif self.mode == 'max':
+            numpy.maximum(self.data,values,out=self.data)
+        elif self.mode == 'min':
+            numpy.minimum(self.data,values,out=self.data)
+        elif self.mode == 'var' or self.mode == 'std':
+            # Welford: mean in self.data, sum of squared differences in self.m2
+            numpy.subtract(values,self.data,out=self.work)
+            numpy.divide(self.work,self.count,out=self.work2)
+            numpy.add(self.data,self.work2,out=self.data)
+            numpy.subtract(values,self.data,out=self.work2)
+            numpy.multiply(self.work,self.work2,out=self.work)
+            numpy.add(self.m2,self.work,out=self.m2)
+        elif self.mode == 'count':
+            numpy.greater(values,self.params[0],out=self.mask)
+            numpy.add(self.data,self.mask,out=self.data)
+        elif self.mode == 'timeofmax':
+            numpy.greater(values,self.maxval,out=self.mask)
+            numpy.copyto(self.maxval,values,where=self.mask)
+            numpy.copyto(self.data,timestep,where=self.mask)
+        elif self.mode == 'perc':
+            self.work[:] = values
+            numpy.isfinite(self.work,out=self.mask)
+            numpy.logical_and(self.valid,self.mask,out=self.valid)
+            numpy.logical_not(self.mask,out=self.mask)
+            numpy.copyto(self.work,self.lower,where=self.mask)
+            numpy.subtract(self.work,self.lower,out=self.work)
+            numpy.multiply(self.work,self.nbins/(self.upper - self.lower),out=self.work)
+            numpy.clip(self.work,0,self.nbins - 1,out=self.work)
+            self.binindex[:] = self.work
+            numpy.add(self.binindex,self.binbase,out=self.binindex)
+            # One bin per cell so the indices are unique
+            self.hist[self.binindex] += 1
+
+
+    def _percentile(self):
+        """
+        Returns the configured percentile from the histograms (the centre of the bin)
+        """
+        hist = self.hist.reshape(-1,self.nbins)
+        target = self.params[0]/100.0 * self.count
+        cum = numpy.cumsum(hist,axis=1)
+        binnr = numpy.sum(cum < target,axis=1)
+        binnr = numpy.clip(binnr,0,self.nbins - 1)
+        width = (self.upper - self.lower)/self.nbins
+        ret = self.lower + (binnr + 0.5) * width
+        ret[~self.valid] = numpy.nan
+
+        return ret
+
 
     def finalise(self):
         """
         Perform final calculations if needed (average, etc) and assign to the
-        result variable
+        result variable. The accumulators are not changed so this can be
+        called more than once during a run.
         """
-        if hasattr(self.data,"isSpatial"):
-            if self.mode == 'sum' or self.mode == 'min' or self.mode == 'max':
-                self.result = self.data
-            if self.mode == 'avg':
-                self.result = self.data/self.count
+        if self.data is None or self.count == 0:
+            return
+
+        if self.mode == 'avg':
+            ret = self.data/self.count
+        elif self.mode == 'var':
+            ret = self.m2/self.count
+        elif self.mode == 'std':
+            ret = numpy.sqrt(self.m2/self.count)
+        elif self.mode == 'timeofmax':
+            # cells that never had a value keep -inf as maximum
+            ret = numpy.where(numpy.isinf(self.maxval),numpy.nan,self.data)
+        elif self.mode == 'perc':
+            ret = self._percentile()
+        else:
+            ret = self.data.copy()
+
+        ret[numpy.isnan(ret)] = checkpointmv
+        self.result = numpy2pcr(Scalar,ret.reshape(self.shape),checkpointmv)
 
 
 class wf_OutputTimeSeriesArea():
     
-  def __init__(self, area,oformat='csv'):
+  def __init__(self, area,oformat='csv',bufsteps=1,flushinterval=0):
       """
       Replacement timeseries output function for the pcraster framework
       
       area - an area-map to average from
       oformat  - format of the output file (csv, txt, tss, only csv and tss at the moment)
+      bufsteps - number of timesteps to keep in memory before writing to disk. If 1
+                 (the default) each row is written directly to a line buffered file
+      flushinterval - also write the buffer if it is older than this number of
+                 seconds (0 disables the time based flush)
 
-      Step 1: make average of variable using the areaverage function
-      Step 2: Sample the values from the areas (remember the index so we can do it faster lateron)
+      Step 1: build a zone index (flat cell index and zone number of each active cell) once
+      Step 2: average the variable(s) per zone with a single numpy bincount
       step 3: store them in order
       """
       
@@ -165,26 +336,98 @@ class wf_OutputTimeSeriesArea():
       self.areanp= pcr2numpy(area,0)
       self.oformat=oformat
       
-      self.flatarea,self.idx = numpy.unique(self.areanp,return_index=True)
+      self.flatarea,self.idx,zoneofcell = numpy.unique(self.areanp,return_index=True,return_inverse=True)
       #print self.flatarea
       #self.flatarea = self.flatarea[numpy.isfinite(self.flatarea)]
       #self.idx = self.idx[numpy.isfinite(self.flatarea)]
+
+      # Zone index: only cells with a defined area take part in the averaging. A zone
+      # sampled at a missing-value cell (the 0 zone) is reported as 0 (as areaaverage did)
+      areadefined = pcr2numpy(defined(area),0).flatten().astype(bool)
+      self.activecells = numpy.flatnonzero(areadefined)
+      self.zones = zoneofcell.flatten()[self.activecells]
+      self.nzones = len(self.flatarea)
+      self.validzone = areadefined[self.idx]
+      self.zonecount = numpy.bincount(self.zones,minlength=self.nzones).astype(float)
+
+      self.bufsteps = int(bufsteps) if int(bufsteps) > 1 else 1
+      self.flushinterval = flushinterval
+      self.lastflush = time.time()
+      if self.oformat == 'tss':
+          delimiter = ' '
+      else:
+          delimiter = ','
+      # %.17g: no loss of precision compared to the repr output of the csv writer
+      self.rowformat = delimiter.join(['%d'] + ['%.17g'] * self.nzones) + "\n"
+
       self.fnamelist=[]  
       self.writer=[]
       self.ofile=[]
+      self.buffer=[]
+      self.bufpos=[]
+
+  def flush(self):
+      """
+      Write all buffered rows to disk and flush the files
+      """
+      for thiswriter in range(0,len(self.fnamelist)):
+          nrows = self.bufpos[thiswriter]
+          if nrows > 0:
+              block = self.buffer[thiswriter][0:nrows,:]
+              self.ofile[thiswriter].write((self.rowformat * nrows) % tuple(block.ravel()))
+              self.bufpos[thiswriter] = 0
+          self.ofile[thiswriter].flush()
+
+      self.lastflush = time.time()
 
   def closeall(self):
       """
-      Close all open filepointers
+      Flush and close all open filepointers
       """
 
+      self.flush()
       for fp in self.ofile:
           fp.close()
           
       self.fnamelist=[]  
       self.writer=[]
       self.ofile=[]
-      
+      self.buffer=[]
+      self.bufpos=[]
+
+
+  def aggregate(self,variables):
+      """
+      Average a list of variables over the zones of the area map in one pass
+
+      variables - list of pcraster maps (or scalars)
+
+      returns a (len(variables), nzones) numpy array with the zone averages
+      """
+      nvars = len(variables)
+      values = numpy.empty((nvars,len(self.activecells)))
+      for i, variable in enumerate(variables):
+          values[i,:] = pcr_as_numpy(scalar(spatial(variable))).ravel()[self.activecells]
+
+      # offset the zone numbers per variable so all variables go into a single bincount
+      keys = (self.zones + self.nzones * numpy.arange(nvars)[:,numpy.newaxis]).ravel()
+      values = values.ravel()
+      ok = numpy.isfinite(values)
+      if ok.all():
+          sums = numpy.bincount(keys,weights=values,minlength=nvars * self.nzones)
+          counts = numpy.tile(self.zonecount,nvars)
+      else:
+          sums = numpy.bincount(keys[ok],weights=values[ok],minlength=nvars * self.nzones)
+          counts = numpy.bincount(keys[ok],minlength=nvars * self.nzones).astype(float)
+
+      res = numpy.zeros(nvars * self.nzones)
+      hasdata = counts > 0
+      res[hasdata] = sums[hasdata]/counts[hasdata]
+      res = res.reshape((nvars,self.nzones))
+      res[:,~self.validzone] = 0.0
+
+      return res
+
       
   def writestep(self,variable,fname,timestep=None):
       """
@@ -193,40 +436,467 @@ class wf_OutputTimeSeriesArea():
       variable - pcraster map to save to tss
       fname - name of the timeseries file
       """
-      # Add new file if not already present
-      if fname not in self.fnamelist:
-           bufsize = 1 # Implies line buffered
-           self.fnamelist.append(fname)
-
-           self.ofile.append(open(fname,'wb',bufsize))
-           if self.oformat =='csv': # Always the case
-               self.writer.append(csv.writer(self.ofile[-1]))
-               self.ofile[-1].write("# Timestep,")
-               self.writer[-1].writerow(self.flatarea)
-           if self.oformat =='tss': # test
-               self.writer.append(csv.writer(self.ofile[-1],delimiter=' '))
-               self.ofile[-1].write("timeseries scalar\n")
-               self.ofile[-1].write(str(len(self.flatarea) + 1) + "\n")
-               self.ofile[-1].write("timestep\n")
-               for idd in self.flatarea:
-                   self.ofile[-1].write(str(idd) +"\n")
+      self.writesteps([variable],[fname],timestep=timestep)
+
+
+  def writesteps(self,variables,fnames,timestep=None):
+      """
+      write a single timestep for a number of variables that share this area map
+
+      variables - list of pcraster maps to save to tss
+      fnames - list with the name of the timeseries file for each variable
+      """
+      for fname in fnames:
+          # Add new file if not already present
+          if fname not in self.fnamelist:
+               if self.bufsteps == 1:
+                   bufsize = 1 # Implies line buffered
+               else:
+                   bufsize = -1 # System default, rows are written in blocks
+               self.fnamelist.append(fname)
+               self.buffer.append(numpy.zeros((self.bufsteps,self.nzones + 1)))
+               self.bufpos.append(0)
+
+               self.ofile.append(open(fname,'wb',bufsize))
+               if self.oformat =='csv': # Always the case
+                   self.writer.append(csv.writer(self.ofile[-1]))
+                   self.ofile[-1].write("# Timestep,")
+                   self.writer[-1].writerow(self.flatarea)
+               if self.oformat =='tss': # test
+                   self.writer.append(csv.writer(self.ofile[-1],delimiter=' '))
+                   self.ofile[-1].write("timeseries scalar\n")
+                   self.ofile[-1].write(str(len(self.flatarea) + 1) + "\n")
+                   self.ofile[-1].write("timestep\n")
+                   for idd in self.flatarea:
+                       self.ofile[-1].write(str(idd) +"\n")
  
       self.steps = self.steps + 1
-      tmpvar = scalar(spatial(variable))
-      self.resmap = areaaverage(tmpvar,self.area)
-      self.remap_np = pcr2numpy(self.resmap,0)
-      self.flatres = self.remap_np.flatten()[self.idx]
+      self.flatres = self.aggregate(variables)
 
-      thiswriter = self.fnamelist.index(fname)
       if timestep >= 0:
-          self.writer[thiswriter].writerow([timestep] + self.flatres.tolist())
-          #self.flatres = numpy.insert(self.flatres,0,timestep)
+          thestep = timestep
       else:
-          self.writer[thiswriter].writerow([self.steps] +  self.flatres.tolist())
-          #self.flatres = numpy.insert(self.flatres,0,self.steps)
+          thestep = self.steps
+
+      blockfull = False
+      for fname, flatres in zip(fnames,self.flatres):
+          thiswriter = self.fnamelist.index(fname)
+          if self.bufsteps == 1:
+              # not buffered: write the row with the csv writer (as before the buffering)
+              self.writer[thiswriter].writerow([thestep] + flatres.tolist())
+              continue
+          pos = self.bufpos[thiswriter]
+          self.buffer[thiswriter][pos,0] = thestep
+          self.buffer[thiswriter][pos,1:] = flatres
+          self.bufpos[thiswriter] = pos + 1
+          if self.bufpos[thiswriter] >= self.bufsteps:
+              blockfull = True
+
+      if blockfull or (self.flushinterval > 0 and time.time() - self.lastflush >= self.flushinterval):
+          self.flush()
 
              
         
+class wf_OutputMapWriter():
+
+  def __init__(self,logger,nrworkers=2,maxqueue=8):
+      """
+      Pool of writer threads for the dynamic output maps. Maps are snapshotted as numpy
+      arrays in the model thread and written (and compressed) by the workers.
+
+      logger - python logging object
+      nrworkers - number of writer threads
+      maxqueue - maximum number of maps waiting to be written. If the queue is full
+                 the model waits for the writers (backpressure)
+      """
+      self.logger = logger
+      self.mv = 1E31
+      self.queue = Queue.Queue(maxsize=maxqueue)
+      self.errors = []
+      self.geotransform = [pcraster._pcraster.clone().west(),pcraster._pcraster.clone().cellSize(),0.0,
+                           pcraster._pcraster.clone().north(),0.0,-pcraster._pcraster.clone().cellSize()]
+      self.workers = []
+      for i in range(0,nrworkers):
+          worker = threading.Thread(target=self._worker,name="outputmapwriter_" + str(i))
+          worker.daemon = True
+          worker.start()
+          self.workers.append(worker)
+
+  def put(self,variable,path,outputformat,gzipit=False):
+      """
+      Snapshot a map and queue it for writing
+
+      :return: True if the map is queued, False if it must be written directly (only
+               scalar maps can be written as pcraster maps by the workers)
+      """
+      if not hasattr(variable,'isSpatial'):
+          return False
+      if outputformat == 1:
+          try:
+              if not variable.isSpatial() or variable.dataType() != Scalar:
+                  return False
+          except AttributeError:
+              return False
+          data = pcr2numpy(variable,self.mv).astype(numpy.float32)
+      else:
+          data = pcr2numpy(variable,-999)
+
+      self.queue.put((outputformat,data,path,gzipit))
+      return True
+
+  def flush(self):
+      """
+      Barrier: waits until all queued maps are written
+      """
+      self.queue.join()
+      for err in self.errors:
+          self.logger.error("Error writing output map: " + err)
+      self.errors = []
+
+  def close(self):
+      """
+      Write all queued maps and stop the workers
+      """
+      self.flush()
+      for worker in self.workers:
+          self.queue.put(None)
+      for worker in self.workers:
+          worker.join()
+      self.workers = []
+
+  def _worker(self):
+      while True:
+          item = self.queue.get()
+          try:
+              if item is None:
+                  return
+              self._write(*item)
+          except Exception, e:
+              self.errors.append(item[2] + ": " + str(e))
+          finally:
+              self.queue.task_done()
+
+  def _write(self,outputformat,data,path,gzipit):
+      if outputformat == 1:
+          memds = gdal.GetDriverByName('MEM').Create('',data.shape[1],data.shape[0],1,gdal.GDT_Float32)
+          memds.SetGeoTransform(self.geotransform)
+          band = memds.GetRasterBand(1)
+          band.SetNoDataValue(self.mv)
+          band.WriteArray(data)
+          outds = gdal.GetDriverByName('PCRaster').CreateCopy(path,memds,0,['PCRASTER_VALUESCALE=VS_SCALAR'])
+          outds = None
+          memds = None
+          if gzipit:
+              Gzip(path,storePath=True)
+      elif outputformat == 2 or outputformat == 3:
+          numpy.savez(path,data)
+      elif outputformat == 4:
+          numpy.savetxt(path,data,fmt="%0.6g")
+
+
+
+class wf_MapCache():
+
+  def __init__(self,logger,maxitems=64):
+      """
+      Least recently used cache of maps read from disk (climatology, static maps). The
+      key is the full path of the file, a map is read again if the modification time
+      of the file changed. If more than maxitems maps are kept the least recently
+      used map is removed.
+
+      logger - python logging object
+      maxitems - maximum number of maps to keep in memory
+      """
+      self.logger = logger
+      self.maxitems = maxitems
+      self.items = OrderedDict()
+      self.lock = threading.Lock()
+      self.hits = 0
+      self.misses = 0
+      self.evictions = 0
+
+  def readmap(self,path):
+      """
+      Returns the map in path from the cache or reads it from disk
+      """
+      key = os.path.abspath(path)
+      mtime = os.path.getmtime(key)
+      with self.lock:
+          if key in self.items:
+              itemtime, pcrmap = self.items.pop(key)
+              if itemtime == mtime:
+                  self.items[key] = (itemtime,pcrmap)
+                  self.hits = self.hits + 1
+                  return pcrmap
+
+      pcrmap = readmap(path)
+      with self.lock:
+          self.misses = self.misses + 1
+          self.items[key] = (mtime,pcrmap)
+          while len(self.items) > self.maxitems:
+              self.items.popitem(last=False)
+              self.evictions = self.evictions + 1
+
+      return pcrmap
+
+  def report(self):
+      """
+      Logs the hits and misses
+      """
+      total = self.hits + self.misses
+      self.logger.info("Map cache: %d reads, %d hits (%.1f%%), %d misses, %d evictions, %d maps in memory" %
+                       (total,self.hits,100.0 * self.hits / total if total > 0 else 0.0,self.misses,self.evictions,len(self.items)))
+
+
+
+class wf_ForcingPrefetcher():
+
+  def __init__(self,logger,nrworkers=2,depth=2,laststep=0):
+      """
+      Reads the maps of the forcing mapstacks for the next timesteps in a pool of
+      background threads while the model computes the current step. The maps are
+      read as numpy arrays with gdal (only scalar pcraster maps are used, other maps
+      and missing files are left to the normal reading in wf_readmap).
+
+      logger - python logging object
+      nrworkers - number of reader threads
+      depth - number of steps to read ahead of the current step
+      laststep - last timestep of the run (no maps are read beyond it, 0: no limit)
+      """
+      self.logger = logger
+      self.depth = depth
+      self.laststep = laststep
+      self.stacks = set()
+      self.items = {}
+      self.lock = threading.Lock()
+      self.queue = Queue.Queue()
+      self.hits = 0
+      self.misses = 0
+      self.workers = []
+      for i in range(0,nrworkers):
+          worker = threading.Thread(target=self._worker,name="forcingprefetcher_" + str(i))
+          worker.daemon = True
+          worker.start()
+          self.workers.append(worker)
+
+  def register(self,name,firststep):
+      """
+      Adds a mapstack and starts reading the first steps of the run. Mapstacks that
+      are not registered are added the first time get is called for them.
+      """
+      self.stacks.add(name)
+      self._schedule(name,firststep)
+
+  def _schedule(self,name,step):
+      """
+      Queues the steps step..step+depth-1 of mapstack name that are not queued yet
+      """
+      for ahead in range(step,step + self.depth):
+          if self.laststep > 0 and ahead > self.laststep:
+              break
+          with self.lock:
+              if (name,ahead) in self.items:
+                  continue
+              item = [threading.Event(),None,None]
+              self.items[(name,ahead)] = item
+          self.queue.put((generateNameT(name,ahead),item))
+
+  def get(self,name,step):
+      """
+      Returns (data, missing value) of mapstack name for step or None if the map
+      was not read ahead (it is read ahead from now on)
+      """
+      self.stacks.add(name)
+      with self.lock:
+          item = self.items.pop((name,step),None)
+          # maps of earlier steps that were not used (e.g. stacks that are not read every step)
+          for key in [key for key in self.items if key[1] < step]:
+              del self.items[key]
+      self._schedule(name,step + 1)
+      if item is None:
+          self.misses = self.misses + 1
+          return None
+
+      item[0].wait()
+      if item[1] is None:
+          self.misses = self.misses + 1
+          return None
+      self.hits = self.hits + 1
+
+      return item[1], item[2]
+
+  def close(self):
+      """
+      Stop the workers and log the number of maps read ahead
+      """
+      for worker in self.workers:
+          self.queue.put(None)
+      for worker in self.workers:
+          worker.join()
+      self.workers = []
+      self.items = {}
+      self.logger.info("Forcing prefetch: %d maps read ahead, %d read by the model" % (self.hits,self.misses))
+
+  def _worker(self):
+      while True:
+          job = self.queue.get()
+          if job is None:
+              return
+          path, item = job
+          try:
+              item[1], item[2] = self._read(path)
+          except Exception, e:
+              self.logger.debug("Cannot read ahead " + path + ": " + str(e))
+          finally:
+              item[0].set()
+
+  def _read(self,path):
+      if not os.path.isfile(path):
+          return None, None
+      ds = gdal.Open(path)
+      if ds is None or ds.GetMetadataItem('PCRASTER_VALUESCALE') not in [None,'VS_SCALAR']:
+          return None, None
+      band = ds.GetRasterBand(1)
+      data = band.ReadAsArray().astype(numpy.float64)
+      mv = band.GetNoDataValue()
+      ds = None
+      if mv is None:
+          return data, 1E31
+
+      return data, float(numpy.float32(mv))
+
+
+class wf_PhaseTimer():
+
+    def __init__(self,fname,logger):
+        """
+        Collects the wall and cpu time of the phases of each timestep and writes
+        them to a per step trace (csv or json, depending on the extension of fname).
+        At the end of the run a summary is logged and saved to <fname without extension>_summary.json
+
+        fname: trace file
+        logger: python logging object
+        """
+        self.fname = fname
+        self.logger = logger
+        self.phases = ['dynamic','wf_readmap','wf_updateparameters','quicksuspend','snapshot',
+                       'savedynmaps','savetimeseries','stats']
+        self.totwall = dict.fromkeys(self.phases,0.0)
+        self.totcpu = dict.fromkeys(self.phases,0.0)
+        self.calls = dict.fromkeys(self.phases,0)
+        self.stepwall = dict.fromkeys(self.phases,0.0)
+        self.stepcpu = dict.fromkeys(self.phases,0.0)
+        self.nrsteps = 0
+        self.starttime = self.now()
+        self.stepstart = self.starttime
+        self.json = os.path.splitext(fname)[1].lower() == '.json'
+        self.trace = []
+        self.fp = None
+        if not self.json:
+            self.fp = open(fname,'w')
+            header = ['step','wall','cpu','peakrssmb']
+            for phase in self.phases:
+                header.extend([phase + '_wall',phase + '_cpu'])
+            self.fp.write(",".join(header) + "\n")
+        logger.info("Writing timing information to: " + fname)
+
+    def now(self):
+        """
+        :return: wall time, cpu time (user + system) in seconds
+        """
+        cpu = os.times()
+        return time.time(), cpu[0] + cpu[1]
+
+    def add(self,phase,wall,cpu):
+        """
+        Adds the time since (wall,cpu) (obtained from now() or a previous add) to a phase
+
+        :return: the current wall and cpu time (the start of the next phase)
+        """
+        nwall, ncpu = self.now()
+        self.stepwall[phase] += nwall - wall
+        self.stepcpu[phase] += ncpu - cpu
+        self.calls[phase] += 1
+        return nwall, ncpu
+
+    def wrap(self,phase,method):
+        """
+        Returns a version of method that adds the time spent in it to phase
+        """
+        def timed(*args,**kwargs):
+            wall, cpu = self.now()
+            try:
+                return method(*args,**kwargs)
+            finally:
+                self.add(phase,wall,cpu)
+
+        return timed
+
+    def peakrss(self):
+        """
+        :return: peak resident memory of the process in Mb (0 if not available on this platform)
+        """
+        if resource is None:
+            return 0.0
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kb, OSX bytes
+        if sys.platform == 'darwin':
+            return rss/1048576.0
+        return rss/1024.0
+
+    def endstep(self,step):
+        """
+        Writes the times of the phases of this step to the trace and resets them
+        """
+        wall, cpu = self.now()
+        steprec = [step,wall - self.stepstart[0],cpu - self.stepstart[1],self.peakrss()]
+        for phase in self.phases:
+            steprec.extend([self.stepwall[phase],self.stepcpu[phase]])
+            self.totwall[phase] += self.stepwall[phase]
+            self.totcpu[phase] += self.stepcpu[phase]
+            self.stepwall[phase] = 0.0
+            self.stepcpu[phase] = 0.0
+
+        if self.json:
+            self.trace.append(steprec)
+        else:
+            self.fp.write(",".join([str(a) for a in steprec]) + "\n")
+        self.nrsteps = self.nrsteps + 1
+        self.stepstart = (wall, cpu)
+
+    def close(self):
+        """
+        Writes the trace (json) and the summary and logs the summary
+        """
+        wall, cpu = self.now()
+        summary = {'steps': self.nrsteps, 'wall': wall - self.starttime[0], 'cpu': cpu - self.starttime[1],
+                   'peakrssmb': self.peakrss(), 'phases': {}}
+        for phase in self.phases:
+            summary['phases'][phase] = {'wall': self.totwall[phase], 'cpu': self.totcpu[phase], 'calls': self.calls[phase]}
+
+        if self.json:
+            columns = ['step','wall','cpu','peakrssmb']
+            for phase in self.phases:
+                columns.extend([phase + '_wall',phase + '_cpu'])
+            fp = open(self.fname,'w')
+            json.dump({'columns': columns, 'steps': self.trace, 'summary': summary},fp)
+            fp.close()
+        elif self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+        fp = open(os.path.splitext(self.fname)[0] + "_summary.json",'w')
+        json.dump(summary,fp,indent=1)
+        fp.close()
+
+        self.logger.info("Timing: " + str(self.nrsteps) + " steps, wall: %.3f s, cpu: %.3f s, peak rss: %.1f Mb" %
+                         (summary['wall'],summary['cpu'],summary['peakrssmb']))
+        for phase in self.phases:
+            if self.calls[phase] > 0:
+                self.logger.info("Timing %s: wall %.3f s, cpu %.3f s, %d calls" %
+                                 (phase,self.totwall[phase],self.totcpu[phase],self.calls[phase]))
+
+
 class wf_DynamicFramework(frameworkBase.FrameworkBase):
   ## \brief Constructor
   #
@@ -239,6 +909,35 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
     frameworkBase.FrameworkBase.__init__(self)
 
     self.ParamType = namedtuple("ParamType", "name stack type default verbose")
+    self.OutputItem = namedtuple("OutputItem", "name getter path writer")
+    self.mapoutputplan = []
+    self.tssoutputplan = []
+    self.tssoutputgroups = []
+    self.statslst = []
+    self.binstacks = {}
+    self.mapwriter = None
+    self.phasetimer = None
+    self.Snapshot = namedtuple("Snapshot", "step datetime states")
+    self.snapshots = None
+    self.snapshotinterval = 1
+    self.stateformat = 'map'
+    self.tblcachedir = None
+    self.mapcache = None
+    self.prefetcher = None
+    self.tblengine = 'pcraster'
+    self._tblengines = {}
+    self.staticcachedir = None
+    self._maphashes = {}
+    self.ensemblemembers = 0
+    self.ensemblemember = None
+    self.ensembleinput = "ensemble/member_{member}"
+    self.ensemblestates = []
+    self.ensemblevars = None
+    self.inputdir = None
+    self.redirectedinputs = {}
+    self.ensemblestats = []
+    self.ensembleNcInput = []
+    self._ensemblesuspend = False
     self.modelparameters = [] # list of model parameters
     self.exchnageitems = wf_exchnageVariables()
     self.setQuiet(True)
@@ -262,6 +961,7 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
     self._addMethodToClass(self.wf_readmap)
     self._addMethodToClass(self.wf_readmapClimatology)
     self._addMethodToClass(self.readtblDefault)
+    self._addMethodToClass(self.wf_cachedStatic)
     self._addMethodToClass(self.wf_supplyVariableNamesAndRoles)
     self._addMethodToClass(self.wf_supplyVariableNamesAndRoles)
     self._addMethodToClass(self.wf_updateparameters)
@@ -308,7 +1008,7 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
                     fname = os.path.join(self._userModel().Dir, par.stack)
                     fileName, fileExtension = os.path.splitext(fname)
                     if fileExtension == '.map':
-                        theparmap = readmap(fname)
+                        theparmap = self._readmapCached(fname)
                     else:
                         self._userModel().logger.error(fname + " Does not have a .map extension")
 
@@ -349,18 +1049,38 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
 
   def _wf_shutdown(self):
       """
-      Makes sure the logging closed
+      Makes sure all (buffered) output is written and the logging closed
       """
-      try:
-          pcrut.logging.shutdown()
+      if hasattr(self,'oscv'):
           for ofile_list in self.oscv:
-              self.oscv[ofile_list].closeall()
-      except:
-          return
+              try:
+                  self.oscv[ofile_list].closeall()
+              except:
+                  self.logger.warn("Could not close timeseries output for: " + ofile_list)
 
       if hasattr(self,'NcOutput'):
         self.NcOutput.finish()
 
+      if self.mapwriter is not None:
+          self.mapwriter.close()
+          self.mapwriter = None
+
+      if self.phasetimer is not None:
+          self.phasetimer.close()
+          self.phasetimer = None
+
+      if self.mapcache is not None:
+          self.mapcache.report()
+
+      if self.prefetcher is not None:
+          self.prefetcher.close()
+          self.prefetcher = None
+
+      try:
+          pcrut.logging.shutdown()
+      except:
+          return
+
  
   def loggingSetUp(self,caseName,runId,logfname,model,modelversion,level=pcrut.logging.INFO):
     """
@@ -386,6 +1106,15 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
     Finally check of a tbl file exists with a .mult postfix (e.g. Cmax.tbl.mult) and apply the
     multiplication to the loaded data.
 
+    With tblengine=numpy in the framework section the tables are evaluated by
+    wflow_lib.lookuptables, the class combinations of the landuse, subcatchment and soil
+    maps are then numbered once for all tables.
+
+    If tblcache is set in the framework section maps made from a tbl file are saved
+    in the cache directory with a key made from the contents of the tbl and .mult files,
+    the landuse, subcatchment and soil maps and the default. The next run with the
+    same inputs reads the map from the cache.
+
     Input:
         -  pathtotbl: full path to table file
         -  landuse: landuse map
@@ -405,10 +1134,21 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
     mapname = os.path.dirname(pathtotbl) + "/../staticmaps/" + os.path.splitext(os.path.basename(pathtotbl))[0]+".map"
     if os.path.exists(mapname):
         self.logger.info("reading map parameter file: " + mapname)
-        rest = cover(readmap(mapname),default)
+        rest = cover(self._readmapCached(mapname),default)
     else:
+        cachefile = self._tblcachefile(pathtotbl,landuse,subcatch,soil,default)
+        if cachefile is not None and os.path.exists(cachefile):
+            self.logger.info("Reading map for table " + pathtotbl + " from cache: " + cachefile)
+            data = numpy.load(cachefile)
+            rest = numpy2pcr(Scalar,data['map'],float(data['mv']))
+            data.close()
+            return rest
+
         if os.path.isfile(pathtotbl):
-            rest=lookupscalar(pathtotbl,landuse,subcatch,soil)
+            if self.tblengine == 'numpy':
+                rest = self._lookuptables(landuse,subcatch,soil).lookupscalar(pathtotbl)
+            else:
+                rest=lookupscalar(pathtotbl,landuse,subcatch,soil)
             self.logger.info("Creating map from table: " + pathtotbl)
         else:
             self.logger.warn("tbl file not found (" + pathtotbl + ") returning default value: " + str(default))
@@ -429,11 +1169,131 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
     # Apply multiplication table if present
     multname = os.path.dirname(pathtotbl) + ".mult"
     if os.path.exists(multname):
-        multfac=lookupscalar(multname,landuse,subcatch,soil)
+        if self.tblengine == 'numpy':
+            multfac = self._lookuptables(landuse,subcatch,soil).lookupscalar(multname)
+        else:
+            multfac=lookupscalar(multname,landuse,subcatch,soil)
         rest = rest * multfac
         self.logger.info("Applying multiplication from table: " + multname)
 
+    if not os.path.exists(mapname) and cachefile is not None:
+        # write to a temporary file first so parallel runs never read a partial file
+        tmpname = cachefile + "." + str(os.getpid()) + ".tmp"
+        fp = open(tmpname,'wb')
+        numpy.savez(fp,map=pcr2numpy(rest,checkpointmv),mv=checkpointmv)
+        fp.close()
+        self._movetocache(tmpname,cachefile)
+
     return rest
+
+
+  def _movetocache(self,tmpname,cachefile):
+      """
+      Moves a temporary file to its name in the cache. On windows the rename fails
+      if the cache file exists, e.g. if a run that started at the same time made it
+      first. That file has the same contents so the temporary file is removed.
+      """
+      try:
+          os.rename(tmpname,cachefile)
+      except OSError:
+          if not os.path.exists(cachefile):
+              raise
+          os.remove(tmpname)
+
+
+  def _lookuptables(self,landuse,subcatch,soil):
+      """
+      Returns the (numpy) lookuptables for a set of class maps. These are made once
+      for each set of class maps with a different content.
+      """
+      key = (self._maphash(landuse),self._maphash(subcatch),self._maphash(soil))
+      if key not in self._tblengines:
+          self._tblengines[key] = lookuptables(landuse,subcatch,soil)
+
+      return self._tblengines[key]
+
+
+  def _maphash(self,pcrmap):
+      """
+      Returns a hash of the contents of a map. The hash is kept for the
+      map object so each map is only hashed once.
+      """
+      if id(pcrmap) not in self._maphashes or self._maphashes[id(pcrmap)][0] is not pcrmap:
+          data = pcr2numpy(pcrmap,-9999)
+          digest = hashlib.sha1(str(data.shape) + str(data.dtype) + data.tostring()).hexdigest()
+          self._maphashes[id(pcrmap)] = (pcrmap,digest)
+
+      return self._maphashes[id(pcrmap)][1]
+
+
+  def _tblcachefile(self,pathtotbl,landuse,subcatch,soil,default):
+      """
+      Returns the name of the cache file of a map made from a tbl file (None if the
+      cache is not used). The name changes if the tbl or .mult file or one
+      of the class maps changes.
+      """
+      if self.tblcachedir is None:
+          return None
+
+      key = hashlib.sha1(os.path.basename(pathtotbl) + str(float(default)))
+      multname = os.path.dirname(pathtotbl) + ".mult"
+      for fname in [pathtotbl,multname]:
+          if os.path.isfile(fname):
+              fp = open(fname,'rb')
+              key.update(fp.read())
+              fp.close()
+          else:
+              key.update("missing")
+      for pcrmap in [landuse,subcatch,soil]:
+          key.update(self._maphash(pcrmap))
+
+      return os.path.join(self.tblcachedir,os.path.splitext(os.path.basename(pathtotbl))[0] + "_" + key.hexdigest() + ".npz")
+
+
+  def wf_cachedStatic(self,name,function,inputs,options=[]):
+      """
+      Returns the map made by function(*inputs) for static maps that are derived from other
+      maps in the initial section (e.g. aspect, accuflux, ldddist). If staticcache is set
+      in the framework section the result is saved in the cache directory of the case and
+      read from there if the name, the contents of the input maps and the options
+      are the same. The cache directory is shared by all models of a case.
+
+      Input:
+          - name: name of the derived map (the same name must give the same map
+            for the same inputs)
+          - function: function that makes the map from the inputs
+          - inputs: list of the maps (or numbers) passed to function
+          - options: list of other settings the map depends on
+
+      Output:
+          - map
+      """
+      if self.staticcachedir is None:
+          return function(*inputs)
+
+      key = hashlib.sha1(name + repr(options))
+      for inp in inputs:
+          if hasattr(inp,'dataType'):
+              key.update(self._maphash(inp))
+          else:
+              key.update(repr(inp))
+      cachefile = os.path.join(self.staticcachedir,name + "_" + key.hexdigest() + ".npz")
+
+      if os.path.exists(cachefile):
+          self.logger.debug("Reading derived map " + name + " from cache: " + cachefile)
+          data = numpy.load(cachefile)
+          result = numpy2pcr(checkpointvaluescales[str(data['valuescale'])],data['map'],checkpointmv)
+          data.close()
+          return result
+
+      result = function(*inputs)
+      tmpname = cachefile + "." + str(os.getpid()) + ".tmp"
+      fp = open(tmpname,'wb')
+      numpy.savez(fp,map=pcr2numpy(result,checkpointmv),valuescale=checkpointvaluescale(result))
+      fp.close()
+      self._movetocache(tmpname,cachefile)
+
+      return result
     
 
   def createRunId(self,intbl="intbl",logfname="wflow.log",NoOverWrite=True,model="model",modelVersion="no version",level=pcrut.logging.DEBUG):
@@ -477,11 +1337,62 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
     self._userModel().config = self.iniFileSetUp(caseName,runId,configfile)
 
     self.outputFormat = int(configget(self._userModel().config,'framework','outputformat','1'))
+    # State files: map (one .map per state) or npz (single compressed checkpoint file)
+    self.stateformat = configget(self._userModel().config,'framework','stateformat','map')
+    # Number of in-memory snapshots of the states to keep (for rolling back) and the interval
+    nrsnapshots = int(configget(self._userModel().config,'framework','snapshotring','0'))
+    self.snapshotinterval = int(configget(self._userModel().config,'framework','snapshotinterval','1'))
+    if nrsnapshots > 0:
+        self.snapshots = deque(maxlen=nrsnapshots)
+
+    # Number of threads for writing output maps (0 means write from the model thread)
+    nrwriters = int(configget(self._userModel().config,'framework','outputmapwriters','0'))
+    if nrwriters > 0:
+        writerqueue = int(configget(self._userModel().config,'framework','outputmapqueue','8'))
+        self.mapwriter = wf_OutputMapWriter(self.logger,nrworkers=nrwriters,maxqueue=writerqueue)
+    # Timing of the phases of each timestep. wf_readmap and wf_updateparameters of the
+    # usermodel are only replaced by timed versions if this is switched on.
+    if int(configget(self._userModel().config,'framework','timing','0')):
+        timingfile = configget(self._userModel().config,'framework','timingfile','timing.csv')
+        self.phasetimer = wf_PhaseTimer(os.path.join(caseName,runId,timingfile),self.logger)
+        setattr(self._userModel(),'wf_readmap',self.phasetimer.wrap('wf_readmap',self.wf_readmap))
+        setattr(self._userModel(),'wf_updateparameters',self.phasetimer.wrap('wf_updateparameters',self.wf_updateparameters))
+
     self.APIDebug = int(configget(self._userModel().config,'framework','debug',str(self.APIDebug)))
 
+    self.tblengine = configget(self._userModel().config,'framework','tblengine',self.tblengine)
+
+    # Keep climatology and static maps in memory (see wf_MapCache)
+    mapcachesize = int(configget(self._userModel().config,'framework','mapcache','0'))
+    if mapcachesize > 0:
+        self.mapcache = wf_MapCache(self.logger,maxitems=mapcachesize)
+
+    # Cache for the maps made from tbl files (see readtblDefault)
+    if int(configget(self._userModel().config,'framework','tblcache','0')):
+        self.tblcachedir = os.path.join(caseName,configget(self._userModel().config,'framework','tblcachedir','tblcache'))
+        if not os.path.isdir(self.tblcachedir):
+            os.makedirs(self.tblcachedir)
+
+    # Cache for derived static maps (see wf_cachedStatic)
+    if int(configget(self._userModel().config,'framework','staticcache','0')):
+        self.staticcachedir = os.path.join(caseName,configget(self._userModel().config,'framework','staticcachedir','staticcache'))
+        if not os.path.isdir(self.staticcachedir):
+            os.makedirs(self.staticcachedir)
+
     self.ncfile = configget(self._userModel().config,'framework','netcdfinput',"None")
     self.ncoutfile = configget(self._userModel().config,'framework','netcdfoutput',"None")
 
+    # Ensemble: run this number of members (each with its own forcing and states) in one
+    # process. The static parameters are only read once. Member output goes to member_<nr>
+    # in the run directory (and the realization dimension of the netcdf output).
+    self.ensemblemembers = int(configget(self._userModel().config,'framework','ensemblemembers','0'))
+    self.ensembleinput = configget(self._userModel().config,'framework','ensembleinput',self.ensembleinput)
+    for member in range(0,self.ensemblemembers):
+        for subdir in ["outmaps","outstate","outsum"]:
+            memberdir = os.path.join(caseName,runId,"member_" + str(member),subdir)
+            if not os.path.isdir(memberdir):
+                os.makedirs(memberdir)
+
 
     # Set teh re-init hint fro the local model
     self.reinit = int(configget(self._userModel().config,'run','reinit',str(self.reinit)))
@@ -530,25 +1441,26 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
         for ms in mstacks:
             varlst.append(os.path.basename(configget(self._userModel().config,'inputmapstacks',ms,'None')))
         self.logger.debug("Found following input variables to get from netcdf file: " + str(varlst))
-        self.NcInput = netcdfinput(os.path.join(caseName,self.ncfile),self.logger,varlst)
+        maxmb = int(configget(self._userModel().config,'framework','netcdfinputmaxmb',"4000"))
+        prefetch = int(configget(self._userModel().config,'framework','netcdfprefetch',"1"))
+        if self.ensemblemembers > 0:
+            self.ensembleNcInput = [netcdfinput(os.path.join(caseName,self.ensembleinput.format(member=member),self.ncfile),
+                                                self.logger,varlst,maxmb=maxmb,prefetch=prefetch)
+                                    for member in range(0,self.ensemblemembers)]
+            self.NcInput = self.ensembleNcInput[0]
+        else:
+            self.NcInput = netcdfinput(os.path.join(caseName,self.ncfile),self.logger,varlst,maxmb=maxmb,prefetch=prefetch)
 
     if self.ncoutfile != 'None': # Ncoutput
         buffer = int(configget(self._userModel().config,'framework','netcdfwritebuffer',"50"))
         meta ={}
         meta['caseName'] = caseName
         meta['runId'] = runId
-        self.NcOutput = netcdfoutput(caseName + "/" + runId + "/" + self.ncoutfile,self.logger,self.datetime_firststep,self._d_lastTimestep - self._d_firstTimestep + 1,maxbuf=buffer,metadata=meta)
-
-    # Fill the summary (stat) list from the ini file
-    self.statslst = []
-    _type = wf_sumavg(None)
-    for sttype in _type.availtypes:
-        _maps = configsection(self._userModel().config,"summary_" + sttype)
-        for thismap in _maps:
-            thismapname = caseName + "/" + runId + "/outsum/" + self._userModel().config.get("summary_" + sttype,thismap)
-            thismap = thismap.split('self.')[1]
-            self.statslst.append(wf_sumavg(thismap,mode=sttype,filename=thismapname))
-
+        # Create all variables in the [outputmaps] section up-front
+        ncvars = [self._userModel().config.get("outputmaps",a) for a in configsection(self._userModel().config,'outputmaps')]
+        self.NcOutput = netcdfoutput(caseName + "/" + runId + "/" + self.ncoutfile,self.logger,self.datetime_firststep,
+                                     self._d_lastTimestep - self._d_firstTimestep + 1,timestepsecs=self.timestepsecs,
+                                     maxbuf=buffer,metadata=meta,vars=ncvars,members=self.ensemblemembers)
 
     # Get model parameters from model object
     if hasattr(self._userModel(),"parameters"):
@@ -579,50 +1491,144 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
             logging.error("Parameter line in ini not valid: " + aline)
 
 
-    # Now gather all the csv/tss/txt etc timeseries output objects
-    # Print .ini defined outputmaps per timestep
+    # Read the forcing mapstacks ahead in background threads (see wf_ForcingPrefetcher)
+    prefetchworkers = int(configget(self._userModel().config,'framework','prefetchworkers','0'))
+    if prefetchworkers > 0 and self.ncfile == "None":
+        # In ensemble mode the member mapstacks are added on the first read
+        self.prefetcher = wf_ForcingPrefetcher(self.logger,nrworkers=prefetchworkers,
+                                               depth=int(configget(self._userModel().config,'framework','prefetchdepth','2')),
+                                               laststep=self._d_lastTimestep)
+        stacks = [caseName + "/" + configget(self._userModel().config,'inputmapstacks',ms,'None')
+                  for ms in configsection(self._userModel().config,"inputmapstacks")]
+        stacks = stacks + [os.path.join(caseName,par.stack) for par in self.modelparameters if par.type == 'timeseries']
+        for stack in stacks:
+            if self.ensemblemembers == 0 and self._getbinstack(stack) is None:
+                self.prefetcher.register(os.path.normpath(stack),self._d_firstTimestep)
+
+    # Now gather all the output (maps, csv/tss timeseries and summaries) in one plan
+    self._compileOutputPlan(caseName,runId)
+
+    # Each member has its own summary statistics
+    self.ensemblestats = [[wf_sumavg(stat.varname,mode=stat.mode,filename=self._memberpath(stat.filename,member),params=stat.params)
+                           for stat in self.statslst] for member in range(0,self.ensemblemembers)]
+
+
+  def _outputGetter(self,expression):
+      """
+      Returns a function that gets the value of an ini file output expression
+      (e.g. self.TSoil) from the usermodel. Plain attributes are resolved with
+      attrgetter, anything else is compiled once and evaluated against the model.
+      """
+      attrname = expression.strip().replace('self.','',1)
+      if re.match("^[A-Za-z_][A-Za-z0-9_]*$",attrname):
+          return operator.attrgetter(attrname)
+      else:
+          code = compile(expression.strip(),'<ini: ' + expression + '>','eval')
+          return lambda model: eval(code,globals(),{'self': model})
+
+
+  def _compileOutputPlan(self,caseName,runId):
+      """
+      Reads the [outputmaps], [outputcsv_N], [outputtss_N] and [summary_*] sections
+      once and stores the resolved getters, target paths and writer objects. The
+      dynamic loop only walks these lists and does not read the config anymore.
+
+      - self.mapoutputplan: list of OutputItem (getter, path, name) for [outputmaps]
+      - self.tssoutputplan: list of OutputItem (getter, path, writer) for csv/tss output
+      - self.tssoutputgroups: the same items grouped per writer (sample map)
+      - self.statslst: list of wf_sumavg objects for the summary_* sections
+      """
+      config = self._userModel().config
+
+      self.mapoutputplan = []
+      for a in configsection(config,'outputmaps'):
+          path = self._userModel().Dir + "/" + runId + "/outmaps/" + config.get("outputmaps",a)
+          self.mapoutputplan.append(self.OutputItem(name=a,getter=self._outputGetter(a),path=path,writer=None))
+
+      # Fill the summary (stat) list from the ini file
+      self.statslst = []
+      _type = wf_sumavg(None)
+      for sttype in _type.availtypes:
+          _maps = configsection(config,"summary_" + sttype)
+          for thismap in _maps:
+              # value: mapname[,param[,param...]] e.g. Qover100.map,100 for summary_count
+              value = config.get("summary_" + sttype,thismap).split(',')
+              thismapname = caseName + "/" + runId + "/outsum/" + value[0].strip()
+              params = [float(p) for p in value[1:]]
+              thismap = thismap.split('self.')[1]
+              self.statslst.append(wf_sumavg(thismap,mode=sttype,filename=thismapname,params=params))
+
+      # Now gather all the csv/tss/txt etc timeseries output objects
+      checktss = configsection(config,"outputtss")
+      if len(checktss) > 0:
+          self.logger.warn("Found a outputtss section. This is NOT used anymore in this version. Please use outputtss_0 .. n")
+
+      # Number of steps (and max number of seconds) to keep timeseries output in memory
+      tssbuffer = int(configget(config,'framework','tsswritebuffer',"1"))
+      tssflushinterval = float(configget(config,'framework','tssflushinterval',"0"))
+
+      self.oscv = {}
+      self.tssoutputplan = []
+      for tsformat in ['csv','tss']:
+          secnr = 0
+          toprint = [None]
+
+          while len(toprint) > 0:
+              thissection = "output" + tsformat +"_" + str(secnr)
+              toprint = configsection(config,thissection)
+              secnr = secnr + 1
+              samplemapname = caseName + "/" + configget(config,thissection,"samplemap","None")
+              if "None" not in samplemapname :
+                  idd = tsformat + ":" +samplemapname
+                  try:
+                      self.samplemap = readmap(samplemapname)
+                      self.oscv[idd] =wf_OutputTimeSeriesArea(self.samplemap,oformat=tsformat,bufsteps=tssbuffer,
+                                                              flushinterval=tssflushinterval)
+                      self.logger.info("Adding " + tsformat + " output at "+ samplemapname)
+                  except:
+                      self.logger.warn("Could not read sample id-map for timeseries: " + samplemapname)
+                      continue
+
+                  for a in toprint:
+                    if  "samplemap" not in a:
+                        fn = os.path.join(caseName,runId,config.get(thissection,a))
+                        self.tssoutputplan.append(self.OutputItem(name=a,getter=self._outputGetter(a),path=fn,writer=self.oscv[idd]))
+
+      # Group the timeseries per sample map so each area is aggregated in one pass
+      self.tssoutputgroups = []
+      for item in self.tssoutputplan:
+          for writer, items in self.tssoutputgroups:
+              if writer is item.writer:
+                  items.append(item)
+                  break
+          else:
+              self.tssoutputgroups.append((item.writer,[item]))
 
-    checktss = configsection(self._userModel().config,"outputtss")
-    if len(checktss) > 0:
-        self.logger.warn("Found a outputtss section. This is NOT used anymore in this version. Please use outputtss_0 .. n")
-        
-    self.oscv = {}
-    self.samplenamecsv = {}
-    self.varnamecsv = {}
-    for tsformat in ['csv','tss']:
-        secnr = 0
-        toprint = [None]
-
-        while len(toprint) > 0:
-            thissection = "output" + tsformat +"_" + str(secnr)
-            toprint = configsection(self._userModel().config,thissection)
-            secnr = secnr + 1
-            samplemapname = caseName + "/" + configget(self._userModel().config,thissection,"samplemap","None")
-            if "None" not in samplemapname :    
-                try:
-                    self.samplemap = readmap(samplemapname)
-                    idd = tsformat + ":" +samplemapname
-                    self.oscv[idd] =wf_OutputTimeSeriesArea(self.samplemap,oformat=tsformat)
-                    self.logger.info("Adding " + tsformat + " output at "+ samplemapname)
-                except:
-                    self.logger.warn("Could not read sample id-map for timeseries: " + samplemapname)
-                
-                for a in toprint:
-                  if  "samplemap" not in a:
-                      b = a.replace('self','self._userModel()')         
-                      fn = os.path.join(caseName,runId,self._userModel().config.get(thissection,a))
-                      self.samplenamecsv[fn] = idd
-                      self.varnamecsv[fn] = b
-                                       
 
-  
   def wf_suspend(self, directory):
       """
-      Suspend the state variables to disk as .map files
+      Suspend the state variables to disk as .map files (lists of maps and 3-D numpy
+      arrays are saved as one map per item/layer using a _? postfix)
       Also saves the summary maps
       
       """
+      # Save the states of each ensemble member to its own directory
+      if self.ensemblemembers > 0 and not self._ensemblesuspend:
+          self._ensemblesuspend = True
+          for member in range(0,self.ensemblemembers):
+              self.wf_setEnsembleMember(member)
+              memberdir = self._memberpath(directory)
+              if not os.path.isdir(memberdir):
+                  os.makedirs(memberdir)
+              self.wf_suspend(memberdir)
+          self._ensemblesuspend = False
+          return
+
       allvars = self._userModel().stateVariables()
+
+      if self.stateformat == 'npz':
+          allvars = []
+          self.wf_savecheckpoint(os.path.join(directory,checkpointname))
       
       for var in allvars:
           try:
@@ -630,6 +1636,12 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
               execstr = "savevar = self._userModel()." + var
               exec execstr
 
+              if isinstance(savevar,numpy.ndarray) and savevar.ndim == 3: # layers of a state as numpy array
+                  for a, z in enumerate(savevar):
+                      fname = os.path.join(directory,var + "_" + str(a)).replace("\\","/") + ".map"
+                      report(numpy2pcr(Scalar,numpy.ascontiguousarray(z),checkpointmv),fname)
+                  continue
+
               try: # Check if we have a list of maps
                   b = len(savevar)
                   a = 0
@@ -647,18 +1659,26 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
       # Save the summary maps
       self.wf_savesummarymaps()
 
+      # Make sure all queued output maps and the buffered timeseries are on disk as well
+      if self.mapwriter is not None:
+          self.mapwriter.flush()
+      for ofile_list in self.oscv:
+          self.oscv[ofile_list].flush()
+
 
 
   def wf_saveTimeSeries(self):
       """
       Print .ini defined output csv/tss timeseries per timestep
       """
-      for a in self.samplenamecsv:
-          exec "tmpvar = " +  self.varnamecsv[a]
+      if len(self.tssoutputplan) == 0:
+          return
 
-          duration = self.currentdatetime - self.datetime_firststep
-          timestep = int(duration.total_seconds()/self.timestepsecs) + 1
-          self.oscv[self.samplenamecsv[a]].writestep(tmpvar,a,timestep=timestep)
+      duration = self.currentdatetime - self.datetime_firststep
+      timestep = int(duration.total_seconds()/self.timestepsecs) + 1
+      for writer, items in self.tssoutputgroups:
+          variables = [item.getter(self._userModel()) for item in items]
+          writer.writesteps(variables,[self._memberpath(item.path) for item in items],timestep=timestep)
 
    
 
@@ -670,6 +1690,10 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
       [summary_avg] # average of maps over the model run
       [summary_max] # max of maps over the model run
       [summary_min] # min of maps over the model run
+      [summary_var], [summary_std] # variance/standard deviation over the model run
+      [summary_count] # number of timesteps above a threshold
+      [summary_timeofmax] # timestep of the maximum
+      [summary_perc] # (approximate) percentile over the model run
       """
 
       toprint = configsection(self._userModel().config,'summary')
@@ -677,7 +1701,7 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
           b = a.replace('self.','')
           try:
               pcrmap = getattr(self._userModel(),b)
-              report( pcrmap , os.path.join(self._userModel().Dir, self._userModel().runId, "outsum", self._userModel().config.get("summary",a)) )
+              report( pcrmap , self._memberpath(os.path.join(self._userModel().Dir, self._userModel().runId, "outsum", self._userModel().config.get("summary",a))) )
           except:
               self._userModel().logger.warn("Could not find or save the configured summary map:"  + a)
 
@@ -686,7 +1710,7 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
           for a in self._userModel().default_summarymaps():
               b = a.replace('self.','')
               pcrmap = getattr(self._userModel(),b)
-              report( pcrmap , os.path.join(self._userModel().Dir, self._userModel().runId, "outsum", b + ".map" ))
+              report( pcrmap , self._memberpath(os.path.join(self._userModel().Dir, self._userModel().runId, "outsum", b + ".map" )))
 
       # These are the ones in the _sum _average etc sections
       for a in range(0,len(self.statslst)):
@@ -705,28 +1729,29 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
 
   def wf_savedynMaps(self):
       """
-      Save the maps defined in the ini file for the dynamic section
-      
-      .. todo::
-          
-          Save maps to be used in memory at startup and do not call the ini file each time
-          
+      Save the maps defined in the ini file for the dynamic section. The list of maps
+      is compiled once in createRunId (see _compileOutputPlan)
       """
-      # Print .ini defined outputmaps per timestep
-      toprint = configsection(self._userModel().config,'outputmaps')
-      for a in toprint:
-          if hasattr(self._userModel(),a.replace('self.','')):
-              thevar = getattr(self._userModel(),a.replace('self.',''))
-              self._reportNew(thevar,self._userModel().Dir + "/" + self._userModel().runId + "/outmaps/" +  self._userModel().config.get("outputmaps",a),longname=a)
+      for item in self.mapoutputplan:
+          try:
+              thevar = item.getter(self._userModel())
+          except AttributeError:
+              continue
+          self._reportNew(thevar,self._memberpath(item.path),longname=item.name)
 
       
   def wf_resume(self, directory):
       """
       Resumes the state variables from disk as .map files (or arrays of maps files using
-      a _? postfix)
+      a _? postfix). With stateformat=npz the states are read from the checkpoint
+      file (see wf_savecheckpoint) if the directory holds one.
       
       """
       allvars = self._userModel().stateVariables()
+
+      if self.stateformat == 'npz' and os.path.exists(os.path.join(directory,checkpointname)):
+          self.wf_loadcheckpoint(os.path.join(directory,checkpointname))
+          allvars = []
       
       for var in allvars:
           # First try to read a stack of state files
@@ -760,15 +1785,11 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
       it uses the wf_supplyVariableNamesAndRoles() function to find them.
       The variables are inserted into the model object
       This function is normally called as part of the run. Normally there is
-      no need to call it directly.
+      no need to call it directly. States that are lists or numpy arrays are
+      copied as the models may change them in place in the next timestep.
       """
-      allvars = self._userModel().stateVariables()
-      
-      for var in allvars:
-          try:
-              exec "self._userModel()." + var + "_laststep = self._userModel()." +  var
-          except:
-              self.logger.warn("Problem saving state variable: " + var)
+      for var, value in self._copystates(self._getstates()).iteritems():
+          setattr(self._userModel(),var + "_laststep",value)
 
               
               
@@ -781,11 +1802,330 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
      
       """
       allvars = self._userModel().stateVariables()
-      
-      for var in allvars:
-          exec "self._userModel()." + var + " = self._userModel()." +  var + "_laststep"
+      laststep = dict([(var, getattr(self._userModel(),var + "_laststep")) for var in allvars])
+
+      for var, value in self._copystates(laststep).iteritems():
+          setattr(self._userModel(),var,value)
   
     
+  def _getstates(self):
+      """
+      Returns a dictionary with the current value of all state variables
+      """
+      states = {}
+      for var in self._userModel().stateVariables():
+          if hasattr(self._userModel(),var):
+              states[var] = getattr(self._userModel(),var)
+          else:
+              self.logger.warn("Problem saving state variable: " + var)
+
+      return states
+
+
+  def _copystates(self,states):
+      """
+      Returns a copy of a states dictionary (see _getstates). Maps are not
+      copied as pcraster maps are never changed in place by the models, lists and
+      numpy arrays are.
+      """
+      copied = {}
+      for var, value in states.iteritems():
+          if isinstance(value,list):
+              copied[var] = list(value)
+          elif isinstance(value,numpy.ndarray):
+              copied[var] = value.copy()
+          else:
+              copied[var] = value
+
+      return copied
+
+
+  def wf_savecheckpoint(self,fname):
+      """
+      Saves all state variables (see stateVariables()) and the current model time
+      in a single compressed file. Lists of maps and single values are supported.
+
+      Input:
+          - fname - name of the checkpoint file (.npz)
+      """
+      arrays = {}
+      meta = {'timestep': self._userModel().currentTimeStep(),
+              'datetime': self.currentdatetime.strftime("%Y-%m-%d %H:%M:%S"),
+              'vars': {}}
+
+      for var, value in self._getstates().iteritems():
+          if hasattr(value,'isSpatial'):
+              arrays[var] = pcr2numpy(value,checkpointmv)
+              meta['vars'][var] = {'kind': 'map', 'valuescale': checkpointvaluescale(value)}
+          elif isinstance(value,list):
+              for nr, z in enumerate(value):
+                  arrays[var + "_" + str(nr)] = pcr2numpy(z,checkpointmv)
+              meta['vars'][var] = {'kind': 'list', 'n': len(value),
+                                   'valuescale': [checkpointvaluescale(z) for z in value]}
+          else:
+              arrays[var] = numpy.array(value)
+              meta['vars'][var] = {'kind': 'value'}
+
+      arrays['__meta__'] = numpy.array(json.dumps(meta))
+      fp = open(fname,'wb')
+      numpy.savez_compressed(fp,**arrays)
+      fp.close()
+      self.logger.info("Saved checkpoint: " + fname + " (timestep " + str(meta['timestep']) + ")")
+
+
+  def wf_loadcheckpoint(self,fname):
+      """
+      Reads the state variables from a checkpoint file made with wf_savecheckpoint
+
+      Input:
+          - fname - name of the checkpoint file (.npz)
+
+      Output:
+          - timestep and datetime (as string) at which the checkpoint was saved
+      """
+      data = numpy.load(fname)
+      meta = json.loads(str(data['__meta__']))
+
+      for var, info in meta['vars'].iteritems():
+          if info['kind'] == 'map':
+              value = numpy2pcr(checkpointvaluescales[info['valuescale']],data[var],checkpointmv)
+          elif info['kind'] == 'list':
+              value = [numpy2pcr(checkpointvaluescales[info['valuescale'][nr]],data[var + "_" + str(nr)],checkpointmv)
+                       for nr in range(0,info['n'])]
+          else:
+              value = data[var].item() if data[var].ndim == 0 else data[var].copy()
+          setattr(self._userModel(),var,value)
+      data.close()
+
+      self.logger.info("Read checkpoint: " + fname + " (timestep " + str(meta['timestep']) + ")")
+      return meta['timestep'], meta['datetime']
+
+
+  def wf_snapshot(self):
+      """
+      Keep the current state variables (and time) in the in-memory ring of
+      snapshots. The oldest snapshot is dropped if the ring is full.
+      """
+      if self.snapshots is not None:
+          states = self._copystates(self._getstates())
+          snap = self.Snapshot(step=self._userModel().currentTimeStep(),datetime=self.currentdatetime,
+                               states=states)
+          self.snapshots.append(snap)
+
+
+  def wf_supplySnapshotSteps(self):
+      """
+      :return: list of the timesteps of the snapshots in memory (oldest first)
+      """
+      if self.snapshots is None:
+          return []
+
+      return [snap.step for snap in self.snapshots]
+
+
+  def wf_rollback(self,step=None):
+      """
+      Restores the state variables from the in-memory snapshot ring. The snapshots
+      taken after the restored one are dropped.
+
+      Input:
+          - step - timestep of the snapshot to restore (default: the last snapshot)
+
+      Output:
+          - the timestep of the restored snapshot (the run should continue at step + 1) or
+            None if no matching snapshot is present
+      """
+      if self.snapshots is None or len(self.snapshots) == 0:
+          self.logger.warn("No snapshots in memory, cannot roll back")
+          return None
+
+      steps = self.wf_supplySnapshotSteps()
+      if step is None:
+          step = steps[-1]
+      if step not in steps:
+          self.logger.warn("No snapshot in memory for timestep " + str(step) + " (available: " + str(steps) + ")")
+          return None
+
+      while self.snapshots[-1].step != step:
+          self.snapshots.pop()
+
+      snap = self.snapshots[-1]
+      # give the model a copy, in place changes of lists and arrays would change the snapshot
+      for var, value in self._copystates(snap.states).iteritems():
+          setattr(self._userModel(),var,value)
+
+      self.currentdatetime = snap.datetime + dt.timedelta(seconds=self._userModel().timestepsecs)
+      self._userModel().currentdatetime = self.currentdatetime
+      self.logger.info("Rolled back model states to timestep " + str(step))
+
+      return step
+
+
+  def _memberpath(self,path,member=None):
+      """
+      Returns the path of an output file (below the run directory) for an ensemble
+      member: case/runId/x/y becomes case/runId/member_<nr>/x/y. Without ensemble
+      members the path is returned unchanged.
+      """
+      if member is None:
+          member = self.ensemblemember
+      if member is None:
+          return path
+
+      rundir = os.path.abspath(os.path.join(self._userModel().Dir,self._userModel().runId))
+      rel = os.path.relpath(os.path.abspath(path),rundir)
+      if rel.startswith(".."):
+          return path
+
+      return os.path.join(rundir,"member_" + str(member),rel)
+
+
+  def _memberinput(self,name):
+      """
+      Returns the name of an input mapstack (below the case directory) for the
+      current ensemble member using the ensembleinput pattern of the framework
+      section: case/inmaps/P becomes e.g. case/ensemble/member_3/inmaps/P (see
+      _redirectinput)
+      """
+      return self._redirectinput(name,self.ensembleinput.format(member=self.ensemblemember))
+
+
+  def _redirectinput(self,name,inputdir):
+      """
+      Returns the name of an input mapstack (below the case directory) in another
+      input directory (relative to the case): case/inmaps/P becomes
+      case/inputdir/inmaps/P. If inputdir has no maps (or binary mapstack) of the
+      mapstack, the mapstack of the case is used (e.g. temperature that is the same
+      for all ensemble members or scenarios).
+      """
+      casedir = os.path.abspath(self._userModel().caseName)
+      rel = os.path.relpath(os.path.abspath(name),casedir)
+      if rel.startswith(".."):
+          return name
+
+      key = (inputdir,name)
+      if key not in self.redirectedinputs:
+          newname = os.path.join(casedir,inputdir,rel)
+          if len(mapstackfiles(newname)) > 0 or os.path.isfile(newname + binstackextension) or os.path.isfile(newname + ".map"):
+              self.redirectedinputs[key] = newname
+          else:
+              self.logger.warn("No mapstack " + newname + ", using " + name)
+              self.redirectedinputs[key] = name
+
+      return self.redirectedinputs[key]
+
+
+  def _initEnsemble(self):
+      """
+      Gives each ensemble member its own copy of the current (resumed) states. If
+      the input directory of a member has an instate directory the states of
+      that member are read from there.
+      """
+      states = self._getstates()
+      self.ensemblestates = []
+      for member in range(0,self.ensemblemembers):
+          instate = os.path.join(self._userModel().caseName,self.ensembleinput.format(member=member),"instate")
+          if os.path.isdir(instate) and not self.reinit:
+              self.wf_resume(instate)
+              self.ensemblestates.append(self._getstates())
+              for var, value in states.iteritems():
+                  setattr(self._userModel(),var,value)
+              self.logger.info("Read states of ensemble member " + str(member) + " from " + instate)
+          else:
+              self.ensemblestates.append(self._copystates(states))
+
+      self.ensemblemember = None
+      self.logger.info("Running " + str(self.ensemblemembers) + " ensemble members")
+
+
+  def wf_setEnsembleMember(self,member):
+      """
+      Makes an ensemble member the current one: the states of the current member
+      are stored and those of the new member are put in the model. Forcing, output
+      and summary statistics go to the member from here on.
+
+      Besides the state variables all model variables that are set in dynamic()
+      (e.g. cumulative fluxes) are kept per member. These are found by comparing the
+      model before and after the first step of member 0 (see _findEnsembleVars).
+
+      Input:
+          - member - number of the member (0 .. ensemblemembers - 1)
+      """
+      if len(self.ensemblestates) == 0:
+          self._initEnsemble()
+      if self.ensemblemember is not None:
+          if self.ensemblevars is None:
+              self._findEnsembleVars()
+          self.ensemblestates[self.ensemblemember] = self._getmemberstates()
+
+      # variables the member has not made yet are made by its own dynamic()
+      for var in self.ensemblevars if self.ensemblevars is not None else []:
+          if var not in self.ensemblestates[member] and hasattr(self._userModel(),var):
+              delattr(self._userModel(),var)
+      for var, value in self.ensemblestates[member].iteritems():
+          setattr(self._userModel(),var,value)
+      if self.ensemblevars is None:
+          self._ensemblestart = self._modelattributes()
+          self._ensemblestartcopy = self._copystates(self._ensemblestart)
+      self.ensemblemember = member
+      self.statslst = self.ensemblestats[member]
+      if len(self.ensembleNcInput) > 0:
+          self.NcInput = self.ensembleNcInput[member]
+
+
+  def _modelattributes(self):
+      """
+      Returns a dictionary with the (public) attributes of the model
+      """
+      return dict([(var, value) for var, value in self._userModel().__dict__.iteritems() if not var.startswith('_')])
+
+
+  def _findEnsembleVars(self):
+      """
+      Determines the variables that are kept per ensemble member: the state variables
+      and the model attributes that were added, replaced or changed in place by the
+      first step of the current member. The other members start from a copy of the
+      values these variables had before that step.
+      """
+      start = self._ensemblestart
+      startcopy = self._ensemblestartcopy
+      changed = []
+      for var, value in self._modelattributes().iteritems():
+          if var not in start or value is not start[var]:
+              changed.append(var)
+          elif isinstance(value,numpy.ndarray):
+              if not numpy.array_equal(value,startcopy[var]):
+                  changed.append(var)
+          elif isinstance(value,list):
+              if len(value) != len(startcopy[var]) or any([a is not b for a, b in zip(value,startcopy[var])]):
+                  changed.append(var)
+
+      for member, states in enumerate(self.ensemblestates):
+          if member == self.ensemblemember:
+              continue
+          for var in changed:
+              if var not in states and var in startcopy:
+                  states[var] = self._copystates({var: startcopy[var]})[var]
+
+      self.ensemblevars = sorted(set(self._userModel().stateVariables()) | set(changed))
+      del self._ensemblestart
+      del self._ensemblestartcopy
+      self.logger.info("Variables kept per ensemble member: " + str(self.ensemblevars))
+
+
+  def _getmemberstates(self):
+      """
+      Returns a dictionary with the current value of the variables that are kept per
+      ensemble member (see _findEnsembleVars)
+      """
+      states = self._getstates()
+      for var in self.ensemblevars:
+          if var not in states and hasattr(self._userModel(),var):
+              states[var] = getattr(self._userModel(),var)
+
+      return states
+
+
   def iniFileSetUp(self,caseName,runId,configfile):
     """
     Reads .ini file and returns a config object. 
@@ -1480,19 +2820,32 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
       #TODO: Check why the timestep setting doesn not work.....
       self._userModel()._setCurrentTimeStep(step)
 
+      timer = self.phasetimer
+      members = range(0,self.ensemblemembers) if self.ensemblemembers > 0 else [None]
       if hasattr(self._userModel(), 'dynamic'):
-        self._incrementIndentLevel()
-        self._traceIn("dynamic")
-        self._userModel().dynamic()
-        self._traceOut("dynamic")
-        self._decrementIndentLevel()
-        # Save state variables in memory
-        self.wf_QuickSuspend()
-        self.wf_savedynMaps()
-        self.wf_saveTimeSeries()
-        for a in range(0,len(self.statslst)):
-            data = getattr(self._userModel(),self.statslst[a].varname)
-            self.statslst[a].add_one(data)
+        for member in members:
+          if member is not None:
+              self.wf_setEnsembleMember(member)
+          if timer: wall, cpu = timer.now()
+          self._incrementIndentLevel()
+          self._traceIn("dynamic")
+          self._userModel().dynamic()
+          self._traceOut("dynamic")
+          self._decrementIndentLevel()
+          if timer: wall, cpu = timer.add('dynamic',wall,cpu)
+          # Save state variables in memory
+          self.wf_QuickSuspend()
+          if timer: wall, cpu = timer.add('quicksuspend',wall,cpu)
+          if self.snapshots is not None and step % self.snapshotinterval == 0 and member is None:
+              self.wf_snapshot()
+              if timer: wall, cpu = timer.add('snapshot',wall,cpu)
+          self.wf_savedynMaps()
+          if timer: wall, cpu = timer.add('savedynmaps',wall,cpu)
+          self.wf_saveTimeSeries()
+          if timer: wall, cpu = timer.add('savetimeseries',wall,cpu)
+          for stat in self.statslst:
+              stat.add_one(stat.getter(self._userModel()),step)
+          if timer: wall, cpu = timer.add('stats',wall,cpu)
 
 
       self.currentdatetime = self.currentdatetime + dt.timedelta(seconds=self._userModel().timestepsecs)
@@ -1501,6 +2854,7 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
 
       self._timeStepFinished()
       self._decrementIndentLevel()
+      if timer: timer.endstep(step)
       step += 1
 
    
@@ -1581,7 +2935,10 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
 
     path = os.path.join(directoryPrefix, newName)
 
-    
+    if self.mapwriter is not None and not hasattr(self,'NcOutput'):
+        if self.mapwriter.put(variable,path,self.outputFormat,gzipit=gzipit):
+            return
+
     if self.outputFormat == 1:
         if sys.version_info[0] == 2 and sys.version_info[1] >=6:
             try:
@@ -1593,7 +2950,7 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
         if not hasattr(self,'NcOutput'):
             PCRaster.report(variable, path)
         else:
-            self.NcOutput.savetimestep( self._userModel().currentTimeStep(),variable,var=name,name=longname)
+            self.NcOutput.savetimestep( self._userModel().currentTimeStep(),variable,var=name,name=longname,member=self.ensemblemember)
         if gzipit:
             Gzip(path,storePath=True)
     elif self.outputFormat == 2:
@@ -1604,6 +2961,17 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
         numpy.savetxt(path,pcr2numpy(variable,-999),fmt="%0.6g")
     
 
+  def _readmapCached(self,path):
+      """
+      Reads a map that does not change during the run (climatology, static maps), from
+      the map cache if mapcache is set in the framework section
+      """
+      if self.mapcache is None:
+          return readmap(path)
+
+      return self.mapcache.readmap(path)
+
+
   def wf_readmapClimatology(self,name,kind=1,default=0.0,verbose=1):
       """
       Read a climatology map. The current date/time is converted to:
@@ -1621,7 +2989,7 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
           newName = generateNameT(name, month)
           path = os.path.join(directoryPrefix, newName)
           if os.path.isfile(path):
-            mapje=readmap(path)
+            mapje=self._readmapCached(path)
             return mapje
           else:
             if verbose:
@@ -1633,7 +3001,7 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
           newName = generateNameT(name, yday)
           path = os.path.join(directoryPrefix, newName)
           if os.path.isfile(path):
-            mapje=readmap(path)
+            mapje=self._readmapCached(path)
             return mapje
           else:
             if verbose:
@@ -1648,19 +3016,20 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
 
     
     
-  def wf_readmap(self, name, default,verbose=True,filetype='PCRaster'):
+  def wf_readmap(self, name, default,verbose=True,filetype='PCRaster',style=None):
     """
       Adjusted version of readmapNew. the style variable is used to indicated
       how the data is read::
           
-          1 - default: reads pcrmaps
+          1 - default: reads pcrmaps (or a binary mapstack name.wfbs if present)
           2 - memory: assumes the map is made available (in memory) using
           the in-memory interface
           
       .. note:
           
           the style variable is set using the variable list from the API
-          section in the ini file
+          section in the ini file, unless it is given as argument (e.g. style=1
+          to read the forcing on disk of a variable that is set by the API)
           
     """
     directoryPrefix = ""
@@ -1668,13 +3037,19 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
     newName = ""
     
     varname = os.path.basename(name)        
+
+    if self.inputdir is not None:
+        name = self._redirectinput(name,self.inputdir)
+    if self.ensemblemember is not None:
+        name = self._memberinput(name)
     
     # find if this is an exchnageitem   
     thevars = self.exchnageitems.getvars()
     if size(thevars) == 0:
         self.wf_supplyVariableNamesAndRoles()
     
-    style = self.exchnageitems.getvarStyle(varname)
+    if style is None:
+        style = self.exchnageitems.getvarStyle(varname)
 
     if hasattr(self._userModel(), "_inStochastic"):
       if self._userModel()._inStochastic():
@@ -1704,6 +3079,17 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
             retval =  self.NcInput.gettimestep(self._userModel().currentTimeStep() ,self.logger,var=varname)
             return retval
 
+        if self._userModel()._inDynamic():
+            binstack = self._getbinstack(name)
+            if binstack is not None:
+                data = binstack.gettimestep(self._userModel().currentTimeStep())
+                if data is not None:
+                    return numpy2pcr(Scalar, data, binstack.mv)
+            if self.prefetcher is not None and directoryPrefix == "":
+                prefetched = self.prefetcher.get(os.path.normpath(name),timestep)
+                if prefetched is not None:
+                    return numpy2pcr(Scalar, prefetched[0], prefetched[1])
+
         if os.path.isfile(path):
             mapje=readmap(path)
             return mapje
@@ -1728,6 +3114,28 @@ class wf_DynamicFramework(frameworkBase.FrameworkBase):
         return cover(scalar(default))
 
 
+  def _getbinstack(self,name):
+      """
+      Returns the binary mapstack (see wf_binstack) for mapstack name or None if
+      no binary version (name + .wfbs) is present. The stack is opened
+      (memory-mapped) the first time it is requested. A binary mapstack that is
+      older than one of the maps of the stack is ignored so the (changed) maps
+      are read instead.
+      """
+      if name not in self.binstacks:
+          fname = name + binstackextension
+          self.binstacks[name] = None
+          if os.path.isfile(fname):
+              binmtime = os.path.getmtime(fname)
+              stale = [f for f in mapstackfiles(name).values() if os.path.getmtime(f) > binmtime]
+              if len(stale) > 0:
+                  self.logger.warn("Ignoring " + fname + ": maps of the mapstack are newer, rerun pcr2binstack to update it")
+              else:
+                  self.binstacks[name] = binstackinput(fname,self.logger)
+
+      return self.binstacks[name]
+
+
   ## \brief testing the requirements for the dynamic framework
   #
   # To use the dynamic framework the user must implement the following methods
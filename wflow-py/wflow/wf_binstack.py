@@ -0,0 +1,143 @@
+"""
+wf_binstack
+-----------
+
+Compact binary mapstacks for wflow forcing data.
+
+A binary mapstack holds all timesteps of one variable in a single file
+(e.g. inmaps/P.wfbs for the inmaps/P mapstack). The layout is:
+
+    - header: magic string (8 bytes), rows, cols, number of steps (int32),
+      missing value (float32)
+    - time index: the framework timestep of each map (int32, nrsteps values)
+    - data: nrsteps x rows x cols float32 values
+
+All values are little-endian. The file is memory-mapped when reading so each
+timestep is a slice of the file instead of a file open and a parse. Use
+the mapstack2binstack function (or Scripts/pcr2binstack.py) to convert existing
+pcraster mapstacks.
+
+"""
+
+import os
+import glob
+import re
+import struct
+import numpy
+
+binstackextension = ".wfbs"
+binstackmagic = "WFLOWBS1"
+binstackheader = "<8siiif"
+binstackmv = 1E31
+
+
+def readbinstackheader(fname):
+    """
+    Reads the header and time index of a binary mapstack
+
+    :return: rows, cols, mv, timesteps (numpy array), offset of the data in the file
+    """
+    hsize = struct.calcsize(binstackheader)
+    fp = open(fname,'rb')
+    try:
+        magic, rows, cols, nrsteps, mv = struct.unpack(binstackheader,fp.read(hsize))
+        if magic != binstackmagic:
+            raise ValueError(fname + " is not a wflow binary mapstack")
+        timesteps = numpy.fromfile(fp,dtype='<i4',count=nrsteps)
+    finally:
+        fp.close()
+
+    return rows, cols, mv, timesteps, hsize + 4 * nrsteps
+
+
+class binstackinput():
+
+    def __init__(self,fname,logger):
+        """
+        Memory-maps a binary mapstack for reading
+
+        fname: binary mapstack file
+        logger: python logging object
+        """
+        self.fname = fname
+        self.logger = logger
+        self.rows, self.cols, self.mv, timesteps, offset = readbinstackheader(fname)
+        self.index = dict(zip(timesteps.tolist(),range(0,len(timesteps))))
+        self.data = numpy.memmap(fname,dtype='<f4',mode='r',offset=offset,shape=(len(timesteps),self.rows,self.cols))
+        logger.info("Using binary mapstack: " + fname + " (" + str(len(timesteps)) + " timesteps)")
+
+    def gettimestep(self,timestep):
+        """
+        Gets the data for a framework timestep (1-based)
+
+        :return: a (read-only) numpy view of the map or None if the timestep is not in the stack
+        """
+        pos = self.index.get(timestep)
+        if pos is None:
+            return None
+
+        return self.data[pos]
+
+
+def mapstackfiles(mapstackname):
+    """
+    Finds the maps of a pcraster mapstack (e.g. inmaps/P0000000.001 etc). In the
+    8.3 layout the name is followed by the timestep, padded with zeros to 8 - len(name)
+    digits before and 3 digits after the dot. The padding must start with a zero, so the
+    mapstack P does not include the maps of PET or of a mapstack P2 (P2000001.001). A
+    mapstack with a 6 or 7 character name is therefore limited to timestep 9999 or 999.
+
+    mapstackname: name of the mapstack without the timestep (e.g. inmaps/P)
+
+    :return: dictionary of timestep -> filename
+    """
+    prefix = os.path.basename(mapstackname)
+    nrdigits = 8 - len(prefix)
+    if nrdigits > 0:
+        pattern = re.compile(re.escape(prefix) + '0[0-9]{' + str(nrdigits - 1) + '}\\.[0-9]{3}$')
+    else:
+        pattern = re.compile(re.escape(prefix) + '\\.[0-9]{3}$')
+
+    found = {}
+    for fname in glob.glob(mapstackname + "*"):
+        name = os.path.basename(fname)
+        if pattern.match(name):
+            found[int(name[len(prefix):].replace('.',''))] = fname
+
+    return found
+
+
+def mapstack2binstack(mapstackname,binstackname,logger,first=None,last=None):
+    """
+    Converts a pcraster mapstack (e.g. inmaps/P0000000.001 etc) to a binary mapstack.
+    The clone must be set to the map dimensions before calling this function.
+
+    mapstackname: name of the mapstack without the timestep (e.g. inmaps/P)
+    binstackname: binary file to create (normally mapstackname + .wfbs)
+    logger: python logging object
+    first, last: optional range of timesteps to convert (default: all maps found)
+
+    :return: number of maps converted
+    """
+    from pcraster import readmap, pcr2numpy, scalar
+
+    found = mapstackfiles(mapstackname)
+    timesteps = sorted([ts for ts in found if (first is None or ts >= first) and (last is None or ts <= last)])
+    if len(timesteps) == 0:
+        logger.warn("No maps found for mapstack: " + mapstackname)
+        return 0
+
+    rows, cols = pcr2numpy(scalar(readmap(found[timesteps[0]])),binstackmv).shape
+    logger.info("Converting " + str(len(timesteps)) + " maps of " + mapstackname + " to " + binstackname)
+
+    fp = open(binstackname,'wb')
+    try:
+        fp.write(struct.pack(binstackheader,binstackmagic,rows,cols,len(timesteps),binstackmv))
+        numpy.array(timesteps,dtype='<i4').tofile(fp)
+        for ts in timesteps:
+            data = pcr2numpy(scalar(readmap(found[ts])),binstackmv).astype('<f4')
+            data.tofile(fp)
+    finally:
+        fp.close()
+
+    return len(timesteps)
@@ -0,0 +1,292 @@
+#!/usr/bin/python
+
+# wf_forecast is Free software, see below:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+syntax:
+    wf_forecast -C case -R runId -s scenarios.ini [-c inifile] [-M module] [-w workers] [-I]
+
+    -C case directory
+    -R runId of the base run (default: forecast_base). The initialisation writes a run
+       directory (log file, copies of the tables and ini file, empty output
+       directories) under this runId in the case
+    -s ini file with one section per scenario (relative to the case or absolute)
+    -c ini file of the model (default: wflow_sbm.ini)
+    -M model module (default: wflow.wflow_sbm)
+    -w number of scenarios to run at the same time (default: number of cpu's)
+    -I start from the default initial conditions instead of the instate directory
+
+Runs a number of forecast scenarios that all start from the same initial
+state. The model is initialised (initial and resume) once, after that each
+scenario runs in a process made with os.fork. The children share the
+memory of the initialised model copy-on-write, so the static maps, tables
+and states are only read once per forecast cycle. Only available on
+systems that have os.fork (not on windows).
+
+Each section of the scenario file is a scenario. The results are saved in
+the case directory in the runId given by the runId option (default: the
+name of the section). Other options:
+
+    inputdir = dir           read the forcing mapstacks (e.g. inmaps/P) from this
+                             directory (relative to the case) with the same layout
+                             as the case. Mapstacks that are not there are read from
+                             the case. Not used for netcdf input
+    mult_Name = factor       multiply the model variable Name with factor
+                             after the initialisation
+    section:option = value   override an option of the model ini file (e.g.
+                             run:endtime or framework:netcdfoutput). Because
+                             initial is not run again only the settings
+                             used by the framework (run times, output, modelparameters)
+                             have effect
+
+Example::
+
+    [wet]
+    inputdir = scenarios/wet
+    run:endtime = 2015-01-10 00:00:00
+
+    [dry_soil]
+    mult_FirstZoneCapacity = 0.8
+"""
+
+import getopt
+import sys
+import os
+import time
+import traceback
+import ConfigParser
+import multiprocessing
+from wflow.wflow_lib import configset
+
+
+def readscenarios(fname):
+    """
+    Reads the scenario file
+
+    :return: list of (name, dictionary with options) in the order of the file
+    """
+    config = ConfigParser.RawConfigParser()
+    config.optionxform = str
+    if not config.read(fname):
+        raise IOError("Cannot read scenario file: " + fname)
+
+    return [(section, dict(config.items(section))) for section in config.sections()]
+
+
+def writescenarioini(caseName, configfile, scenRunId, options):
+    """
+    Writes the model ini file of a scenario (the ini file of the case with the
+    section:option overrides of the scenario) to the run directory of the scenario
+
+    :return: name of the ini file relative to the case
+    """
+    config = ConfigParser.RawConfigParser()
+    config.optionxform = str
+    config.read(os.path.join(caseName, configfile))
+    for key, value in options.items():
+        if ':' in key:
+            section, option = key.split(':', 1)
+            if not config.has_section(section):
+                config.add_section(section)
+            config.set(section, option, value)
+
+    rundir = os.path.join(caseName, scenRunId)
+    if not os.path.isdir(rundir):
+        os.makedirs(rundir)
+    inifile = os.path.join(scenRunId, os.path.basename(configfile))
+    fp = open(os.path.join(caseName, inifile), 'w')
+    config.write(fp)
+    fp.close()
+
+    return inifile
+
+
+def runscenario(dynModelFw, name, options, logger):
+    """
+    Runs one scenario in the (forked) child. The model has been initialised
+    by the parent, here only the run directory, ini file, forcing and parameters of
+    the scenario are set up before running the dynamic part.
+    """
+    myModel = dynModelFw._userModel()
+    caseName = myModel.caseName
+    scenRunId = options.get('runId', name)
+
+    # The child logs to the run directory of the scenario only
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    myModel.configfile = writescenarioini(caseName, myModel.configfile, scenRunId, options)
+    myModel.runId = scenRunId
+    myModel.SaveDir = os.path.join(myModel.Dir, scenRunId)
+    if hasattr(myModel, 'SaveMapDir'):
+        myModel.SaveMapDir = os.path.join(myModel.Dir, scenRunId, "outmaps")
+    if hasattr(myModel, 'OverWriteInit'):
+        myModel.OverWriteInit = 0
+    dynModelFw.createRunId(NoOverWrite=False, logfname="wf_forecast_" + name + ".log", model=name)
+
+    if 'inputdir' in options:
+        dynModelFw.inputdir = options['inputdir']
+    for key, value in options.items():
+        if key.startswith('mult_'):
+            if not dynModelFw.wf_multParameterValues(key[5:], float(value)):
+                dynModelFw.logger.warn("Scenario " + name + ": " + key[5:] + " not found in the model")
+
+    dynModelFw.logger.info("Running scenario " + name + " in " + os.path.join(caseName, scenRunId))
+    dynModelFw._runDynamic(0, 0)
+    dynModelFw._runSuspend()
+    dynModelFw._wf_shutdown()
+
+
+def stopthreads(dynModelFw):
+    """
+    Stops the background threads of the framework (forcing prefetch, output map
+    writers, netcdf writer and prefetch). A child made with os.fork only has the
+    thread that forked, locks held by the other threads (gdal, logging, queues) at
+    that moment would stay locked forever in the child. The children start their
+    own threads in createRunId.
+    """
+    if dynModelFw.prefetcher is not None:
+        dynModelFw.prefetcher.close()
+        dynModelFw.prefetcher = None
+    if dynModelFw.mapwriter is not None:
+        dynModelFw.mapwriter.close()
+        dynModelFw.mapwriter = None
+    if hasattr(dynModelFw, 'NcOutput'):
+        dynModelFw.NcOutput.finish()
+        del dynModelFw.NcOutput
+    for ncinput in [getattr(dynModelFw, 'NcInput', None)] + list(dynModelFw.ensembleNcInput or []):
+        if ncinput is not None and ncinput.prefetcher is not None:
+            ncinput.prefetcher.join()
+            ncinput.prefetcher = None
+
+
+def forkscenario(dynModelFw, name, options, logger):
+    """
+    Forks a child that runs the scenario
+
+    :return: process id of the child
+    """
+    pid = os.fork()
+    if pid == 0:
+        ret = 0
+        try:
+            runscenario(dynModelFw, name, options, logger)
+        except Exception:
+            traceback.print_exc()
+            ret = 1
+        # Do not run the cleanup of the parent in the child
+        os._exit(ret)
+
+    return pid
+
+
+def runscenarios(dynModelFw, scenarios, nrworkers, logger):
+    """
+    Runs the scenarios with at most nrworkers children at the same time
+
+    :return: dictionary with the exit code of each scenario
+    """
+    todo = list(scenarios)
+    running = {}
+    result = {}
+    while len(todo) > 0 or len(running) > 0:
+        while len(todo) > 0 and len(running) < nrworkers:
+            name, options = todo.pop(0)
+            running[forkscenario(dynModelFw, name, options, logger)] = name
+            logger.info("Started scenario: " + name)
+        pid, status = os.wait()
+        if pid in running:
+            name = running.pop(pid)
+            result[name] = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+            logger.info("Scenario " + name + " finished with exit code " + str(result[name]))
+
+    return result
+
+
+def usage(*args):
+    sys.stdout = sys.stderr
+    for msg in args: print msg
+    print __doc__
+    sys.exit(0)
+
+
+def main(argv=None):
+    """
+    Perform command line execution of the forecast server.
+    """
+    caseName = None
+    runId = "forecast_base"
+    configfile = "wflow_sbm.ini"
+    module = "wflow.wflow_sbm"
+    scenariofile = None
+    nrworkers = multiprocessing.cpu_count()
+    reinit = False
+
+    if argv is None:
+        argv = sys.argv[1:]
+        if len(argv) == 0:
+            usage()
+            return
+
+    try:
+        opts, args = getopt.getopt(argv, 'C:R:c:M:s:w:Ih')
+    except getopt.error, msg:
+        usage(msg)
+
+    for o, a in opts:
+        if o == '-h': usage()
+        if o == '-C': caseName = a
+        if o == '-R': runId = a
+        if o == '-c': configfile = a
+        if o == '-M': module = a
+        if o == '-s': scenariofile = a
+        if o == '-w': nrworkers = int(a)
+        if o == '-I': reinit = True
+
+    if caseName is None or scenariofile is None:
+        usage("Need a case (-C) and a scenario file (-s)")
+    if not hasattr(os, 'fork'):
+        print "ERROR: wf_forecast needs os.fork, this is not available on this system"
+        sys.exit(1)
+
+    caseName = os.path.abspath(caseName)
+    scenarios = readscenarios(os.path.join(caseName, scenariofile))
+
+    wf = __import__(module, fromlist=['WflowModel'])
+    myModel = wf.WflowModel('wflow_subcatch.map', caseName, runId, configfile)
+    dynModelFw = wf.wf_DynamicFramework(myModel, 1, 1)
+    dynModelFw.createRunId(NoOverWrite=False, logfname="wf_forecast.log", model="wf_forecast")
+    logger = dynModelFw.logger
+    if reinit:
+        configset(myModel.config, 'model', 'reinit', '1', overwrite=True)
+    t0 = time.time()
+    dynModelFw._runInitial()
+    dynModelFw._runResume()
+    logger.info("Initialised the model in %.2f s, running %d scenarios with %d workers" % (time.time() - t0, len(scenarios), nrworkers))
+
+    stopthreads(dynModelFw)
+    result = runscenarios(dynModelFw, scenarios, nrworkers, logger)
+    dynModelFw._wf_shutdown()
+
+    failed = [name for name in result if result[name] != 0]
+    if len(failed) > 0:
+        print "ERROR: the following scenarios failed: " + str(failed)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,9 @@ from numpy import *
 
 import time
 import datetime as dt
+import os
+import threading
+import Queue
 
 
 import wflow.wflow_lib as wflow_lib
@@ -35,10 +38,11 @@ globmetadata['Conventions'] = 'CF-1.4'
 # 'NETCDF4', 'NETCDF4_CLASSIC', 'NETCDF3_64BIT', or 'NETCDF3_CLASSIC'
 netcdfformat = "NETCDF4"
 
-def prepare_nc(trgFile, timeList, x, y, metadata, logger, units='Days since 1900-01-01 00:00:00', calendar='gregorian',Format="NETCDF4",complevel=1,zlib=True):
+def prepare_nc(trgFile, timeList, x, y, metadata, logger, units='Days since 1900-01-01 00:00:00', calendar='gregorian',Format="NETCDF4",complevel=1,zlib=True,members=0):
     """
     This function prepares a NetCDF file with given metadata, for a certain year, daily basis data
     The function assumes a gregorian calendar and a time unit 'Days since 1900-01-01 00:00:00'
+    If members > 0 a realization dimension (ensemble members) is added as well
     """
     import datetime as dt
 
@@ -52,6 +56,13 @@ def prepare_nc(trgFile, timeList, x, y, metadata, logger, units='Days since 1900
     nc_trg.createDimension('time', 0) #NrOfDays*8
     nc_trg.createDimension('lat', len(y))
     nc_trg.createDimension('lon', len(x))
+    if members > 0:
+        nc_trg.createDimension('realization', members)
+        r_var = nc_trg.createVariable('realization','i4',('realization',))
+        r_var.standard_name = 'realization'
+        r_var.long_name = 'ensemble member'
+        r_var.axis = 'E'
+        r_var[:] = arange(0,members)
     DateHour = nc_trg.createVariable('time','f8',('time',))
     DateHour.units = units
     DateHour.calendar = calendar
@@ -87,9 +98,24 @@ def prepare_nc(trgFile, timeList, x, y, metadata, logger, units='Days since 1900
 
 class netcdfoutput():
 
-    def __init__(self,netcdffile,logger,starttime,timesteps,timestepsecs=86400,metadata={},maxbuf=25):
+    def __init__(self,netcdffile,logger,starttime,timesteps,timestepsecs=86400,metadata={},maxbuf=25,vars=[],maxqueue=4,members=0):
         """
-        Under construction
+        Write mapstacks to a single netcdf file. The file is kept open during the
+        run and full buffers are written by a background thread so the model does
+        not have to wait for compression or disk access.
+
+        netcdffile: file to write to
+        logger: python logging object
+        starttime: datetime of the first timestep
+        timesteps: number of timesteps in the run
+        timestepsecs: length of a timestep in seconds
+        metadata: dictionary with global attributes
+        maxbuf: number of timesteps to keep in memory per variable before writing
+        vars: list of variables to create up-front (others are created when first saved)
+        maxqueue: max number of full buffers waiting to be written. If the queue is full
+                  the model waits for the writer (backpressure)
+        members: number of ensemble members. If > 0 the variables get a realization
+                 dimension (time,realization,lat,lon) and each member is saved separately
         """
 
         def date_range(start, end, tdelta="days"):
@@ -105,6 +131,7 @@ class netcdfoutput():
         self.maxbuf =  maxbuf if timesteps >= maxbuf else timesteps
         self.ncfile = netcdffile
         self.timesteps = timesteps
+        self.members = members
         rows = pcraster._pcraster.clone().nrRows()
         cols = pcraster._pcraster.clone().nrCols()
         cellsize = pcraster._pcraster.clone().cellSize()
@@ -119,18 +146,82 @@ class netcdfoutput():
         else:
             timeList = date_range(starttime, end, tdelta="hours")
 
-        self.timestepbuffer = zeros((self.maxbuf,len(y),len(x)))
+        if self.members > 0:
+            self.timestepbuffer = zeros((self.maxbuf,self.members,len(y),len(x)))
+        else:
+            self.timestepbuffer = zeros((self.maxbuf,len(y),len(x)))
         self.bufflst={}
 
+        # Chunk along time with the size of the write buffer, limit chunks to about 4Mb
+        maxchunkfloats = 4 * 1048576/4
+        tchunk = maxchunkfloats/(len(y) * len(x))
+        tchunk = self.maxbuf if tchunk > self.maxbuf else tchunk
+        tchunk = 1 if tchunk < 1 else tchunk
+        self.chunksizes = (tchunk,len(y),len(x))
+        if self.members > 0:
+            self.chunksizes = (tchunk,1,len(y),len(x))
+
         globmetadata.update(metadata)
 
+        prepare_nc(self.ncfile,timeList,x,y,globmetadata,logger,Format=netcdfformat,members=self.members)
+
+        # Open the file once, all access after this point is done by the writer thread
+        self.nc_trg = netCDF4.Dataset(self.ncfile, 'a',format=netcdfformat)
+        self.nc_trg.set_fill_off()
+        for var in vars:
+            self._createvar(os.path.basename(var))
+        self.nc_trg.sync()
 
-        prepare_nc(self.ncfile,timeList,x,y,globmetadata,logger,Format=netcdfformat)
+        self.writeerror = None
+        self.writequeue = Queue.Queue(maxsize=maxqueue)
+        self.writer = threading.Thread(target=self._writer,name="netcdfwriter")
+        self.writer.daemon = True
+        self.writer.start()
 
 
-    def savetimestep(self,timestep,pcrdata,unit="mm",var='P',name="Precipitation"):
+    def _createvar(self,var,unit="mm",name=None):
         """
-        save a single timestep for a variable
+        Create a (time,lat,lon) or (time,realization,lat,lon) variable in the open file
+
+        :return: the netcdf variable
+        """
+        self.logger.debug("Creating variable " + var + " in netcdf file. Format: " + netcdfformat)
+        dims = ('time', 'realization', 'lat', 'lon',) if self.members > 0 else ('time', 'lat', 'lon',)
+        nc_var = self.nc_trg.createVariable(var, 'f4', dims, fill_value=-9999.0, zlib=True,
+                                            complevel=1,chunksizes=self.chunksizes)
+        nc_var.units = unit
+        nc_var.standard_name = var if name == None else name
+
+        return nc_var
+
+
+    def _writer(self):
+        """
+        Writer thread. Takes full buffers from the queue and writes them to the file.
+        A None in the queue stops the thread.
+        """
+        while True:
+            item = self.writequeue.get()
+            try:
+                if item is None:
+                    return
+                var, unit, name, spos, data = item
+                if var in self.nc_trg.variables:
+                    nc_var = self.nc_trg.variables[var]
+                else:
+                    nc_var = self._createvar(var,unit=unit,name=name)
+                nc_var[spos:spos + data.shape[0],...] = data
+            except Exception, e:
+                self.writeerror = e
+                self.logger.error("Error writing to netcdf file " + self.ncfile + ": " + str(e))
+            finally:
+                self.writequeue.task_done()
+
+
+    def savetimestep(self,timestep,pcrdata,unit="mm",var='P',name="Precipitation",member=None):
+        """
+        save a single timestep for a variable. With ensemble members the buffer is
+        written after the last member of the timestep has been saved.
 
         input:
             - timestep - current timestep
@@ -138,67 +229,67 @@ class netcdfoutput():
             - unit - unit string
             - var - variable string
             - name - name of the variable
+            - member - ensemble member (only if the file has a realization dimension)
         """
-        # Open target netCDF file
-        var = os.path.basename(var)
-        self.nc_trg = netCDF4.Dataset(self.ncfile, 'a',format=netcdfformat,zlib=True,complevel=1)
-        self.nc_trg.set_fill_off()
-        # read time axis and convert to time objects
-        time = self.nc_trg.variables['time']
-        timeObj = netCDF4.num2date(time[:], units=time.units, calendar=time.calendar)
+        if self.writeerror is not None:
+            raise self.writeerror
 
+        var = os.path.basename(var)
         idx = timestep -1
 
         buffreset = (idx + 1) % self.maxbuf
         bufpos = (idx) % self.maxbuf
 
-        try:
-             nc_var = self.nc_trg.variables[var]
-        except:
-            self.logger.debug("Creating variable " + var + " in netcdf file. Format: " + netcdfformat)
-            nc_var = self.nc_trg.createVariable(var, 'f4', ('time', 'lat', 'lon',), fill_value=-9999.0, zlib=True,complevel=1)
-            nc_var.units = unit
-            nc_var.standard_name = name
-            self.nc_trg.sync()
-
-        miss =  float(nc_var._FillValue)
-        data = pcr2numpy(pcrdata,miss)
+        data = pcr2numpy(pcrdata,-9999.0)
 
-        if self.bufflst.has_key(var):
-            self.bufflst[var][bufpos,:,:] =  data
-        else:
+        if not self.bufflst.has_key(var):
             self.bufflst[var] = self.timestepbuffer.copy()
+        if self.members > 0:
+            self.bufflst[var][bufpos,member,:,:] = data
+            if member != self.members - 1:
+                return
+        else:
             self.bufflst[var][bufpos,:,:] =  data
 
-        # Write out timestep buffer.....
+        # Hand the timestep buffer to the writer thread and start a new one
         if buffreset == 0 or idx ==  self.maxbuf -1 or self.timesteps <= timestep:
             spos = idx-bufpos
             self.logger.debug("Writing buffer for " + var + " to file at: " + str(spos) + " " + str(int(bufpos) + 1) + " timesteps")
-            nc_var[spos:idx+1,:,:] = self.bufflst[var][0:bufpos+1,:,:]
-            self.nc_trg.sync()
+            self.writequeue.put((var,unit,name,spos,self.bufflst[var][0:bufpos+1,...]))
+            self.bufflst[var] = self.timestepbuffer.copy()
 
 
     def finish(self):
         """
-        Flushes and closes the netcdf file
+        Waits for the writer thread to write all buffers, flushes and closes the netcdf file
 
         :return: Nothing
         """
-        if hasattr(self,"nc_trg"):
+        if hasattr(self,"writer") and self.writer.is_alive():
+            self.writequeue.put(None)
+            self.writer.join()
+        if hasattr(self,"nc_trg") and self.nc_trg is not None:
             self.nc_trg.sync()
             self.nc_trg.close()
+            self.nc_trg = None
 
 
 class netcdfinput():
 
-    def __init__(self,netcdffile,logging,vars=[]):
+    def __init__(self,netcdffile,logging,vars=[],maxmb=4000,prefetch=True):
         """
         First try to setup a class read netcdf files
         (converted with pcr2netcdf.py)
 
+        Data is read in blocks of timesteps. Only the part of the file that
+        covers the current clone map is read. If prefetch is set the next block is
+        read in a background thread while the model runs on the current block.
+
         netcdffile: file to read the forcing data from
         logging: python logging object
         vars: list of variables to get from file
+        maxmb: memory budget in Mb for all blocks in memory (current + prefetched)
+        prefetch: read the next block in the background
         """
 
         if os.path.exists(netcdffile):
@@ -208,21 +299,130 @@ class netcdfinput():
             exit(ValueError)
 
         logging.info("Reading input from netCDF file: " + netcdffile + ": " + str(self.dataset).replace('\n',' '))
+        self.logging = logging
+        self.prefetch = prefetch
         self.alldat ={}
-        a = pcr2numpy(cover(0.0),0.0).flatten()
-        # Determine steps to load in mem based on estimated memory usage
+
+        self.vars = []
+        for var in vars:
+            if var in self.dataset.variables:
+                self.vars.append(var)
+            else:
+                logging.warn("Variable " + var + " not found in netcdf file: " + netcdffile)
+
+        self.latslice, self.lonslice, self.flipud = self._clonewindow(logging)
+        nrcells = len(range(*self.latslice.indices(len(self.dataset.variables['lat'])))) * \
+                  len(range(*self.lonslice.indices(len(self.dataset.variables['lon']))))
+
+        # Determine steps to load in mem based on the memory budget. With prefetching two
+        # blocks are in memory at the same time.
         floatspermb = 1048576/4
-        maxmb = 4000
-        self.maxsteps = maxmb * len(a)/floatspermb + 1
+        nrblocks = 2 if self.prefetch else 1
+        nrvars = len(self.vars) if len(self.vars) > 0 else 1
+        self.maxsteps = maxmb * floatspermb/(nrcells * nrvars * nrblocks)
+        self.maxsteps = 1 if self.maxsteps < 1 else self.maxsteps
+
+        # Align the blocks with the chunking along the time axis of the file
+        tchunk = 1
+        for var in self.vars:
+            chunking = self.dataset.variables[var].chunking()
+            if chunking != 'contiguous' and chunking is not None:
+                tchunk = chunking[0] if chunking[0] > tchunk else tchunk
+        if self.maxsteps > tchunk:
+            self.maxsteps = (self.maxsteps/tchunk) * tchunk
+        logging.info("Reading netcdf data in blocks of " + str(self.maxsteps) + " timesteps")
+
         self.fstep = 0
         self.lstep = self.fstep + self.maxsteps
+        self.alldat = self._readblock(self.fstep)
 
-        for var in vars:
-            try:
-                self.alldat[var] = self.dataset.variables[var][self.fstep:self.maxsteps]
-            except:
-                self.alldat.pop(var, None)
-                logging.warn("Variable " + var + " not found in netcdf file: " + netcdffile)
+        self.nextdat = None
+        self.prefetcher = None
+        self._startprefetch(self.lstep)
+
+
+    def _clonewindow(self,logging):
+        """
+        Determines the part of the lat/lon grid in the file that covers the clone map
+
+        :return: latslice, lonslice, flipud (True if the rows in the file run south to north)
+        """
+        lat = self.dataset.variables['lat'][:]
+        lon = self.dataset.variables['lon'][:]
+        y = _pcrut.pcr2numpy(_pcrut.ycoordinate(_pcrut.boolean(_pcrut.cover(1.0))),NaN)[:,0]
+        x = _pcrut.pcr2numpy(_pcrut.xcoordinate(_pcrut.boolean(_pcrut.cover(1.0))),NaN)[0,:]
+        tol = absolute(x[1] - x[0]) * 0.5 if len(x) > 1 else 1E-6
+
+        latidx = nonzero((lat >= y.min() - tol) & (lat <= y.max() + tol))[0]
+        lonidx = nonzero((lon >= x.min() - tol) & (lon <= x.max() + tol))[0]
+
+        if len(latidx) == len(y) and len(lonidx) == len(x):
+            flipud = len(lat) > 1 and (lat[-1] > lat[0]) != (y[-1] > y[0])
+            logging.debug("Reading netcdf window lat: " + str(latidx[0]) + "-" + str(latidx[-1]) +
+                          " lon: " + str(lonidx[0]) + "-" + str(lonidx[-1]))
+            return slice(latidx[0],latidx[-1] + 1), slice(lonidx[0],lonidx[-1] + 1), flipud
+        else:
+            logging.warn("netcdf grid does not match the clone map, reading the full extent")
+            return slice(None), slice(None), False
+
+
+    def _readblock(self,start):
+        """
+        Reads a block of maxsteps timesteps for all variables starting at start
+
+        :return: dictionary with an array for each variable
+        """
+        block = {}
+        for var in self.vars:
+            data = self.dataset.variables[var][start:start + self.maxsteps,self.latslice,self.lonslice]
+            if self.flipud:
+                data = data[:,::-1,:]
+            block[var] = data
+
+        return block
+
+
+    def _prefetch(self,start):
+        """
+        Runs in the prefetch thread
+        """
+        try:
+            self.nextdat = self._readblock(start)
+        except Exception, e:
+            self.logging.error("Error prefetching netcdf data block at: " + str(start) + " " + str(e))
+            self.nextdat = None
+
+
+    def _startprefetch(self,start):
+        """
+        Start reading the block starting at start in the background
+        """
+        self.nextstart = start
+        if self.prefetch and start < len(self.dataset.variables['time']):
+            self.prefetcher = threading.Thread(target=self._prefetch,args=(start,),name="netcdfprefetch")
+            self.prefetcher.daemon = True
+            self.prefetcher.start()
+
+
+    def _loadblock(self,ncindex,logging):
+        """
+        Make the block starting at ncindex the current block. Uses the prefetched
+        data if available, otherwise reads synchronously.
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.join()
+            self.prefetcher = None
+
+        if self.nextdat is not None and self.nextstart == ncindex:
+            self.alldat = self.nextdat
+        else:
+            logging.debug("reading new netcdf data block starting at: " + str(ncindex))
+            self.alldat = self._readblock(ncindex)
+        self.nextdat = None
+
+        self.fstep = ncindex
+        self.lstep = ncindex + self.maxsteps
+        self._startprefetch(self.lstep)
 
 
     def gettimestep(self,timestep,logging,var='P'):
@@ -235,12 +435,8 @@ class netcdfinput():
         """
         ncindex = timestep -1
         if self.alldat.has_key(var):
-            if ncindex == self.lstep: # Read new block of data in mem
-                logging.debug("reading new netcdf data block starting at: " + str(ncindex))
-                for vars in self.alldat:
-                    self.alldat[vars] = self.dataset.variables[vars][ncindex:ncindex + self.maxsteps]
-                self.fstep = ncindex
-                self.lstep = ncindex + self.maxsteps
+            if ncindex >= self.lstep or ncindex < self.fstep: # Read new block of data in mem
+                self._loadblock(ncindex,logging)
             np_step = self.alldat[var][ncindex-self.fstep,:,:]
             return numpy2pcr(Scalar, np_step, 1E31)
         else:
@@ -0,0 +1,642 @@
+#!/usr/bin/python
+
+# wf_parallel is Free software, see below:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+syntax:
+    wf_parallel -C case -R runId [-c inifile] [-M module] [-n groups] [-w workers] [-k] [-- model options]
+
+    -C case directory
+    -R runId
+    -c ini file of the model (default: wflow_sbm.ini)
+    -M model module (default: wflow.wflow_sbm)
+    -n number of groups of subcatchments (default: number of cpu's)
+    -w number of worker processes (default: the value of -n)
+    -k keep the worker cases (case/runId/subbasins) after merging
+    -- all options after this are passed to the model (e.g. -- -T 365)
+
+    Pipelined mode (nested subcatchments, no SubCatchFlowOnly in the model itself):
+
+    -P run each subcatchment in its own worker, upstream to downstream. At most
+       -w workers compute at the same time
+    -T last timestep (if not set in the [run] section of the ini file)
+    -V variable that is passed from the outlet of a subcatchment to the downstream
+       subcatchment (default: SurfaceRunoff, m3/s)
+    -I inflow mapstack the upstream discharge is added to (default: inmaps/IF). This
+       is set to an API input (role 0) in the worker cases that have upstream
+       subcatchments. If the case already has it as API input the upstream
+       discharge is added to 0 instead of to the forcing
+
+Runs a model with SubCatchFlowOnly=1 in parallel. The subcatchments of
+staticmaps/wflow_subcatch.map are divided into groups with about the same number
+of cells. For each group a case is made in case/runId/subbasins/group_N with
+the maps in staticmaps and instate cropped to the group (cells of
+other groups are set to missing) and the maps in inmaps cropped to the same
+window. Netcdf input is read from the original file (only the window of the
+clone is read). Each group runs in a separate process. At the end
+the maps in outmaps, outsum and outstate and the csv/tss files of the
+outputcsv_N and outputtss_N sections are merged into case/runId.
+
+In pipelined mode the subcatchments drain into each other (along the ldd in
+wflow_ldd). Each subcatchment runs (with SubCatchFlowOnly) in a worker process
+that receives the discharge of the upstream subcatchments for each
+timestep through a queue, so headwater and downstream subcatchments run at
+the same time, one upstream step ahead. The upstream discharge enters the
+kinematic wave as lateral inflow at the entry cell. With Tslice=1 this gives
+the same surface water routing as a single run. Subsurface flow across the
+subcatchment boundaries is not passed on.
+"""
+
+import getopt
+import sys
+import os
+import shutil
+import subprocess
+import time
+import heapq
+import logging
+import ConfigParser
+import multiprocessing
+import numpy
+import osgeo.gdal as gdal
+import wflow.pcrut as pcrut
+from wflow.wflow_lib import lddrowoffset, lddcoloffset
+
+subcatchmap = "staticmaps/wflow_subcatch.map"
+cropdirs = ["staticmaps","instate"]
+windowdirs = ["inmaps"]
+copydirs = ["intbl","intss"]
+mergedirs = ["outmaps","outsum","outstate"]
+
+
+def readgrid(fname):
+    """
+    Reads a map with gdal
+
+    :return: data, geotransform, missing value, pcraster valuescale
+    """
+    ds = gdal.Open(fname)
+    band = ds.GetRasterBand(1)
+    data = band.ReadAsArray()
+    ret = data, ds.GetGeoTransform(), band.GetNoDataValue(), band.GetMetadataItem('PCRASTER_VALUESCALE')
+    ds = None
+    return ret
+
+
+def writegrid(fname,data,geotransform,mv,valuescale):
+    """
+    Writes a numpy array to a pcraster map
+    """
+    gdaltypes = {'uint8': gdal.GDT_Byte, 'int32': gdal.GDT_Int32, 'float32': gdal.GDT_Float32, 'float64': gdal.GDT_Float64}
+    memds = gdal.GetDriverByName('MEM').Create('',data.shape[1],data.shape[0],1,gdaltypes.get(str(data.dtype),gdal.GDT_Float32))
+    memds.SetGeoTransform(geotransform)
+    band = memds.GetRasterBand(1)
+    if mv is not None:
+        band.SetNoDataValue(mv)
+    band.WriteArray(data)
+    options = ['PCRASTER_VALUESCALE=' + valuescale] if valuescale else []
+    outds = gdal.GetDriverByName('PCRaster').CreateCopy(fname,memds,0,options)
+    outds = None
+    memds = None
+
+
+def ismap(fname):
+    """
+    :return: True if fname is a pcraster map
+    """
+    gdal.PushErrorHandler('CPLQuietErrorHandler')
+    try:
+        ds = gdal.Open(fname)
+        ret = ds is not None and ds.GetDriver().ShortName == 'PCRaster'
+        ds = None
+    finally:
+        gdal.PopErrorHandler()
+    return ret
+
+
+def partition(subcatch,mv,nrgroups):
+    """
+    Divides the subcatchments in groups with about the same number of cells (largest
+    subcatchment first, to the group with the lowest number of cells)
+
+    :return: list of lists of subcatchment ids
+    """
+    ids, counts = numpy.unique(subcatch[subcatch != mv],return_counts=True)
+    nrgroups = nrgroups if nrgroups < len(ids) else len(ids)
+    heap = [(0,grp) for grp in range(0,nrgroups)]
+    groups = [[] for grp in range(0,nrgroups)]
+    for pos in numpy.argsort(-counts,kind='mergesort'):
+        cells, grp = heapq.heappop(heap)
+        groups[grp].append(ids[pos])
+        heapq.heappush(heap,(cells + counts[pos],grp))
+
+    return groups
+
+
+def groupwindow(mask):
+    """
+    :return: first row, last row + 1, first col, last col + 1 of the True cells in mask
+    """
+    rows = numpy.flatnonzero(mask.any(axis=1))
+    cols = numpy.flatnonzero(mask.any(axis=0))
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+
+def windowgeotransform(geotransform,window):
+    return (geotransform[0] + window[2] * geotransform[1],geotransform[1],geotransform[2],
+            geotransform[3] + window[0] * geotransform[5],geotransform[4],geotransform[5])
+
+
+def cropdir(src,dst,window,mask=None):
+    """
+    Crops all pcraster maps in src (recursively) to the window and saves them in dst.
+    If mask is given cells outside the mask are set to missing. Other files are copied.
+    """
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst,os.path.relpath(root,src))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for f in files:
+            fname = os.path.join(root,f)
+            if ismap(fname):
+                data, geotransform, mv, valuescale = readgrid(fname)
+                data = data[window[0]:window[1],window[2]:window[3]].copy()
+                if mask is not None and mv is not None:
+                    data[~mask] = mv
+                writegrid(os.path.join(target,f),data,windowgeotransform(geotransform,window),mv,valuescale)
+            else:
+                shutil.copy(fname,os.path.join(target,f))
+
+
+def preparegroupcase(caseName,groupcase,configfile,window,mask,logger,settings={}):
+    """
+    Makes the case for one group of subcatchments
+
+    settings: extra ini settings for the group case {(section, option): value}
+    """
+    logger.info("Preparing " + groupcase + " window (rows, cols): " + str(window))
+    if os.path.exists(groupcase):
+        shutil.rmtree(groupcase)
+    os.makedirs(groupcase)
+    for d in cropdirs:
+        if os.path.isdir(os.path.join(caseName,d)):
+            cropdir(os.path.join(caseName,d),os.path.join(groupcase,d),window,mask)
+    for d in windowdirs:
+        if os.path.isdir(os.path.join(caseName,d)):
+            cropdir(os.path.join(caseName,d),os.path.join(groupcase,d),window)
+    for d in copydirs:
+        if os.path.isdir(os.path.join(caseName,d)):
+            shutil.copytree(os.path.join(caseName,d),os.path.join(groupcase,d))
+
+    config = ConfigParser.RawConfigParser()
+    config.optionxform = str
+    config.read(os.path.join(caseName,configfile))
+    if config.has_option('framework','netcdfoutput'):
+        logger.warn("netcdf output is written per group (in " + groupcase + ") and not merged")
+    if config.has_option('framework','netcdfinput'):
+        config.set('framework','netcdfinput',os.path.abspath(os.path.join(caseName,config.get('framework','netcdfinput'))))
+    if not config.has_section('model'):
+        config.add_section('model')
+    config.set('model','SubCatchFlowOnly','1')
+    for (section, option), value in settings.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section,option,value)
+    fp = open(os.path.join(groupcase,configfile),'w')
+    config.write(fp)
+    fp.close()
+
+
+def runworkers(commands,nrworkers,logger,cwd=None):
+    """
+    Runs the commands with at most nrworkers at the same time
+
+    :return: list with the exit code of each command
+    """
+    todo = list(enumerate(commands))
+    running = {}
+    result = [None] * len(commands)
+    while len(todo) > 0 or len(running) > 0:
+        while len(todo) > 0 and len(running) < nrworkers:
+            nr, cmd = todo.pop(0)
+            logger.info("Starting: " + " ".join(cmd))
+            running[nr] = subprocess.Popen(cmd,cwd=cwd)
+        for nr in running.keys():
+            ret = running[nr].poll()
+            if ret is not None:
+                result[nr] = ret
+                del running[nr]
+                logger.info("Worker " + str(nr) + " finished with exit code " + str(ret))
+        time.sleep(0.2)
+
+    return result
+
+
+def mergemaps(groupruns,windows,masks,target,shape,geotransform,logger):
+    """
+    Merges the maps in the mergedirs of the group runs into target
+    """
+    for d in mergedirs:
+        names = set()
+        for grouprun in groupruns:
+            if os.path.isdir(os.path.join(grouprun,d)):
+                names.update(os.listdir(os.path.join(grouprun,d)))
+        if not os.path.isdir(os.path.join(target,d)):
+            os.makedirs(os.path.join(target,d))
+        for name in sorted(names):
+            merged = None
+            for grouprun, window, mask in zip(groupruns,windows,masks):
+                fname = os.path.join(grouprun,d,name)
+                if not os.path.isfile(fname):
+                    continue
+                if not ismap(fname):
+                    logger.warn("Not merging (not a pcraster map): " + fname)
+                    break
+                data, gt, mv, valuescale = readgrid(fname)
+                if merged is None:
+                    merged = numpy.empty(shape,dtype=data.dtype)
+                    merged.fill(mv if mv is not None else 0)
+                    mergedmv, mergedvs = mv, valuescale
+                part = merged[window[0]:window[1],window[2]:window[3]]
+                part[mask] = data[mask]
+            if merged is not None:
+                writegrid(os.path.join(target,d,name),merged,geotransform,mergedmv,mergedvs)
+
+
+def readtimeseries(fname):
+    """
+    Reads a csv or tss file written by the framework
+
+    :return: ids of the columns, data (timestep in the first column)
+    """
+    fp = open(fname)
+    lines = fp.readlines()
+    fp.close()
+    if lines[0].startswith('#'):
+        ids = [float(a) for a in lines[0].split(',')[1:]]
+        data = numpy.genfromtxt(lines[1:],delimiter=',')
+    else:
+        nrcols = int(lines[1])
+        ids = [float(a) for a in lines[3:2 + nrcols]]
+        data = numpy.genfromtxt(lines[2 + nrcols:])
+    return ids, data.reshape((-1,len(ids) + 1))
+
+
+def writetimeseries(fname,ids,data):
+    """
+    Writes a csv or tss file in the same layout as the framework
+    """
+    fp = open(fname,'w')
+    if fname.endswith('.tss'):
+        fp.write("timeseries scalar\n" + str(len(ids) + 1) + "\ntimestep\n")
+        for idd in ids:
+            fp.write(str(idd) + "\n")
+        delimiter = ' '
+    else:
+        fp.write("# Timestep," + ",".join([str(a) for a in ids]) + "\n")
+        delimiter = ','
+    rowformat = delimiter.join(['%d'] + ['%.10g'] * len(ids)) + "\n"
+    for row in data:
+        fp.write(rowformat % tuple(row))
+    fp.close()
+
+
+def timeseriesweights(groupcase,samplemap):
+    """
+    :return: dictionary with the number of cells in the group case for each id of the sample map
+    """
+    fname = os.path.join(groupcase,samplemap)
+    if not os.path.isfile(fname):
+        return {}
+    data, gt, mv, vs = readgrid(fname)
+    ids, counts = numpy.unique(data[data != mv],return_counts=True)
+    return dict(zip(ids.tolist(),counts.tolist()))
+
+
+def mergetimeseries(groupcases,runId,target,configfile,logger):
+    """
+    Merges the csv/tss files of the outputcsv_N/outputtss_N sections. Columns (areas)
+    found in more than one group are averaged using the number of cells of the area in
+    each group.
+    """
+    config = ConfigParser.RawConfigParser()
+    config.optionxform = str
+    config.read(os.path.join(groupcases[0],configfile))
+    for section in config.sections():
+        if not (section.startswith('outputcsv_') or section.startswith('outputtss_')):
+            continue
+        samplemap = config.get(section,'samplemap') if config.has_option(section,'samplemap') else None
+        weights = [timeseriesweights(g,samplemap) if samplemap else {} for g in groupcases]
+        for option in config.options(section):
+            if option == 'samplemap':
+                continue
+            name = config.get(section,option)
+            sums = {}
+            counts = {}
+            steps = None
+            for groupcase, weight in zip(groupcases,weights):
+                fname = os.path.join(groupcase,runId,name)
+                if not os.path.isfile(fname):
+                    continue
+                ids, data = readtimeseries(fname)
+                steps = data[:,0]
+                for col, idd in enumerate(ids):
+                    if idd == 0 and len(ids) > 1:
+                        continue
+                    w = weight.get(idd,1) if len(weight) > 0 else 1
+                    if w == 0:
+                        continue
+                    sums[idd] = sums.get(idd,0.0) + data[:,col + 1] * w
+                    counts[idd] = counts.get(idd,0) + w
+            if steps is None:
+                logger.warn("No timeseries found to merge for: " + name)
+                continue
+            ids = sorted(sums.keys())
+            merged = numpy.column_stack([steps] + [sums[idd]/counts[idd] for idd in ids])
+            writetimeseries(os.path.join(target,name),ids,merged)
+
+
+def subcatchdag(subcatch,mv,lddarr):
+    """
+    Determines how the subcatchments drain into each other
+
+    Input:
+        - subcatch - subcatchment ids (numpy array)
+        - mv - missing value of subcatch
+        - lddarr - ldd directions (numpy array, values outside 1-9 are missing)
+
+    Output:
+        - order - subcatchment ids, upstream subcatchments before downstream ones
+        - links - dictionary: (upstream id, downstream id) -> (outlet cells, entry cells), flat
+          indices of the cells that drain out of the upstream subcatchment and the
+          cells in the downstream subcatchment they drain into
+    """
+    rows, cols = subcatch.shape
+    flat = lddarr.ravel().astype(numpy.int64)
+    sub = subcatch.ravel()
+    active = numpy.flatnonzero((flat >= 1) & (flat <= 9) & (flat != 5) & (sub != mv))
+    trow = active // cols + lddrowoffset[flat[active]]
+    tcol = active % cols + lddcoloffset[flat[active]]
+    inside = (trow >= 0) & (trow < rows) & (tcol >= 0) & (tcol < cols)
+    active = active[inside]
+    target = trow[inside] * cols + tcol[inside]
+    crossing = (sub[target] != mv) & (sub[target] != sub[active])
+
+    links = {}
+    for cell, entry in zip(active[crossing],target[crossing]):
+        key = (sub[cell],sub[entry])
+        outlets, entries = links.get(key,([],[]))
+        outlets.append(cell)
+        entries.append(entry)
+        links[key] = (outlets,entries)
+
+    ids = numpy.unique(sub[sub != mv]).tolist()
+    nrupstream = dict([(i,0) for i in ids])
+    for up, down in links:
+        nrupstream[down] = nrupstream[down] + 1
+    order = [i for i in ids if nrupstream[i] == 0]
+    pos = 0
+    while pos < len(order):
+        for up, down in links:
+            if up == order[pos]:
+                nrupstream[down] = nrupstream[down] - 1
+                if nrupstream[down] == 0:
+                    order.append(down)
+        pos = pos + 1
+
+    if len(order) != len(ids):
+        raise ValueError("The subcatchments drain into each other in a loop, check the ldd and subcatch maps")
+
+    return order, links
+
+
+def pipelineworker(module,groupcase,runId,configfile,laststep,variable,inflowstack,apiinflow,inlinks,outlinks,done):
+    """
+    Runs the model of one subcatchment in a worker process. Before each step the discharge
+    of the upstream subcatchments is received and added to the inflow forcing (inflowstack)
+    at the entry cells. After each step the value of variable at the outlet cells is sent
+    to the downstream subcatchments. done is set after the last step has been sent.
+
+    apiinflow: the inflow stack is an API input in the original case, start from 0 (as a
+    single run does) instead of the forcing on disk
+    inlinks: list of (queue, rows, cols) of the entry cells for each upstream subcatchment
+    outlinks: list of (queue, rows, cols) of the outlet cells for each downstream subcatchment
+    """
+    wf = __import__(module,fromlist=['WflowModel'])
+    myModel = wf.WflowModel('wflow_subcatch.map',groupcase,runId,configfile)
+    dynModelFw = wf.wf_DynamicFramework(myModel,laststep,1)
+    dynModelFw.createRunId(NoOverWrite=False,logfname="wf_parallel_worker.log")
+    dynModelFw._runInitial()
+    dynModelFw._runResume()
+    first = dynModelFw._d_firstTimestep
+    last = myModel.nrTimeSteps()
+    inflowname = os.path.basename(inflowstack)
+
+    for ts in range(first,last + 1):
+        if len(inlinks) > 0:
+            if apiinflow:
+                inflow = numpy.zeros((wf.getrows(),wf.getcols()))
+            else:
+                # the inflow stack is an API input in the worker case, read the forcing
+                # (maps, binary mapstack or netcdf) as the model would
+                myModel._setInDynamic(True)
+                myModel._setCurrentTimeStep(ts)
+                forcing = dynModelFw.wf_readmap(os.path.join(groupcase,inflowstack),0.0,verbose=False,style=1)
+                myModel._setInDynamic(False)
+                inflow = wf.pcr2numpy(wf.cover(forcing,wf.spatial(wf.scalar(0.0))),0.0)
+            for queue, rows, cols in inlinks:
+                step, values = queue.get()
+                if step != ts:
+                    raise ValueError("Expected inflow for step " + str(ts) + " but got " + str(step))
+                numpy.add.at(inflow,(rows,cols),values)
+            setattr(myModel,inflowname,wf.numpy2pcr(wf.Scalar,inflow,-999.0))
+
+        dynModelFw._runDynamic(ts,ts)
+
+        if len(outlinks) > 0:
+            outvar = wf.pcr2numpy(getattr(myModel,variable),0.0)
+            for queue, rows, cols in outlinks:
+                queue.put((ts,outvar[rows,cols].tolist()))
+
+    done.set()
+    dynModelFw._runSuspend()
+    dynModelFw._wf_shutdown()
+
+
+def runpipeline(workers,done,nrworkers,logger):
+    """
+    Runs the worker processes with at most nrworkers computing at the same time. The
+    workers must be ordered from upstream to downstream. A worker gives up its slot
+    when it has sent its last step (done[nr] is set) and not when it exits: the
+    process only exits after the data on its queues has been read by the downstream
+    worker, which may still have to be started.
+
+    :return: list with the exit code of each worker
+    """
+    todo = range(0,len(workers))
+    computing = {}
+    started = {}
+    result = [None] * len(workers)
+    while len(todo) > 0 or len(started) > 0:
+        while len(todo) > 0 and len(computing) < nrworkers:
+            nr = todo.pop(0)
+            logger.info("Starting worker: " + workers[nr].name)
+            workers[nr].start()
+            computing[nr] = workers[nr]
+            started[nr] = workers[nr]
+        for nr in computing.keys():
+            if done[nr].is_set() or not computing[nr].is_alive():
+                del computing[nr]
+        for nr in started.keys():
+            if not started[nr].is_alive():
+                started[nr].join()
+                result[nr] = started[nr].exitcode
+                logger.info("Worker " + started[nr].name + " finished with exit code " + str(result[nr]))
+                del started[nr]
+        time.sleep(0.2)
+
+    return result
+
+
+def main(argv=None):
+    """
+    Perform command line execution of the parallel run.
+    """
+    caseName = None
+    runId = "run_default"
+    configfile = "wflow_sbm.ini"
+    module = "wflow.wflow_sbm"
+    nrgroups = multiprocessing.cpu_count()
+    nrworkers = None
+    keep = False
+    pipeline = False
+    laststep = 1
+    variable = "SurfaceRunoff"
+    inflowstack = "inmaps/IF"
+
+    if argv is None:
+        argv = sys.argv[1:]
+        if len(argv) == 0:
+            usage()
+            return
+
+    try:
+        opts, args = getopt.getopt(argv, 'C:R:c:M:n:w:kPT:V:I:h')
+    except getopt.error, msg:
+        usage(msg)
+
+    for o, a in opts:
+        if o == '-h': usage()
+        if o == '-C': caseName = a
+        if o == '-R': runId = a
+        if o == '-c': configfile = a
+        if o == '-M': module = a
+        if o == '-n': nrgroups = int(a)
+        if o == '-w': nrworkers = int(a)
+        if o == '-k': keep = True
+        if o == '-P': pipeline = True
+        if o == '-T': laststep = int(a)
+        if o == '-V': variable = a
+        if o == '-I': inflowstack = a
+
+    if caseName is None:
+        usage("No case given (-C)")
+    nrworkers = nrworkers if nrworkers else nrgroups
+    caseName = os.path.abspath(caseName)
+    target = os.path.join(caseName,runId)
+    if not os.path.isdir(target):
+        os.makedirs(target)
+    logger = pcrut.setlogger(os.path.join(target,"wf_parallel.log"),"wf_parallel",thelevel=logging.DEBUG)
+
+    subcatch, geotransform, mv, vs = readgrid(os.path.join(caseName,subcatchmap))
+    if pipeline:
+        # one worker per subcatchment, from upstream to downstream
+        config = ConfigParser.RawConfigParser()
+        config.optionxform = str
+        config.read(os.path.join(caseName,configfile))
+        lddname = config.get('model','wflow_ldd') if config.has_option('model','wflow_ldd') else "staticmaps/wflow_ldd.map"
+        lddarr = readgrid(os.path.join(caseName,lddname))[0]
+        order, links = subcatchdag(subcatch,mv,lddarr)
+        groups = [[idd] for idd in order]
+        withinflow = set([down for up, down in links])
+        inflowname = os.path.basename(inflowstack)
+        apiinflow = config.has_option('API',inflowname) and config.get('API',inflowname).split(',')[0].strip() == '0'
+        logger.info("Running " + str(len(groups)) + " subcatchments pipelined with " + str(nrworkers) + " workers")
+    else:
+        groups = partition(subcatch,mv,nrgroups)
+        logger.info("Running " + str(len(groups)) + " groups of subcatchments with " + str(nrworkers) + " workers")
+
+    windows = []
+    masks = []
+    groupcases = []
+    commands = []
+    for nr, group in enumerate(groups):
+        full = numpy.in1d(subcatch.ravel(),group).reshape(subcatch.shape)
+        window = groupwindow(full)
+        groupcase = os.path.join(target,"subbasins","group_" + str(nr))
+        # Only subcatchments that get upstream inflow set the inflow map from the pipeline,
+        # the others read the inflow forcing from disk
+        settings = {('API',os.path.basename(inflowstack)): '0,1'} if pipeline and group[0] in withinflow else {}
+        preparegroupcase(caseName,groupcase,configfile,window,full[window[0]:window[1],window[2]:window[3]],logger,settings)
+        windows.append(window)
+        masks.append(full[window[0]:window[1],window[2]:window[3]])
+        groupcases.append(groupcase)
+        commands.append([sys.executable,'-m',module,'-C',groupcase,'-R',runId,'-c',configfile] + args)
+
+    if pipeline:
+        cols = subcatch.shape[1]
+        position = dict([(group[0],nr) for nr, group in enumerate(groups)])
+        inlinks = [[] for group in groups]
+        outlinks = [[] for group in groups]
+        for (up, down), (outlets, entries) in links.items():
+            queue = multiprocessing.Queue()
+            upw = windows[position[up]]
+            downw = windows[position[down]]
+            outlets = numpy.array(outlets)
+            entries = numpy.array(entries)
+            outlinks[position[up]].append((queue,outlets // cols - upw[0],outlets % cols - upw[2]))
+            inlinks[position[down]].append((queue,entries // cols - downw[0],entries % cols - downw[2]))
+        done = [multiprocessing.Event() for group in groups]
+        workers = [multiprocessing.Process(target=pipelineworker,name="subcatch_" + str(group[0]),
+                                           args=(module,groupcases[nr],runId,configfile,laststep,variable,inflowstack,apiinflow,
+                                                 inlinks[nr],outlinks[nr],done[nr]))
+                   for nr, group in enumerate(groups)]
+        result = runpipeline(workers,done,nrworkers,logger)
+    else:
+        result = runworkers(commands,nrworkers,logger)
+
+    if any([ret != 0 for ret in result]):
+        logger.error("One or more workers failed: " + str(result) + " see the logfiles in " + os.path.join(target,"subbasins"))
+        sys.exit(1)
+
+    logger.info("Merging the results into " + target)
+    mergemaps([os.path.join(g,runId) for g in groupcases],windows,masks,target,subcatch.shape,geotransform,logger)
+    mergetimeseries(groupcases,runId,target,configfile,logger)
+
+    if not keep:
+        shutil.rmtree(os.path.join(target,"subbasins"))
+
+
+def usage(*args):
+    sys.stdout = sys.stderr
+    for msg in args: print msg
+    print __doc__
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
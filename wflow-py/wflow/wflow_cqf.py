@@ -305,6 +305,10 @@ class WflowModel(DynamicModel):
         # Set and get defaults from ConfigFile here ###################################
     self.scalarInput = int(configget(self.config,"model","ScalarInput","0"))
     self.Tslice = int(configget(self.config,"model","Tslice","1"))
+    # pcraster: pcraster kinematic function, numpy: kinematic_numpy on a precomputed lddgraph
+    self.kinwavesolver = configget(self.config,"model","kinwavesolver","pcraster")
+    # pcraster: pcraster upstream/accucapacity* etc, numpy: the lddgraph versions of these
+    self.lddoperators = configget(self.config,"model","lddoperators","pcraster")
     self.interpolMethod = configget(self.config,"model","InterpolationMethod","inv")
     self.reinit = int(configget(self.config,"model","reinit","0"))
     self.fewsrun = int(configget(self.config,"model","fewsrun","0"))
@@ -478,7 +482,7 @@ class WflowModel(DynamicModel):
     # soil thickness based on topographical index (see Environmental modelling: finding simplicity in complexity)
     # 1: calculate wetness index
     # 2: Scale the capacity (now actually a max capacity) based on the index, also apply a minmum capacity
-    WI = ln(accuflux(self.TopoLdd,1)/self.Slope) # Topographical wetnesss. Scale WI by zone/subcatchment assuming these ara also geological units
+    WI = ln(self.wf_cachedStatic("accuflux",accuflux,[self.TopoLdd,1])/self.Slope) # Topographical wetnesss. Scale WI by zone/subcatchment assuming these ara also geological units
     WIMax = areamaximum(WI, self.TopoId) * WIMaxScale
     self.FirstZoneThickness = max(min(self.FirstZoneThickness,(WI/WIMax) * self.FirstZoneThickness),    self.FirstZoneMinCapacity)
     
@@ -512,14 +516,19 @@ class WflowModel(DynamicModel):
         self.UpdateMap = numpy2pcr(Nominal,touse,0.0)
         # Calulate distance to updating points (upstream) annd use to scale the correction
         # ldddist returns zero for cell at the gauges so add 1.0 tp result
-        self.DistToUpdPt = cover(min(ldddist(self.TopoLdd,boolean(cover(self.UpdateMap,0)),1) * self.reallength/celllength(),self.UpdMaxDist),self.UpdMaxDist)
+        updatedist = self.wf_cachedStatic("ldddist_update",ldddist,
+                                          [self.TopoLdd,boolean(cover(self.UpdateMap,0)),1])
+        self.DistToUpdPt = cover(min(updatedist * self.reallength/celllength(),self.UpdMaxDist),self.UpdMaxDist)
 
         
     
     # Initializing of variables
     self.logger.info("Initializing of model variables..")
-    self.TopoLdd=lddmask(self.TopoLdd,boolean(self.TopoId))   
+    self.TopoLdd=self.wf_cachedStatic("lddmask_topoid",lddmask,[self.TopoLdd,boolean(self.TopoId)])
     catchmentcells=maptotal(scalar(self.TopoId))
+    if self.kinwavesolver == "numpy" or self.lddoperators == "numpy":
+        self.logger.info("Using numpy drainage network (kinwavesolver: " + self.kinwavesolver + ", lddoperators: " + self.lddoperators + ")")
+        self.TopoGraph = getlddgraph(self.TopoLdd)
  
     # Used to seperate output per LandUse/management classes
     OutZones = self.LandUse
@@ -559,13 +568,11 @@ class WflowModel(DynamicModel):
     self.CumIF=self.ZeroMap
     self.CumSeepage=self.ZeroMap
     self.CumActInfilt=self.ZeroMap
-    self.Aspect=scalar(aspect(self.Altitude))# aspect [deg]
-    self.Aspect  = ifthenelse(self.Aspect <= 0.0 , scalar(0.001),self.Aspect)
-    # On Flat areas the Aspect function fails, fill in with average...
-    self.Aspect = ifthenelse (defined(self.Aspect), self.Aspect, areaaverage(self.Aspect,self.TopoId))
+    # aspect [deg], on flat areas the aspect function fails, these get the average
+    self.Aspect=self.wf_cachedStatic("aspect",detaspect,[self.Altitude,self.TopoId])
            
     # Set DCL to riverlength if that is longer that the basic length calculated from grid  
-    drainlength = detdrainlength(self.TopoLdd,self.xl,self.yl)
+    drainlength = self.wf_cachedStatic("drainlength",detdrainlength,[self.TopoLdd,self.xl,self.yl])
     
     self.DCL=max(drainlength,self.RiverLength) # m
     # Multiply with Factor (taken from upscaling operation, defaults to 1.0 if no map is supplied
@@ -573,7 +580,7 @@ class WflowModel(DynamicModel):
     
     # water depth (m) 
     # set width for kinematic wave to cell width for all cells
-    self.Bw=detdrainwidth(self.TopoLdd,self.xl,self.yl)
+    self.Bw=self.wf_cachedStatic("drainwidth",detdrainwidth,[self.TopoLdd,self.xl,self.yl])
     # However, in the main river we have real flow so set the width to the 
     # width of the river
     
@@ -593,7 +600,7 @@ class WflowModel(DynamicModel):
    
     #self.initstorage=areaaverage(self.FirstZoneDepth,self.TopoId)+areaaverage(self.UStoreDepth,self.TopoId)#+areaaverage(self.Snow,self.TopoId)
     # calculate catchmentsize
-    self.upsize=catchmenttotal(self.xl * self.yl,self.TopoLdd)
+    self.upsize=self.wf_cachedStatic("upsize",catchmenttotal,[self.xl * self.yl,self.TopoLdd])
     self.csize=areamaximum(self.upsize,self.TopoId)
     # Save some summary maps
     self.logger.info("Saving summary maps...")
@@ -1002,8 +1009,11 @@ class WflowModel(DynamicModel):
         # 
         #MaxHor = max(0,min(self.FirstZoneKsatVer * self.Slope * exp(-SaturationDeficit/self.M),self.FirstZoneDepth*(self.thetaS-self.thetaR))) * timestepsecs/basetimestep
         MaxHor =  max(0.0,min(self.FirstZoneKsatVer * self.Slope * exp(-SaturationDeficit/self.M),self.FirstZoneDepth)) 
-        self.FirstZoneFlux = accucapacityflux (self.TopoLdd, self.FirstZoneDepth, MaxHor)
-        self.FirstZoneDepth = accucapacitystate (self.TopoLdd, self.FirstZoneDepth, MaxHor)
+        if self.lddoperators == "numpy":
+            self.FirstZoneFlux, self.FirstZoneDepth = self.TopoGraph.accucapacity(self.FirstZoneDepth, MaxHor)
+        else:
+            self.FirstZoneFlux = accucapacityflux (self.TopoLdd, self.FirstZoneDepth, MaxHor)
+            self.FirstZoneDepth = accucapacitystate (self.TopoLdd, self.FirstZoneDepth, MaxHor)
         
 
 
@@ -1062,10 +1072,16 @@ class WflowModel(DynamicModel):
     # per distance along stream
     q=self.Inwater/self.DCL
     # discharge (m3/s)
-    self.SurfaceRunoff = kinematic(self.TopoLdd, self.SurfaceRunoff,q,self.Alpha, self.Beta,self.Tslice,self.timestepsecs,self.DCL) # m3/s
+    if self.kinwavesolver == "numpy":
+        self.SurfaceRunoff = kinematic_numpy(self.TopoGraph, self.SurfaceRunoff,q,self.Alpha, self.Beta,self.Tslice,self.timestepsecs,self.DCL) # m3/s
+    else:
+        self.SurfaceRunoff = kinematic(self.TopoLdd, self.SurfaceRunoff,q,self.Alpha, self.Beta,self.Tslice,self.timestepsecs,self.DCL) # m3/s
     self.SurfaceRunoffMM=self.SurfaceRunoff*self.QMMConv # SurfaceRunoffMM (mm) from SurfaceRunoff (m3/s)
     self.updateRunOff()
-    self.InflowKinWaveCell=upstream(self.TopoLdd,self.SurfaceRunoff)
+    if self.lddoperators == "numpy":
+        self.InflowKinWaveCell=self.TopoGraph.upstream(self.SurfaceRunoff)
+    else:
+        self.InflowKinWaveCell=upstream(self.TopoLdd,self.SurfaceRunoff)
     self.MassBalKinWave = (self.KinWaveVolume - self.OldKinWaveVolume)/self.timestepsecs  + self.InflowKinWaveCell + self.Inwater - self.SurfaceRunoff
 
     Runoff=self.SurfaceRunoff
@@ -1115,7 +1131,10 @@ class WflowModel(DynamicModel):
     CellStorage = self.UStoreDepth+self.FirstZoneDepth
     DeltaStorage = CellStorage - self.InitialStorage
     OutFlow = self.FirstZoneFlux
-    CellInFlow = upstream(self.TopoLdd,scalar(self.FirstZoneFlux));
+    if self.lddoperators == "numpy":
+        CellInFlow = self.TopoGraph.upstream(self.FirstZoneFlux)
+    else:
+        CellInFlow = upstream(self.TopoLdd,scalar(self.FirstZoneFlux));
     #CellWatBal = ActInfilt - self.ActEvap - self.ExfiltWater - ActLeakage + Reinfilt + IF - OutFlow + (OldCellStorage - CellStorage)
     #SumCellWatBal = SumCellWatBal + CellWatBal;
 
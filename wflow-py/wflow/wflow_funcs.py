@@ -24,6 +24,9 @@ that may be used within the wflow models
 
 
 from numpy import *
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
 import getopt
 import os
 import os.path
@@ -147,6 +150,277 @@ def rainfall_interception_modrut(Precipitation,PotEvap,CanopyStorage,CanopyGapFr
     return NetInterception, ThroughFall, StemFlow, LeftOver, Interception, CanopyStorage
 
 
+def _kinematic_newton(Qin,Qold,q,alpha,beta,deltaT,deltaX,epsilon=1E-12,maxiter=3000):
+    """
+    Solves the kinematic wave equation for a set of independent cells (arrays)
+    with Newton-Raphson iteration. This is the same scheme as used in the
+    pcraster kinematic function (Chow, Applied Hydrology).
+
+    Input:
+        - Qin - sum of the inflow from the upstream cells [m3/s]
+        - Qold - discharge at the previous (sub)timestep [m3/s]
+        - q - lateral inflow per unit length [m2/s]
+        - alpha, beta - kinematic wave parameters
+        - deltaT - (sub)timestep [s]
+        - deltaX - length of the cells along the drainage network [m]
+
+    Output:
+        - new discharge [m3/s]
+    """
+    deltaTX = deltaT/deltaX
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        ab_pQ = alpha * beta * ((Qold + Qin)/2.0) ** (beta - 1.0)
+        C = deltaTX * Qin + alpha * Qold ** beta + deltaT * q
+        Qkx = (deltaTX * Qin + Qold * ab_pQ + deltaT * q)/(deltaTX + ab_pQ)
+        # NaN (no flow at all) also becomes the minimum
+        Qkx = numpy.where(Qkx > 1E-30,Qkx,1E-30)
+
+        todo = numpy.arange(len(Qkx))
+        count = 0
+        while len(todo) > 0 and count < maxiter:
+            Qk = Qkx[todo]
+            a = alpha[todo]
+            b = beta[todo]
+            dtx = deltaTX[todo]
+            fQkx = dtx * Qk + a * Qk ** b - C[todo]
+            dfQkx = dtx + a * b * Qk ** (b - 1.0)
+            Qk = Qk - fQkx/dfQkx
+            Qkx[todo] = numpy.where(Qk > 1E-30,Qk,1E-30)
+            count = count + 1
+            # The first update is always done, after that check for convergence
+            if count > 1:
+                todo = todo[numpy.absolute(fQkx) > epsilon]
+
+    Qkx[(Qin + Qold + q) == 0] = 0.0
+
+    return Qkx
+
+
+def kinematic_numpy(graph,Qold,q,alpha,beta,nrslices,deltaT,deltaX):
+    """
+    Kinematic wave routing over the drainage network of a wflow_lib.lddgraph. The
+    arguments are the same as those of the pcraster kinematic function except that
+    the ldd is replaced by the (once determined) lddgraph. All cells in one level of
+    the graph are solved at the same time.
+
+    Input:
+        - graph - lddgraph of the ldd
+        - Qold - discharge at the previous timestep [m3/s]
+        - q - lateral inflow per unit length [m2/s]
+        - alpha, beta - kinematic wave parameters
+        - nrslices - number of sub timesteps
+        - deltaT - timestep [s]
+        - deltaX - length of the cells along the drainage network [m]
+
+    Output:
+        - new discharge (map) [m3/s]
+    """
+    Q = graph.values(Qold)
+    q = graph.values(q)
+    alpha = graph.values(alpha)
+    beta = graph.values(beta)
+    deltaX = graph.values(deltaX)
+    n = graph.nrcells
+    dt = float(deltaT)/nrslices
+    for tslice in range(0,nrslices):
+        # Qin[n] collects the outflow of the pits
+        Qin = numpy.zeros(n + 1,dtype=numpy.float64)
+        Qnew = numpy.empty(n,dtype=numpy.float64)
+        for s, e in graph.levels:
+            Qnew[s:e] = _kinematic_newton(Qin[s:e],Q[s:e],q[s:e],alpha[s:e],beta[s:e],dt,deltaX[s:e])
+            numpy.add.at(Qin,graph.downstream[s:e],Qnew[s:e])
+        Q = Qnew
+
+    return graph.tomap(Q)
+
+
+class sparsedynamicwave():
+
+    def __init__(self,graph,bottomlevel,length,bottomwidth,depth,form,floodplainwidth,maxcourant=2.0,mintimestep=1.0,minslope=1E-4):
+        """
+        Implicit dynamic wave for a river network (the cells of a wflow_lib.lddgraph).
+        The momentum equation is linearised (local inertia, pressure and friction,
+        no advection term) and substituted in the continuity equation. This gives a
+        sparse symmetric system for the water level of all cells that is solved
+        for each sub timestep. The sparsity pattern (each cell and its downstream cell)
+        is determined once.
+
+        The channel is a trapezoid (bottomwidth, depth, form = side slope) with a
+        floodplain (floodplainwidth) above the channel depth. Pits without a level
+        boundary drain with the normal (manning) discharge for the bed slope of the
+        upstream cells (at least minslope).
+
+        Input (maps):
+            - graph - lddgraph of the river ldd
+            - bottomlevel - level of the channel bottom [m]
+            - length - channel length of the cells [m]
+            - bottomwidth, depth, form, floodplainwidth - cross section [m]
+            - maxcourant - the sub timestep is chosen so the courant number is below this value
+            - mintimestep - smallest sub timestep [s]
+        """
+        self.graph = graph
+        n = graph.nrcells
+        self.n = n
+        self.g = 9.81
+        self.maxcourant = maxcourant
+        self.mintimestep = mintimestep
+        self.zb = numpy.nan_to_num(graph.values(bottomlevel))
+        self.L = numpy.maximum(numpy.nan_to_num(graph.values(length)),1.0)
+        self.bw = numpy.maximum(numpy.nan_to_num(graph.values(bottomwidth)),0.0)
+        self.depth = numpy.maximum(numpy.nan_to_num(graph.values(depth)),0.0)
+        self.form = numpy.maximum(numpy.nan_to_num(graph.values(form)),0.0)
+        self.fpw = numpy.maximum(numpy.nan_to_num(graph.values(floodplainwidth)),self.bw + 2.0 * self.form * self.depth)
+
+        # links from a cell (up) to its downstream cell (down)
+        self.up = numpy.flatnonzero(graph.downstream < n)
+        self.down = graph.downstream[self.up]
+        self.linklength = (self.L[self.up] + self.L[self.down]) / 2.0
+        self.pits = numpy.flatnonzero(graph.downstream == n)
+        slope = (self.zb[self.up] - self.zb[self.down]) / self.linklength
+        self.pitslope = numpy.zeros(n)
+        numpy.maximum.at(self.pitslope,self.down,slope)
+        self.pitslope = numpy.maximum(self.pitslope,minslope)
+
+        # matrix entries: the diagonal, (up, down) and (down, up). order maps the entries to the csr data
+        rows = numpy.concatenate([numpy.arange(n),self.up,self.down])
+        cols = numpy.concatenate([numpy.arange(n),self.down,self.up])
+        pattern = scipy.sparse.csr_matrix((numpy.arange(1,len(rows) + 1,dtype=numpy.float64),(rows,cols)),shape=(n,n))
+        self.indptr = pattern.indptr
+        self.indices = pattern.indices
+        self.order = pattern.data.astype(numpy.int64) - 1
+        self.rows = rows
+
+    def geometry(self,h,idx=None):
+        """
+        Returns the wetted area, surface width and hydraulic radius for water depths h
+        (of the cells idx, default all cells)
+        """
+        if idx is None:
+            idx = numpy.arange(self.n)
+        bw = self.bw[idx]
+        depth = self.depth[idx]
+        form = self.form[idx]
+        fpw = self.fpw[idx]
+        hc = numpy.minimum(h,depth)
+        hf = numpy.maximum(h - depth,0.0)
+        area = hc * (bw + form * hc) + hf * fpw
+        width = numpy.where(h < depth,bw + 2.0 * form * h,fpw)
+        perimeter = bw + 2.0 * hc * numpy.sqrt(1.0 + form * form) + numpy.where(hf > 0.0,fpw - bw - 2.0 * form * depth + 2.0 * hf,0.0)
+        radius = area / numpy.maximum(perimeter,1E-6)
+
+        return area, width, radius
+
+    def step(self,h,Q,qlat,nch,nfp,dt,boundary):
+        """
+        One implicit sub timestep
+
+        Input (arrays for the cells of the graph):
+            - h - water depth [m], Q - outflow of the cells [m3/s], qlat - lateral inflow [m3/s]
+            - nch, nfp - manning roughness of the channel and floodplain
+            - dt - timestep [s]
+            - boundary - water depth at level boundary cells (NaN elsewhere)
+
+        Output:
+            - new h and Q
+        """
+        g = self.g
+        n = self.n
+        up = self.up
+        down = self.down
+        eta = self.zb + h
+
+        # linearised momentum equation of the links: Q = Qex - c * (eta_down - eta_up)
+        hl = numpy.maximum(numpy.maximum(eta[up],eta[down]) - numpy.maximum(self.zb[up],self.zb[down]),0.0)
+        al, wl, rl = self.geometry(hl,up)
+        rough = numpy.where(hl > self.depth[up],nfp[up],nch[up])
+        wet = al > 1E-6
+        friction = numpy.zeros(len(up))
+        friction[wet] = g * dt * rough[wet] ** 2 * numpy.abs(Q[up][wet]) / (al[wet] * rl[wet] ** (4.0 / 3.0))
+        dfac = 1.0 + friction
+        c = numpy.where(wet,g * al * dt / (self.linklength * dfac),0.0)
+        qex = numpy.where(wet,Q[up] / dfac,0.0)
+
+        # pits drain with the normal discharge (explicit), limited to the volume in the cell
+        area, width, radius = self.geometry(h)
+        surface = numpy.maximum(width,0.1) * self.L
+        pits = self.pits
+        isbound = numpy.isfinite(boundary)
+        qpit = area[pits] * radius[pits] ** (2.0 / 3.0) * numpy.sqrt(self.pitslope[pits]) / nch[pits]
+        qpit = numpy.minimum(qpit,surface[pits] * h[pits] / dt)
+        qpit[isbound[pits]] = 0.0
+
+        diag = surface / dt
+        numpy.add.at(diag,up,c)
+        numpy.add.at(diag,down,c)
+        rhs = surface / dt * eta + qlat
+        numpy.subtract.at(rhs,up,qex)
+        numpy.add.at(rhs,down,qex)
+        rhs[pits] = rhs[pits] - qpit
+
+        values = numpy.concatenate([diag,-c,-c])
+        # level boundaries: fixed water level
+        values[isbound[self.rows]] = 0.0
+        values[numpy.flatnonzero(isbound)] = 1.0
+        rhs[isbound] = self.zb[isbound] + boundary[isbound]
+
+        matrix = scipy.sparse.csr_matrix((values[self.order],self.indices,self.indptr),shape=(n,n))
+        etanew = scipy.sparse.linalg.spsolve(matrix,rhs)
+
+        qlink = qex - c * (etanew[down] - etanew[up])
+        Qnew = numpy.zeros(n)
+        Qnew[up] = qlink
+        Qnew[pits] = qpit
+        # outflow of the level boundaries from the water balance of the cell
+        inflow = numpy.bincount(down,weights=qlink,minlength=n)
+        Qnew[isbound] = (qlat + inflow - surface * (etanew - eta) / dt)[isbound]
+
+        return numpy.maximum(etanew - self.zb,0.0), Qnew
+
+    def run(self,WaterLevel,Q,qlat,channelroughness,floodplainroughness,deltaT,boundary=None):
+        """
+        Runs the dynamic wave for one model timestep with adaptive sub timesteps
+
+        Input (maps):
+            - WaterLevel - water depth [m]
+            - Q - discharge [m3/s]
+            - qlat - lateral inflow [m3/s]
+            - channelroughness, floodplainroughness - manning n
+            - deltaT - model timestep [s]
+            - boundary - water depth at the level boundary cells (missing elsewhere), None: no level boundaries
+
+        Output:
+            - discharge [m3/s], water depth [m] (maps), number of sub timesteps and
+              the maximum courant number
+        """
+        h = numpy.maximum(numpy.nan_to_num(self.graph.values(WaterLevel)),0.0)
+        Qa = numpy.nan_to_num(self.graph.values(Q))
+        qlat = numpy.nan_to_num(self.graph.values(qlat))
+        nch = numpy.maximum(numpy.nan_to_num(self.graph.values(channelroughness)),1E-3)
+        nfp = numpy.maximum(numpy.nan_to_num(self.graph.values(floodplainroughness)),1E-3)
+        if boundary is None:
+            bound = numpy.empty(self.n)
+            bound.fill(numpy.nan)
+        else:
+            bound = self.graph.values(boundary)
+
+        done = 0.0
+        nrsteps = 0
+        maxcourant = 0.0
+        while done < deltaT:
+            area = self.geometry(h)[0]
+            celerity = numpy.abs(Qa) / numpy.maximum(area,1E-6) + numpy.sqrt(self.g * h)
+            courant = float(numpy.max(celerity / self.L)) if self.n > 0 else 0.0
+            dt = self.maxcourant / courant if courant > 0.0 else deltaT
+            # plain comparisons, min and max are the pcraster functions in this module
+            dt = self.mintimestep if dt < self.mintimestep else dt
+            dt = deltaT - done if dt > deltaT - done else dt
+            maxcourant = courant * dt if courant * dt > maxcourant else maxcourant
+            h, Qa = self.step(h,Qa,qlat,nch,nfp,dt,bound)
+            done = done + dt
+            nrsteps = nrsteps + 1
+
+        return self.graph.tomap(Qa), self.graph.tomap(h), nrsteps, maxcourant
+
 
 # baseflow seperation methods
 # see http://mssanz.org.au/MODSIM97/Vol%201/Chapman.pdf
@@ -139,8 +139,31 @@ def mk_qres(N):
         uhq.append(cover(0.0))
         
     return uhq
-    
-    
+
+
+def mk_uhring(data):
+    """
+    Returns a ring buffer for the delayed flow of a unit hydrograph
+
+    Input:
+
+        - data - the delayed flow for each lag: a list of maps (as made by mk_qres and
+          read by wf_resume) or a (lags, rows, cols) array
+
+    Ouput:
+
+        - (2 * lags, rows, cols) array with data in the first lags layers (the others are zero)
+    """
+    if isinstance(data,list):
+        layers = numpy.array([pcr2numpy(m,0.0) for m in data],dtype=numpy.float64)
+    else:
+        layers = numpy.array(data,dtype=numpy.float64)
+    ring = numpy.zeros((2 * layers.shape[0],) + layers.shape[1:])
+    ring[0:layers.shape[0]] = layers
+
+    return ring
+
+
 
 class WflowModel(DynamicModel):  
   """
@@ -177,6 +200,8 @@ class WflowModel(DynamicModel):
 
       :var self.S_X1: production reservoir content at the beginning of the time step (divided by X1) [mm]
       :var self.R_X3: routing reservoir content at the beginning of the time step (divided by X3) [mm]
+      :var self.QUH1: delayed flow of UH1 for each lag, (lags, rows, cols) array saved as QUH1_<lag>.map [mm]
+      :var self.QUH2: delayed flow of UH2 for each lag, (lags, rows, cols) array saved as QUH2_<lag>.map [mm]
       
       .. todo::
       
@@ -310,6 +335,8 @@ class WflowModel(DynamicModel):
     
     self.QUH1 = mk_qres(self.NH)
     self.QUH2 = mk_qres(self.NH * 2)
+    # ring buffer, current window (the state) and position of the window for QUH1 and QUH2
+    self.UHrings = {}
         
     self.logger.info("End of initial section...")
 
@@ -336,6 +363,40 @@ class WflowModel(DynamicModel):
         self.wf_resume(os.path.join(self.Dir, "instate"))
 
 
+  def uhstate(self,name):
+      """
+      Returns the delayed flow of unit hydrograph name (QUH1 or QUH2) as a
+      (lags, rows, cols) window on its ring buffer. If the state was set from outside
+      (resume, rollback) it is copied into a new ring buffer first.
+      """
+      ring, window, pos = self.UHrings.get(name,(None,None,0))
+      current = getattr(self,name)
+      if current is not window:
+          ring = mk_uhring(current)
+          window = ring[0:ring.shape[0]/2]
+          self.UHrings[name] = (ring, window, 0)
+          setattr(self,name,window)
+
+      return window
+
+  def uhrotate(self,name):
+      """
+      Drops the first lag of the delayed flow of unit hydrograph name by moving the window
+      on the ring buffer one layer. Only if the window reaches the end of the buffer the
+      window is copied to the start.
+      """
+      ring, window, pos = self.UHrings[name]
+      lags = window.shape[0]
+      if pos + 1 > lags:
+          ring[0:lags - 1] = ring[pos + 1:pos + lags]
+          ring[lags - 1:] = 0.0
+          pos = 0
+      else:
+          pos = pos + 1
+      window = ring[pos:pos + lags]
+      self.UHrings[name] = (ring, window, pos)
+      setattr(self,name,window)
+
   def dynamic(self):
       """
       *Required*
@@ -375,17 +436,16 @@ class WflowModel(DynamicModel):
     
       #ouput of UH1 =========================================================
 
-      for j in range (0,self.NH): #UH1 output for each time step
-            self.QUH1[j]=self.QUH1[j] + float(self.UH1[j])*self.Pr
-      
-      self.Q9=self.B*self.QUH1[0]  
+      # Add the current Pr to all lags of the UH stores at once
+      Pr = pcr2numpy(self.Pr,0.0)
+      QUH1 = self.uhstate("QUH1")
+      QUH1 += numpy.multiply.outer(self.UH1,Pr)
+      QUH2 = self.uhstate("QUH2")
+      QUH2 += numpy.multiply.outer(self.UH2,Pr)
 
-            
-      # Add the current Q to the UH res
-      for j in range (0,2*self.NH): #UH2 output for each time step
-           self.QUH2[j]=self.QUH2[j] + float(self.UH2[j])*self.Pr
+      self.Q9=self.B*ifthen(defined(self.Pr),numpy2pcr(Scalar,QUH1[0],-9999.0))
 
-      self.Q1prim = self.QUH2[0]
+      self.Q1prim = ifthen(defined(self.Pr),numpy2pcr(Scalar,QUH2[0],-9999.0))
       # Get final runoff
       self.Q1=(1-self.B)*self.Q1prim
       self.F=self.X2*(self.R_X3)**3.5 #water subterranean exchange
@@ -398,10 +458,8 @@ class WflowModel(DynamicModel):
       self.SurfaceRunoff = areatotal(self.Q * self.ToCubic,self.OutputId)
 
       # Remove first item from the UH stacks and add a new empty one at the end
-      self.QUH1 = delete(self.QUH1,0)
-      self.QUH1 = append(self.QUH1,cover(0.0))
-      self.QUH2 = delete(self.QUH2,0)
-      self.QUH2 = append(self.QUH2,cover(0.0))
+      self.uhrotate("QUH1")
+      self.uhrotate("QUH2")
       
     
 
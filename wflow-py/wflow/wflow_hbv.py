@@ -94,6 +94,7 @@ import getopt
 
 from wflow.wf_DynamicFramework import *
 from wflow.wf_DynamicFramework import *
+from wflow.wflow_funcs import kinematic_numpy
 from wflow.wflow_adapt import *
 from wflow_adapt import *    
         
@@ -331,6 +332,10 @@ class WflowModel(DynamicModel):
         # Set and get defaults from ConfigFile here ###################################
     self.scalarInput = int(configget(self.config,"model","ScalarInput","0"))
     self.Tslice = int(configget(self.config,"model","Tslice","1"))
+    # pcraster: pcraster kinematic function, numpy: kinematic_numpy on a precomputed lddgraph
+    self.kinwavesolver = configget(self.config,"model","kinwavesolver","pcraster")
+    # pcraster: pcraster upstream/accucapacity* etc, numpy: the lddgraph versions of these
+    self.lddoperators = configget(self.config,"model","lddoperators","pcraster")
     self.interpolMethod = configget(self.config,"model","InterpolationMethod","inv")
     self.reinit = int(configget(self.config,"model","reinit","0"))
     self.fewsrun = int(configget(self.config,"model","fewsrun","0"))
@@ -523,14 +528,16 @@ class WflowModel(DynamicModel):
         self.UpdateMap = numpy2pcr(Nominal,touse,0.0)
         # Calculate distance to updating points (upstream) annd use to scale the correction
         # ldddist returns zero for cell at the gauges so add 1.0 tp result
-        self.DistToUpdPt = cover(min(ldddist(self.TopoLdd,boolean(cover(self.UpdateMap,0)),1) * self.reallength/celllength(),self.UpdMaxDist),self.UpdMaxDist)
+        updatedist = self.wf_cachedStatic("ldddist_update",ldddist,
+                                          [self.TopoLdd,boolean(cover(self.UpdateMap,0)),1])
+        self.DistToUpdPt = cover(min(updatedist * self.reallength/celllength(),self.UpdMaxDist),self.UpdMaxDist)
         #self.DistToUpdPt = ldddist(self.TopoLdd,boolean(cover(self.OutputId,0.0)),1)
         #* self.reallength/celllength()
 
 
     # Initializing of variables
     self.logger.info("Initializing of model variables..")
-    self.TopoLdd=lddmask(self.TopoLdd,boolean(self.TopoId))   
+    self.TopoLdd=self.wf_cachedStatic("lddmask_topoid",lddmask,[self.TopoLdd,boolean(self.TopoId)])
     catchmentcells=maptotal(scalar(self.TopoId))
 
 
@@ -538,9 +545,11 @@ class WflowModel(DynamicModel):
     # This is very handy for Ribasim etc...
     if self.SubCatchFlowOnly > 0:
         self.logger.info("Creating subcatchment-only drainage network (ldd)")
-        ds = downstream(self.TopoLdd,self.TopoId)
-        usid = ifthenelse(ds != self.TopoId,self.TopoId,0)
-        self.TopoLdd = lddrepair(ifthenelse(boolean(usid),ldd(5),self.TopoLdd))
+        self.TopoLdd = self.wf_cachedStatic("ldd_subcatchonly",subcatchonlyldd,[self.TopoLdd,self.TopoId])
+
+    if self.kinwavesolver == "numpy" or self.lddoperators == "numpy":
+        self.logger.info("Using numpy drainage network (kinwavesolver: " + self.kinwavesolver + ", lddoperators: " + self.lddoperators + ")")
+        self.TopoGraph = getlddgraph(self.TopoLdd)
 
     # Used to seperate output per LandUse/management classes
     #OutZones = self.LandUse
@@ -566,15 +575,13 @@ class WflowModel(DynamicModel):
     #CatSurface=maptotal(scalar(ifthen(scalar(self.TopoId)>scalar(0.0),scalar(1.0))))                   # catchment surface (in  km2) 
 
    
-    self.Aspect=scalar(aspect(self.Altitude))# aspect [deg]
-    self.Aspect  = ifthenelse(self.Aspect <= 0.0 , scalar(0.001),self.Aspect)
-    # On Flat areas the Aspect function fails, fill in with average...
-    self.Aspect = ifthenelse (defined(self.Aspect), self.Aspect, areaaverage(self.Aspect,self.TopoId))
+    # aspect [deg], on flat areas the aspect function fails, these get the average
+    self.Aspect=self.wf_cachedStatic("aspect",detaspect,[self.Altitude,self.TopoId])
 
     
 
     # Set DCL to riverlength if that is longer that the basic length calculated from grid  
-    drainlength = detdrainlength(self.TopoLdd,self.xl,self.yl)
+    drainlength = self.wf_cachedStatic("drainlength",detdrainlength,[self.TopoLdd,self.xl,self.yl])
     
     self.DCL=max(drainlength,self.RiverLength) # m
     # Multiply with Factor (taken from upscaling operation, defaults to 1.0 if no map is supplied
@@ -582,7 +589,7 @@ class WflowModel(DynamicModel):
     
     # water depth (m) 
     # set width for kinematic wave to cell width for all cells
-    self.Bw=detdrainwidth(self.TopoLdd,self.xl,self.yl)
+    self.Bw=self.wf_cachedStatic("drainwidth",detdrainwidth,[self.TopoLdd,self.xl,self.yl])
     # However, in the main river we have real flow so set the width to the 
     # width of the river
     
@@ -595,7 +602,7 @@ class WflowModel(DynamicModel):
     # initial approximation for Alpha
     
     # calculate catchmentsize
-    self.upsize=catchmenttotal(self.xl * self.yl,self.TopoLdd)
+    self.upsize=self.wf_cachedStatic("upsize",catchmenttotal,[self.xl * self.yl,self.TopoLdd])
     self.csize=areamaximum(self.upsize,self.TopoId)
 
 
@@ -747,8 +754,12 @@ class WflowModel(DynamicModel):
         # 5.67 = tan 80 graden
         SnowFluxFrac = min(0.5,self.Slope/5.67) * min(1.0,self.DrySnow/MaxSnowPack)
         MaxFlux = SnowFluxFrac * self.DrySnow
-        self.DrySnow = accucapacitystate(self.TopoLdd,self.DrySnow, MaxFlux)
-        self.FreeWater = accucapacitystate(self.TopoLdd,self.FreeWater,SnowFluxFrac * self.FreeWater )
+        if self.lddoperators == "numpy":
+            self.DrySnow = self.TopoGraph.accucapacity(self.DrySnow, MaxFlux)[1]
+            self.FreeWater = self.TopoGraph.accucapacity(self.FreeWater,SnowFluxFrac * self.FreeWater)[1]
+        else:
+            self.DrySnow = accucapacitystate(self.TopoLdd,self.DrySnow, MaxFlux)
+            self.FreeWater = accucapacitystate(self.TopoLdd,self.FreeWater,SnowFluxFrac * self.FreeWater )
     else:
         SnowFluxFrac = self.ZeroMap
         MaxFlux= self.ZeroMap
@@ -817,12 +828,18 @@ class WflowModel(DynamicModel):
     q=self.Inwater/self.DCL + self.ForecQ_qmec/self.DCL
     self.OldSurfaceRunoff=self.SurfaceRunoff
     
-    self.SurfaceRunoff = kinematic(self.TopoLdd, self.SurfaceRunoff,q,self.Alpha, self.Beta,self.Tslice,self.timestepsecs,self.DCL) # m3/s
+    if self.kinwavesolver == "numpy":
+        self.SurfaceRunoff = kinematic_numpy(self.TopoGraph, self.SurfaceRunoff,q,self.Alpha, self.Beta,self.Tslice,self.timestepsecs,self.DCL) # m3/s
+    else:
+        self.SurfaceRunoff = kinematic(self.TopoLdd, self.SurfaceRunoff,q,self.Alpha, self.Beta,self.Tslice,self.timestepsecs,self.DCL) # m3/s
     self.SurfaceRunoffMM=self.SurfaceRunoff*self.QMMConv # SurfaceRunoffMM (mm) from SurfaceRunoff (m3/s)
       
     
     self.updateRunOff()
-    InflowKinWaveCell=upstream(self.TopoLdd,self.SurfaceRunoff)
+    if self.lddoperators == "numpy":
+        InflowKinWaveCell=self.TopoGraph.upstream(self.SurfaceRunoff)
+    else:
+        InflowKinWaveCell=upstream(self.TopoLdd,self.SurfaceRunoff)
     self.MassBalKinWave = (self.KinWaveVolume - self.OldKinWaveVolume)/self.timestepsecs  + InflowKinWaveCell + self.Inwater - self.SurfaceRunoff
     Runoff=self.SurfaceRunoff
 
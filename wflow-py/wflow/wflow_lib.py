@@ -39,6 +39,7 @@ import getopt
 import os
 import os.path
 import sys
+import numpy
 
 
 import osgeo.gdal as gdal
@@ -48,6 +49,9 @@ from pcraster.framework import *
 import scipy
 import netCDF4 as nc4
 import gzip, zipfile
+import hashlib
+import re
+from collections import OrderedDict
 
 
 
@@ -651,6 +655,42 @@ def detdrainwidth(ldd,xl,yl):
     return drainwidth
 
 
+def detaspect(dem,zones):
+    """
+    Determines the aspect of a dem. Flat areas (where the pcraster aspect
+    function fails) get the average aspect of the zone
+    
+    Input:
+        - dem - digital elevation model
+        - zones - zones (e.g. subcatchments) to average over
+        
+    Output:
+        - aspect [deg]
+    """
+    asp = scalar(aspect(dem))
+    asp = ifthenelse(asp <= 0.0, scalar(0.001), asp)
+
+    return ifthenelse(defined(asp), asp, areaaverage(asp, zones))
+
+
+def subcatchonlyldd(lddmap,subcatch):
+    """
+    Makes pits at all subcatchment boundaries so no water flows from one
+    subcatchment to another
+    
+    Input:
+        - lddmap - drainage network
+        - subcatch - subcatchment map
+        
+    Output:
+        - ldd
+    """
+    ds = downstream(lddmap,subcatch)
+    usid = ifthenelse(ds != subcatch,subcatch,0)
+
+    return lddrepair(ifthenelse(boolean(usid),ldd(5),lddmap))
+
+
 def classify(inmap,lower=[0,10,20,30],upper=[10,20,30,40],classes=[2,2,3,4]):
     """
     classify a scaler maps accroding to the boundaries given in classes.
@@ -866,3 +906,547 @@ def writeMap(fileName, fileFormat, x, y, data, FillVal):
 
     if verbose:
         print 'Writing to ' + fileName + ' is done!'
+
+
+# row and column offsets of the downstream cell for ldd directions 0-9 (5 is a pit)
+lddrowoffset = numpy.array([0,1,1,1,0,0,0,-1,-1,-1])
+lddcoloffset = numpy.array([0,-1,0,1,-1,0,1,-1,0,1])
+# lddgraphs made by getlddgraph, by contents of the ldd. Only the last
+# _lddgraphcachesize graphs are kept.
+_lddgraphcache = OrderedDict()
+_lddgraphcachesize = 4
+
+
+def getlddgraph(ldd):
+    """
+    Returns the lddgraph of an ldd. The graph is made only once for each ldd
+    (with the same contents) and reused after that. Only the graphs of the last
+    few ldds are kept.
+
+    Input:
+        - ldd - drainage network
+
+    Output:
+        - lddgraph
+    """
+    lddarr = pcr2numpy(ldd,0).astype(numpy.int32)
+    key = (lddarr.shape,hashlib.sha1(lddarr.tostring()).hexdigest())
+    if key in _lddgraphcache:
+        graph = _lddgraphcache.pop(key)
+    else:
+        graph = lddgraph(ldd)
+    _lddgraphcache[key] = graph
+    while len(_lddgraphcache) > _lddgraphcachesize:
+        _lddgraphcache.popitem(last=False)
+
+    return graph
+
+
+class lddgraph():
+
+    def __init__(self,ldd):
+        """
+        The drainage network of an ldd as 1-D arrays of the active (non missing)
+        cells, ordered from upstream to downstream. Make it once (e.g. in the initial
+        section of a model, see getlddgraph) and use it for every timestep.
+
+        The upstream, downstream, accuflux, accucapacity, catchmenttotal, ldddist and
+        areatotal methods are numpy versions of the pcraster functions with the same
+        name. They take maps (or numbers) and return maps with missing values outside
+        of the network.
+
+        Input:
+            - ldd - drainage network
+
+        Attributes:
+            - shape - rows and cols of the clone
+            - cells - flat index (row * cols + col) of the active cells in upstream to downstream order
+            - downstream - position (in cells) of the downstream cell of each cell. Pits (and cells
+              that drain out of the map) have len(cells)
+            - upstreamptr, upstreamidx - the upstream cells of cell i are upstreamidx[upstreamptr[i]:upstreamptr[i+1]]
+            - levelstart - cells[levelstart[i]:levelstart[i+1]] are the cells of level i. These
+              cells only receive water from cells in lower levels.
+        """
+        lddarr = pcr2numpy(ldd,0).astype(numpy.int32)
+        self.shape = lddarr.shape
+        rows, cols = self.shape
+        flat = lddarr.ravel()
+        active = numpy.flatnonzero(flat > 0)
+        n = len(active)
+
+        # downstream position of each active cell (n for pits)
+        pos = numpy.empty(rows * cols,dtype=numpy.int64)
+        pos[:] = -1
+        pos[active] = numpy.arange(n)
+        trow = active // cols + lddrowoffset[flat[active]]
+        tcol = active % cols + lddcoloffset[flat[active]]
+        inside = (trow >= 0) & (trow < rows) & (tcol >= 0) & (tcol < cols) & (flat[active] != 5)
+        ds = numpy.empty(n,dtype=numpy.int64)
+        ds[:] = -1
+        ds[inside] = pos[trow[inside] * cols + tcol[inside]]
+        ds[ds < 0] = n
+
+        # Determine the levels: a cell can be done if all upstream cells are done
+        todo = numpy.bincount(ds,minlength=n + 1)[:n]
+        front = numpy.flatnonzero(todo == 0)
+        order = []
+        levelstart = [0]
+        while len(front) > 0:
+            order.append(front)
+            levelstart.append(levelstart[-1] + len(front))
+            down = ds[front]
+            down = down[down < n]
+            numpy.subtract.at(todo,down,1)
+            down = numpy.unique(down)
+            front = down[todo[down] == 0]
+
+        if levelstart[-1] != n:
+            raise ValueError("The ldd is not sound (it contains cycles)")
+
+        order = numpy.concatenate(order) if n > 0 else numpy.zeros(0,dtype=numpy.int64)
+        rank = numpy.empty(n + 1,dtype=numpy.int64)
+        rank[order] = numpy.arange(n)
+        rank[n] = n
+        self.cells = active[order]
+        self.downstream = rank[ds[order]]
+        self.levelstart = numpy.array(levelstart,dtype=numpy.int64)
+        self.nrcells = n
+        self.nrlevels = len(levelstart) - 1
+        self.mv = 1E31
+
+        # downstream cell or the cell itself for pits
+        self.downstreamorself = numpy.where(self.downstream < n,self.downstream,numpy.arange(n))
+        # upstream cells (compressed sparse rows)
+        inflow = numpy.flatnonzero(self.downstream < n)
+        self.upstreamidx = inflow[numpy.argsort(self.downstream[inflow],kind='mergesort')]
+        self.upstreamptr = numpy.zeros(n + 1,dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(self.downstream[inflow],minlength=n),out=self.upstreamptr[1:])
+        # distance to the downstream cell in cell lengths
+        lddorder = flat[self.cells]
+        self.drainsteps = numpy.where((lddorder % 2) == 1,numpy.sqrt(2.0),1.0)
+        self.drainsteps[lddorder == 5] = 0.0
+        self.levels = zip(self.levelstart[:-1],self.levelstart[1:])
+
+    def values(self,data):
+        """
+        Returns the values of a map (or a single value) for the cells of the network
+
+        Input:
+            - data - pcraster map or number
+
+        Output:
+            - float64 numpy array (len(cells)), missing values are NaN
+        """
+        if hasattr(data,'isSpatial'):
+            if not data.isSpatial() or data.dataType() != Scalar:
+                data = spatial(scalar(data))
+            return pcr_as_numpy(data).ravel()[self.cells].astype(numpy.float64)
+        else:
+            ret = numpy.empty(self.nrcells,dtype=numpy.float64)
+            ret.fill(float(data))
+            return ret
+
+    def tomap(self,values):
+        """
+        Returns the values of the cells of the network as a scalar map (missing
+        values outside the network and for NaN values)
+        """
+        full = numpy.empty(self.shape[0] * self.shape[1],dtype=numpy.float64)
+        full.fill(self.mv)
+        full[self.cells] = numpy.where(numpy.isnan(values),self.mv,values)
+        return numpy2pcr(Scalar,full.reshape(self.shape),self.mv)
+
+    def upstreamvalues(self,values):
+        """
+        Sum of the values of the upstream cells (array version of upstream)
+        """
+        return numpy.bincount(self.downstream,weights=values,minlength=self.nrcells + 1)[:self.nrcells]
+
+    def accufluxvalues(self,values):
+        """
+        Accumulated values over the network (array version of accuflux)
+        """
+        total = numpy.zeros(self.nrcells + 1,dtype=numpy.float64)
+        total[:self.nrcells] = values
+        for s, e in self.levels:
+            numpy.add.at(total,self.downstream[s:e],total[s:e])
+
+        return total[:self.nrcells]
+
+    def accucapacityvalues(self,material,capacity):
+        """
+        Transport of material over the network with a maximum flux per cell (array
+        version of accucapacityflux and accucapacitystate)
+
+        :return: flux, state
+        """
+        inflow = numpy.zeros(self.nrcells + 1,dtype=numpy.float64)
+        flux = numpy.empty(self.nrcells,dtype=numpy.float64)
+        state = numpy.empty(self.nrcells,dtype=numpy.float64)
+        for s, e in self.levels:
+            total = material[s:e] + inflow[s:e]
+            flux[s:e] = numpy.minimum(total,capacity[s:e])
+            state[s:e] = total - flux[s:e]
+            numpy.add.at(inflow,self.downstream[s:e],flux[s:e])
+
+        return flux, state
+
+    def upstream(self,material):
+        """
+        numpy version of pcraster upstream(ldd,material)
+        """
+        return self.tomap(self.upstreamvalues(self.values(material)))
+
+    def downstream(self,material):
+        """
+        numpy version of pcraster downstream(ldd,material): the value of the downstream
+        cell (pits get their own value)
+        """
+        return self.tomap(self.values(material)[self.downstreamorself])
+
+    def accuflux(self,material):
+        """
+        numpy version of pcraster accuflux(ldd,material)
+        """
+        return self.tomap(self.accufluxvalues(self.values(material)))
+
+    def catchmenttotal(self,material):
+        """
+        numpy version of pcraster catchmenttotal(material,ldd)
+        """
+        return self.accuflux(material)
+
+    def accucapacity(self,material,capacity):
+        """
+        numpy version of pcraster accucapacityflux and accucapacitystate in one go
+
+        :return: flux, state
+        """
+        flux, state = self.accucapacityvalues(self.values(material),self.values(capacity))
+        return self.tomap(flux), self.tomap(state)
+
+    def ldddist(self,points,friction):
+        """
+        numpy version of pcraster ldddist(ldd,points,friction): friction distance to the first
+        downstream cell that is True in points. Cells that do not drain to a point are missing.
+        """
+        ispoint = self.values(points) > 0
+        friction = self.values(friction)
+        cellsize = pcr2numpy(celllength(),numpy.nan)[0,0]
+        frictionds = numpy.append(friction,numpy.nan)[self.downstream]
+        step = self.drainsteps * cellsize * (friction + frictionds)/2.0
+        dist = numpy.empty(self.nrcells + 1,dtype=numpy.float64)
+        dist.fill(numpy.nan)
+        for s, e in reversed(self.levels):
+            dist[s:e] = numpy.where(ispoint[s:e],0.0,dist[self.downstream[s:e]] + step[s:e])
+
+        return self.tomap(dist[:self.nrcells])
+
+    def areatotal(self,material,areaclass):
+        """
+        numpy version of pcraster areatotal(material,areaclass) for the cells of the network
+        """
+        classes = self.values(areaclass)
+        valid = ~numpy.isnan(classes)
+        ids, classnr = numpy.unique(classes[valid],return_inverse=True)
+        totals = numpy.bincount(classnr,weights=self.values(material)[valid],minlength=len(ids))
+        ret = numpy.empty(self.nrcells,dtype=numpy.float64)
+        ret.fill(numpy.nan)
+        ret[valid] = totals[classnr]
+        return self.tomap(ret)
+
+
+class lddupdater():
+
+    def __init__(self,maxchanged=0.01,rebuildinterval=0):
+        """
+        Keeps an ldd derived from a dem that changes a little every timestep (e.g. the
+        water table in wflow_sbm) up to date without calling lddcreate every
+        timestep. The ldd is made with lddcreate (all pits removed) the first time. After
+        that only the cells for which the steepest descent direction changed
+        get the new direction. The ldd is rebuilt with lddcreate if:
+
+            - more than maxchanged (fraction of the active cells) of the cells changed direction
+            - a changed cell is in or next to an area where lddcreate did not follow the
+              steepest descent (filled depressions)
+            - a pit is made or removed
+            - the new directions make a cycle
+            - rebuildinterval (if > 0) updates have been done since the last rebuild
+
+        Input:
+            - maxchanged - fraction of the active cells
+            - rebuildinterval - number of updates after which the ldd is always rebuilt (0: never)
+
+        Attributes:
+            - nrrebuilds, nrupdates, nrunchanged - counters of what happened in update
+        """
+        self.maxchanged = maxchanged
+        self.rebuildinterval = rebuildinterval
+        self.ldd = None
+        self.lddmap = None
+        self.raw = None
+        self.locked = None
+        self.sinceupdate = 0
+        self.nrrebuilds = 0
+        self.nrupdates = 0
+        self.nrunchanged = 0
+
+    def directions(self,demarr):
+        """
+        Steepest descent (d8) directions of a dem. Cells without a lower neighbour
+        get 5, missing values 0.
+
+        Input:
+            - demarr - dem as numpy array (missing values are NaN)
+        """
+        rows, cols = demarr.shape
+        padded = numpy.empty((rows + 2,cols + 2))
+        padded.fill(numpy.inf)
+        padded[1:-1,1:-1] = numpy.where(numpy.isfinite(demarr),demarr,numpy.inf)
+        steepest = numpy.zeros((rows,cols))
+        dirs = numpy.empty((rows,cols),dtype=numpy.int32)
+        dirs.fill(5)
+        for code in [1,2,3,4,6,7,8,9]:
+            dist = numpy.sqrt(2.0) if code % 2 == 1 else 1.0
+            r = 1 + lddrowoffset[code]
+            c = 1 + lddcoloffset[code]
+            drop = (demarr - padded[r:r + rows,c:c + cols]) / dist
+            better = drop > steepest
+            steepest[better] = drop[better]
+            dirs[better] = code
+        dirs[~numpy.isfinite(demarr)] = 0
+
+        return dirs
+
+    def _hascycle(self,lddarr,starts):
+        """
+        Follows the ldd downstream from the start cells (flat indices) until all reach
+        a pit. A cycle in the ldd must pass through one of the start cells (the rest of
+        the ldd did not change) so a cycle shows up as a walk that returns to its start.
+        """
+        cols = lddarr.shape[1]
+        flat = lddarr.ravel()
+        pos = starts.copy()
+        start = starts
+        while len(pos) > 0:
+            code = flat[pos]
+            alive = (code != 5) & (code > 0)
+            pos = pos[alive] + lddrowoffset[code[alive]] * cols + lddcoloffset[code[alive]]
+            start = start[alive]
+            if numpy.any(pos == start):
+                return True
+
+        return False
+
+    def _rebuild(self,dem,raw):
+        self.lddmap = lddcreate(dem,1E35,1E35,1E35,1E35)
+        self.ldd = pcr2numpy(self.lddmap,0).astype(numpy.int32)
+        self.raw = raw
+        # cells where lddcreate did not follow the steepest descent and their neighbours
+        mismatch = numpy.pad((self.ldd != raw) & (raw > 0),1,mode='constant')
+        rows, cols = raw.shape
+        self.locked = numpy.zeros((rows,cols),dtype=bool)
+        for dr in [0,1,2]:
+            for dc in [0,1,2]:
+                self.locked |= mismatch[dr:dr + rows,dc:dc + cols]
+        self.sinceupdate = 0
+        self.nrrebuilds = self.nrrebuilds + 1
+
+        return self.lddmap
+
+    def update(self,dem):
+        """
+        Returns the ldd of the dem (see the class description)
+
+        Input:
+            - dem - pcraster map
+
+        Output:
+            - ldd map (the same map object as the previous call if nothing changed)
+        """
+        raw = self.directions(pcr2numpy(dem,numpy.nan))
+        if self.ldd is None or not numpy.array_equal(raw > 0,self.raw > 0):
+            return self._rebuild(dem,raw)
+
+        changed = raw != self.raw
+        nrchanged = numpy.count_nonzero(changed)
+        if nrchanged == 0:
+            self.nrunchanged = self.nrunchanged + 1
+            return self.lddmap
+
+        self.sinceupdate = self.sinceupdate + 1
+        if self.rebuildinterval > 0 and self.sinceupdate >= self.rebuildinterval:
+            return self._rebuild(dem,raw)
+        if nrchanged > self.maxchanged * numpy.count_nonzero(raw):
+            return self._rebuild(dem,raw)
+        if numpy.any(changed & self.locked) or numpy.any(raw[changed] == 5) or numpy.any(self.raw[changed] == 5):
+            return self._rebuild(dem,raw)
+
+        lddarr = self.ldd.copy()
+        lddarr[changed] = raw[changed]
+        if self._hascycle(lddarr,numpy.flatnonzero(changed)):
+            return self._rebuild(dem,raw)
+
+        self.ldd = lddarr
+        self.raw = raw
+        self.lddmap = numpy2pcr(Ldd,lddarr,0)
+        self.nrupdates = self.nrupdates + 1
+
+        return self.lddmap
+
+
+def readlookuptable(fname,nrkeys=None):
+    """
+    Reads a pcraster lookup table (as used by lookupscalar). Each key column holds a
+    value or a range: [a,b] includes both ends, <a,b> excludes them, the two can be
+    mixed (e.g. [a,b>) and an empty end means no bound (e.g. <,14]).
+
+    Input:
+        - fname - name of the table file
+        - nrkeys - number of key columns (default: all but the last column)
+
+    Output:
+        - list of (list of (lower,upper,includelower,includeupper) per key column, value)
+    """
+    rows = []
+    fp = open(fname)
+    for line in fp:
+        # a range may contain spaces (e.g. [1, 5>)
+        fields = re.findall(r'[\[<][^\]>]*[\]>]|\S+',line)
+        if len(fields) == 0 or fields[0].startswith('#'):
+            continue
+        if nrkeys is not None and len(fields) != nrkeys + 1:
+            fp.close()
+            raise ValueError("Expected " + str(nrkeys + 1) + " columns in " + fname + ": " + line.strip())
+        conditions = []
+        for field in fields[:-1]:
+            if field[0] in '[<':
+                lower, upper = field[1:-1].split(',')
+                conditions.append((float(lower) if lower.strip() else -numpy.inf,
+                                   float(upper) if upper.strip() else numpy.inf,
+                                   field[0] == '[', field[-1] == ']'))
+            else:
+                conditions.append((float(field),float(field),True,True))
+        rows.append((conditions,float(fields[-1])))
+    fp.close()
+
+    return rows
+
+
+class lookuptables():
+
+    def __init__(self,*classmaps):
+        """
+        Numpy version of lookupscalar for many tables that use the same class maps
+        (e.g. landuse, subcatchment and soil). The combinations of class values
+        that occur in the maps are numbered once. A table is evaluated for these
+        combinations only (first matching row wins, as in pcraster) and the map is
+        made with a single index operation. The values of a table are kept until the
+        file changes. Tables that readlookuptable cannot read are passed on to
+        pcraster lookupscalar.
+
+        Input:
+            - classmaps - the maps that match the key columns of the tables
+
+        Example::
+
+            tables = lookuptables(self.LandUse,subcatch,self.Soil)
+            self.N = tables.lookupscalar(self.Dir + "/intbl/N.tbl")
+        """
+        self.classmaps = classmaps
+        arrays = [pcr2numpy(scalar(classmap),numpy.nan).astype(numpy.float64) for classmap in classmaps]
+        self.shape = arrays[0].shape
+        classes = numpy.column_stack([arr.ravel() for arr in arrays])
+        valid = numpy.all(numpy.isfinite(classes),axis=1)
+        classes = classes[valid]
+
+        # number the unique combinations, -1 (the extra row of the
+        # value arrays, see _gather) for missing values
+        order = numpy.lexsort(classes.T[::-1])
+        ordered = classes[order]
+        first = numpy.ones(len(ordered),dtype=bool)
+        first[1:] = numpy.any(ordered[1:] != ordered[:-1],axis=1)
+        self.combinations = ordered[first]
+        keys = numpy.empty(len(ordered),dtype=numpy.int32)
+        keys[order] = numpy.cumsum(first) - 1
+        self.keys = numpy.empty(valid.size,dtype=numpy.int32)
+        self.keys.fill(-1)
+        self.keys[valid] = keys
+        self.mv = 1E31
+        self._values = {}
+
+    def values(self,fname):
+        """
+        Values of a table for each combination of classes (NaN if no row matches)
+
+        Input:
+            - fname - name of the table file
+        """
+        mtime = os.path.getmtime(fname)
+        if fname in self._values and self._values[fname][0] == mtime:
+            return self._values[fname][1]
+
+        nrcomb, nrkeys = self.combinations.shape
+        vals = numpy.empty(nrcomb)
+        vals.fill(numpy.nan)
+        todo = numpy.ones(nrcomb,dtype=bool)
+        for conditions, value in readlookuptable(fname,nrkeys):
+            match = todo.copy()
+            for col, (lower, upper, inclower, incupper) in enumerate(conditions):
+                classes = self.combinations[:,col]
+                match &= (classes >= lower) if inclower else (classes > lower)
+                match &= (classes <= upper) if incupper else (classes < upper)
+            vals[match] = value
+            todo &= ~match
+        self._values[fname] = (mtime,vals)
+
+        return vals
+
+    def _gather(self,vals):
+        """
+        Makes maps of the values per combination (one column per map)
+        """
+        table = numpy.vstack([vals,numpy.empty((1,vals.shape[1]))])
+        table[-1] = numpy.nan
+        result = table[self.keys]
+        result[numpy.isnan(result)] = self.mv
+
+        return [numpy2pcr(Scalar,result[:,nr].reshape(self.shape),self.mv) for nr in range(vals.shape[1])]
+
+    def lookupscalar(self,fname,multname=None):
+        """
+        Returns the scalar map of a table (like lookupscalar(fname,classmaps...)).
+
+        Input:
+            - fname - name of the table file
+            - multname - optional table with factors that are applied to the values
+        """
+        return self.lookupmaps([fname],[multname])[0]
+
+    def lookupmaps(self,fnames,multnames=None):
+        """
+        Returns the scalar maps of a list of tables, made in one pass
+
+        Input:
+            - fnames - names of the table files
+            - multnames - optional list (same length) of tables with factors (or None)
+        """
+        if multnames is None:
+            multnames = [None] * len(fnames)
+        try:
+            vals = numpy.column_stack([self.values(fname) * (self.values(multname) if multname is not None else 1.0)
+                                       for fname, multname in zip(fnames,multnames)])
+        except ValueError:
+            return [self._pcrlookupscalar(fname,multname) for fname, multname in zip(fnames,multnames)]
+
+        return self._gather(vals)
+
+    def _pcrlookupscalar(self,fname,multname=None):
+        """
+        pcraster lookupscalar of a table (and the optional factors) with the class maps
+        """
+        result = lookupscalar(fname,*self.classmaps)
+        if multname is not None:
+            result = result * lookupscalar(multname,*self.classmaps)
+
+        return result
@@ -195,6 +195,10 @@ class WflowModel(DynamicModel):
         self.updating = int(configget(self.config, "model", "updating", "0"))
         self.updateFile = configget(self.config, "model", "updateFile", "no_set")
         self.Tslice = int(configget(self.config, "model", "Tslice", "1"))
+        # pcraster: pcraster kinematic function, numpy: kinematic_numpy on a precomputed lddgraph
+        self.kinwavesolver = configget(self.config, "model", "kinwavesolver", "pcraster")
+        # pcraster: pcraster upstream/accucapacity* etc, numpy: the lddgraph versions of these
+        self.lddoperators = configget(self.config, "model", "lddoperators", "pcraster")
         self.sCatch = int(configget(self.config, "model", "sCatch", "0"))
         self.intbl = configget(self.config, "model", "intbl", "intbl")
         self.timestepsecs = int(configget(self.config, "model", "timestepsecs", "86400"))
@@ -325,6 +329,10 @@ class WflowModel(DynamicModel):
             usid = ifthenelse(ds != self.TopoId,self.TopoId,0)
             self.TopoLdd = lddrepair(ifthenelse(boolean(usid),ldd(5),self.TopoLdd))
 
+        if self.kinwavesolver == "numpy" or self.lddoperators == "numpy":
+            self.logger.info("Using numpy drainage network (kinwavesolver: " + self.kinwavesolver + ", lddoperators: " + self.lddoperators + ")")
+            self.TopoGraph = getlddgraph(self.TopoLdd)
+
         self.QMMConv = self.timestepsecs / (self.reallength * self.reallength * 0.001)  #m3/s --> mm
         self.ToCubic = (self.reallength * self.reallength * 0.001) / self.timestepsecs  # m3/s
         self.KinWaveVolume = self.ZeroMap
@@ -463,11 +471,18 @@ class WflowModel(DynamicModel):
         # per distance along stream
         q = self.Inwater / self.DCL
         # discharge (m3/s)
-        self.SurfaceRunoff = kinematic(self.TopoLdd, self.SurfaceRunoff, q, self.Alpha, self.Beta, self.Tslice,
-                                       self.timestepsecs, self.DCL)  # m3/s
+        if self.kinwavesolver == "numpy":
+            self.SurfaceRunoff = kinematic_numpy(self.TopoGraph, self.SurfaceRunoff, q, self.Alpha, self.Beta, self.Tslice,
+                                                 self.timestepsecs, self.DCL)  # m3/s
+        else:
+            self.SurfaceRunoff = kinematic(self.TopoLdd, self.SurfaceRunoff, q, self.Alpha, self.Beta, self.Tslice,
+                                           self.timestepsecs, self.DCL)  # m3/s
         self.SurfaceRunoffMM = self.SurfaceRunoff * self.QMMConv  # SurfaceRunoffMM (mm) from SurfaceRunoff (m3/s)
         self.updateRunOff()
-        self.InflowKinWaveCell = upstream(self.TopoLdd, self.SurfaceRunoff)
+        if self.lddoperators == "numpy":
+            self.InflowKinWaveCell = self.TopoGraph.upstream(self.SurfaceRunoff)
+        else:
+            self.InflowKinWaveCell = upstream(self.TopoLdd, self.SurfaceRunoff)
         self.MassBalKinWave = (self.KinWaveVolume - self.OldKinWaveVolume) / self.timestepsecs + self.InflowKinWaveCell + self.Inwater - self.SurfaceRunoff
 
         Runoff = self.SurfaceRunoff
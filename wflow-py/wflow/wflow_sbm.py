@@ -294,6 +294,11 @@ class WflowModel(DynamicModel):
         self.logger.info("Saving initial conditions...")
         self.wf_suspend(os.path.join(self.SaveDir,"outstate"))
 
+        if hasattr(self, "WaterLddUpdater"):
+            self.logger.info("Water table ldd: " + str(self.WaterLddUpdater.nrrebuilds) + " rebuilds, " +
+                             str(self.WaterLddUpdater.nrupdates) + " incremental updates, " +
+                             str(self.WaterLddUpdater.nrunchanged) + " unchanged")
+
         if self.OverWriteInit:
             self.logger.info("Saving initial conditions over start conditions...")
             self.wf_suspend(self.SaveDir + "/instate/")
@@ -406,6 +411,10 @@ class WflowModel(DynamicModel):
         # Set and get defaults from ConfigFile here ###################################
 
         self.Tslice = int(configget(self.config, "model", "Tslice", "1"))
+        # pcraster: pcraster kinematic function, numpy: kinematic_numpy on a precomputed lddgraph
+        self.kinwavesolver = configget(self.config, "model", "kinwavesolver", "pcraster")
+        # pcraster: pcraster upstream/accucapacity* etc, numpy: the lddgraph versions of these
+        self.lddoperators = configget(self.config, "model", "lddoperators", "pcraster")
         self.interpolMethod = configget(self.config, "model", "InterpolationMethod", "inv")
         self.reinit = int(configget(self.config, "model", "reinit", "0"))
         self.fewsrun = int(configget(self.config, "model", "fewsrun", "0"))
@@ -437,6 +446,10 @@ class WflowModel(DynamicModel):
 
         #self.ExternalQbase=int(configget(self.config,'model','ExternalQbase','0'))
         self.waterdem = int(configget(self.config, 'model', 'waterdem', '0'))
+        # full: lddcreate of the water table every timestep, incremental: only update changed directions
+        self.waterlddupdate = configget(self.config, 'model', 'waterlddupdate', 'full')
+        self.waterlddmaxchanged = float(configget(self.config, 'model', 'waterlddmaxchanged', '0.01'))
+        self.waterlddrebuild = int(configget(self.config, 'model', 'waterlddrebuild', '0'))
         WIMaxScale = float(configget(self.config, 'model', 'WIMaxScale', '0.8'))
         self.reInfilt = int(configget(self.config, 'model', 'reInfilt', '0'))
         self.MassWasting = int(configget(self.config,"model","MassWasting","0"))
@@ -660,8 +673,7 @@ class WflowModel(DynamicModel):
         # soil thickness based on topographical index (see Environmental modelling: finding simplicity in complexity)
         # 1: calculate wetness index
         # 2: Scale the capacity (now actually a max capacity) based on the index, also apply a minmum capacity
-        WI = ln(accuflux(self.TopoLdd,
-                         1) / self.Slope)  # Topographical wetnesss. Scale WI by zone/subcatchment assuming these ara also geological units
+        WI = ln(self.wf_cachedStatic("accuflux", accuflux, [self.TopoLdd, 1]) / self.Slope)  # Topographical wetnesss. Scale WI by zone/subcatchment assuming these ara also geological units
         WIMax = areamaximum(WI, self.TopoId) * WIMaxScale
         self.FirstZoneThickness = max(min(self.FirstZoneThickness, (WI / WIMax) * self.FirstZoneThickness),
                                       self.FirstZoneMinCapacity)
@@ -692,8 +704,10 @@ class WflowModel(DynamicModel):
             self.UpdateMap = numpy2pcr(Nominal, touse, 0.0)
             # Calculate distance to updating points (upstream) annd use to scale the correction
             # ldddist returns zero for cell at the gauges so add 1.0 tp result
+            updatedist = self.wf_cachedStatic("ldddist_update", ldddist,
+                                              [self.TopoLdd, boolean(cover(self.UpdateMap, 0)), 1])
             self.DistToUpdPt = cover(
-                min(ldddist(self.TopoLdd, boolean(cover(self.UpdateMap, 0)), 1) * self.reallength / celllength(),
+                min(updatedist * self.reallength / celllength(),
                     self.UpdMaxDist), self.UpdMaxDist)
             #self.DistToUpdPt = ldddist(self.TopoLdd,boolean(cover(self.OutputId,0.0)),1)
             #* self.reallength/celllength()
@@ -701,16 +715,21 @@ class WflowModel(DynamicModel):
 
         # Initializing of variables
         self.logger.info("Initializing of model variables..")
-        self.TopoLdd = lddmask(self.TopoLdd, boolean(self.TopoId))
+        self.TopoLdd = self.wf_cachedStatic("lddmask_topoid", lddmask, [self.TopoLdd, boolean(self.TopoId)])
         catchmentcells = maptotal(scalar(self.TopoId))
 
         # Limit lateral flow per subcatchment (make pits at all subcatch boundaries)
         # This is very handy for Ribasim etc...
         if self.SubCatchFlowOnly > 0:
             self.logger.info("Creating subcatchment-only drainage network (ldd)")
-            ds = downstream(self.TopoLdd,self.TopoId)
-            usid = ifthenelse(ds != self.TopoId,self.TopoId,0)
-            self.TopoLdd = lddrepair(ifthenelse(boolean(usid),ldd(5),self.TopoLdd))
+            self.TopoLdd = self.wf_cachedStatic("ldd_subcatchonly", subcatchonlyldd, [self.TopoLdd, self.TopoId])
+
+        if self.kinwavesolver == "numpy" or self.lddoperators == "numpy":
+            self.logger.info("Using numpy drainage network (kinwavesolver: " + self.kinwavesolver + ", lddoperators: " + self.lddoperators + ")")
+            self.TopoGraph = getlddgraph(self.TopoLdd)
+
+        if self.waterdem and self.waterlddupdate == "incremental":
+            self.WaterLddUpdater = lddupdater(maxchanged=self.waterlddmaxchanged, rebuildinterval=self.waterlddrebuild)
 
 
         # Used to seperate output per LandUse/management classes
@@ -751,13 +770,11 @@ class WflowModel(DynamicModel):
         self.CumCellInFlow = self.ZeroMap
         self.CumIF = self.ZeroMap
         self.CumActInfilt = self.ZeroMap
-        self.Aspect = scalar(aspect(self.Altitude))  # aspect [deg]
-        self.Aspect = ifthenelse(self.Aspect <= 0.0, scalar(0.001), self.Aspect)
-        # On Flat areas the Aspect function fails, fill in with average...
-        self.Aspect = ifthenelse(defined(self.Aspect), self.Aspect, areaaverage(self.Aspect, self.TopoId))
+        # aspect [deg], on flat areas the aspect function fails, these get the average
+        self.Aspect = self.wf_cachedStatic("aspect", detaspect, [self.Altitude, self.TopoId])
 
         # Set DCL to riverlength if that is longer that the basic length calculated from grid
-        drainlength = detdrainlength(self.TopoLdd, self.xl, self.yl)
+        drainlength = self.wf_cachedStatic("drainlength", detdrainlength, [self.TopoLdd, self.xl, self.yl])
 
         # Multiply with Factor (taken from upscaling operation, defaults to 1.0 if no map is supplied
         self.DCL = drainlength * max(1.0, self.RiverLengthFac)
@@ -766,7 +783,7 @@ class WflowModel(DynamicModel):
 
         # water depth (m)
         # set width for kinematic wave to cell width for all cells
-        self.Bw = detdrainwidth(self.TopoLdd, self.xl, self.yl)
+        self.Bw = self.wf_cachedStatic("drainwidth", detdrainwidth, [self.TopoLdd, self.xl, self.yl])
         # However, in the main river we have real flow so set the width to the
         # width of the river
 
@@ -790,7 +807,7 @@ class WflowModel(DynamicModel):
         #self.initstorage=areaaverage(self.FirstZoneDepth,self.TopoId)+areaaverage(self.UStoreDepth,self.TopoId)#+areaaverage(self.Snow,self.TopoId)
 
         # calculate catchmentsize
-        self.upsize = catchmenttotal(self.xl * self.yl, self.TopoLdd)
+        self.upsize = self.wf_cachedStatic("upsize", catchmenttotal, [self.xl * self.yl, self.TopoLdd])
         self.csize = areamaximum(self.upsize, self.TopoId)
         # Save some summary maps
         self.logger.info("Saving summary maps...")
@@ -970,7 +987,10 @@ class WflowModel(DynamicModel):
                 # 5.67 = tan 80 graden
                 SnowFluxFrac = min(0.5,self.Slope/5.67) * min(1.0,self.DrySnow/MaxSnowPack)
                 MaxFlux = SnowFluxFrac * self.DrySnow
-                self.DrySnow = accucapacitystate(self.TopoLdd,self.DrySnow, MaxFlux)
+                if self.lddoperators == "numpy":
+                    self.DrySnow = self.TopoGraph.accucapacity(self.DrySnow, MaxFlux)[1]
+                else:
+                    self.DrySnow = accucapacitystate(self.TopoLdd,self.DrySnow, MaxFlux)
             else:
                 SnowFluxFrac = self.ZeroMap
                 MaxFlux= self.ZeroMap
@@ -1143,7 +1163,10 @@ class WflowModel(DynamicModel):
         self.WaterDem = self.Altitude - (self.zi * 0.001)
         self.waterSlope = max(0.000001, slope(self.WaterDem) * celllength() / self.reallength)
         if self.waterdem:
-            self.waterLdd = lddcreate(self.WaterDem, 1E35, 1E35, 1E35, 1E35)
+            if self.waterlddupdate == "incremental":
+                self.waterLdd = self.WaterLddUpdater.update(self.WaterDem)
+            else:
+                self.waterLdd = lddcreate(self.WaterDem, 1E35, 1E35, 1E35, 1E35)
             #waterLdd = lddcreate(waterDem,1,1,1,1)
 
 
@@ -1168,8 +1191,11 @@ class WflowModel(DynamicModel):
 
             MaxHor = max(0.0, min(Lateral, self.FirstZoneDepth))
             #MaxHor = self.ZeroMap
-            self.FirstZoneFlux = accucapacityflux(self.TopoLdd, self.FirstZoneDepth, MaxHor)
-            self.FirstZoneDepth = accucapacitystate(self.TopoLdd, self.FirstZoneDepth, MaxHor)
+            if self.lddoperators == "numpy":
+                self.FirstZoneFlux, self.FirstZoneDepth = self.TopoGraph.accucapacity(self.FirstZoneDepth, MaxHor)
+            else:
+                self.FirstZoneFlux = accucapacityflux(self.TopoLdd, self.FirstZoneDepth, MaxHor)
+                self.FirstZoneDepth = accucapacitystate(self.TopoLdd, self.FirstZoneDepth, MaxHor)
 
         ##########################################################################
         # Determine returnflow from first zone          ##########################
@@ -1222,11 +1248,18 @@ class WflowModel(DynamicModel):
         # per distance along stream
         q = self.Inwater / self.DCL
         # discharge (m3/s)
-        self.SurfaceRunoff = kinematic(self.TopoLdd, self.SurfaceRunoff, q, self.Alpha, self.Beta, self.Tslice,
-                                       self.timestepsecs, self.DCL)  # m3/s
+        if self.kinwavesolver == "numpy":
+            self.SurfaceRunoff = kinematic_numpy(self.TopoGraph, self.SurfaceRunoff, q, self.Alpha, self.Beta, self.Tslice,
+                                                 self.timestepsecs, self.DCL)  # m3/s
+        else:
+            self.SurfaceRunoff = kinematic(self.TopoLdd, self.SurfaceRunoff, q, self.Alpha, self.Beta, self.Tslice,
+                                           self.timestepsecs, self.DCL)  # m3/s
         self.SurfaceRunoffMM = self.SurfaceRunoff * self.QMMConv  # SurfaceRunoffMM (mm) from SurfaceRunoff (m3/s)
         self.updateRunOff()
-        self.InflowKinWaveCell = upstream(self.TopoLdd, self.SurfaceRunoff)
+        if self.lddoperators == "numpy":
+            self.InflowKinWaveCell = self.TopoGraph.upstream(self.SurfaceRunoff)
+        else:
+            self.InflowKinWaveCell = upstream(self.TopoLdd, self.SurfaceRunoff)
         self.MassBalKinWave = (self.KinWaveVolume - self.OldKinWaveVolume) / self.timestepsecs + self.InflowKinWaveCell + self.Inwater - self.SurfaceRunoff
 
         Runoff = self.SurfaceRunoff
@@ -1276,7 +1309,10 @@ class WflowModel(DynamicModel):
 
         self.DeltaStorage = CellStorage - self.OrgStorage
         OutFlow = self.FirstZoneFlux
-        CellInFlow = upstream(self.TopoLdd, scalar(self.FirstZoneFlux))
+        if self.lddoperators == "numpy":
+            CellInFlow = self.TopoGraph.upstream(self.FirstZoneFlux)
+        else:
+            CellInFlow = upstream(self.TopoLdd, scalar(self.FirstZoneFlux))
 
         self.CumOutFlow = self.CumOutFlow + OutFlow
         self.CumActInfilt = self.CumActInfilt + self.ActInfilt
@@ -70,6 +70,14 @@ of the ini file.
     # non-zero value in the wflow_hboun map
     #levelTss=intss/Hboun.tss
     #AdaptiveTimeStepping=1
+
+    # pcraster (default): dynamicwaveq/dynamicwaveh, sparse: implicit solver on the
+    # river cells (wflow_funcs.sparsedynamicwave) with sub timesteps that keep the
+    # courant number below maxcourant (and above mintimestep seconds). With the sparse
+    # solver a negative fixedLevel gives a free (normal depth) outflow at the
+    # boundary points and lowerflowbound is not used.
+    #solver=sparse
+    #maxcourant=2.0
     
     
 
@@ -108,6 +116,7 @@ import shutil, glob
 import getopt
 
 from wflow.wf_DynamicFramework import *
+from wflow.wflow_funcs import sparsedynamicwave
 
 #import scipy
 
@@ -142,11 +151,47 @@ class WflowModel(DynamicModel):
       self.SaveDir = os.path.join(self.Dir,self.runId)
 
 
+  def runSparseDynamicWave(self):
+        """
+        Runs the implicit (sparse matrix) dynamic wave for the main river
+        """
+        # Lateral inflow: discharge of the cells that drain into the main river
+        comb = ordinal(cover(self.DynRiver,0))
+        dst = downstream(self.Ldd,comb)
+        inf = ifthen(boolean(self.DynRiver),ordinal(0))
+        inf = cover(inf,dst)
+        self.Qin = upstream(self.Ldd,ifthenelse(inf > 0,self.SurfaceRunoff,scalar(0.0)))
+
+        # level boundary, fixed or TSS. A negative level gives a free outflow
+        if self.fixed_h == 0.0:
+            levelBoun = ifthen(self.dynHBoundary > 0,timeinputscalar(self.caseName + self.fixed_h_tss,ordinal(self.dynHBoundary)))
+        elif self.fixed_h > 0.0:
+            levelBoun = ifthen(self.dynHBoundary > 0,scalar(self.fixed_h))
+        else:
+            levelBoun = None
+
+        self.SurfaceRunoffDyn, self.WaterLevelDyn, nrsteps, courant = self.SparseWave.run(self.WaterLevelDyn,self.SurfaceRunoffDyn,
+                                   self.Qin,self.ChannelRoughness,self.FloodplainRoughness,self.timestepsecs,boundary=levelBoun)
+        self.logger.debug("Dynamic wave: " + str(nrsteps) + " substeps, max courant number: " + str(courant))
+
+        ChannelSurface = (self.ChannelBottomWidth + (self.ChannelForm * self.WaterLevelDyn * 2.0) + self.ChannelBottomWidth)/2.0
+        self.AChannel = min(self.WaterLevelDyn,self.ChannelDepth) * ChannelSurface
+        self.AFloodplain = max((self.WaterLevelDyn - self.ChannelDepth) * self.FloodplainWidth,0.0)
+        self.A = max(self.AChannel + self.AFloodplain,0.0001)
+        self.velocity = self.SurfaceRunoffDyn/self.A
+        self.crt = abs((self.timestepsecs/nrsteps * self.velocity)/self.ChannelLength)
+        self.crtsum = self.crtsum + self.crt
+        self.FloodPlainVol = self.AFloodplain * self.ChannelLength
+        self.ChannelVol = self.AChannel * self.ChannelLength
+
+
   def runDynamicWave(self):
         """
         Runs the dynamic wave for the main river
         Beware: Experimental, *very* slow and unstable
         """ 
+        if self.dynsolver == "sparse":
+            return self.runSparseDynamicWave()
  
         # Determine all the inflow points into the main river
         setglobaloption('manning')
@@ -318,6 +363,8 @@ class WflowModel(DynamicModel):
     self.logger.info("Dynamic wave timestep is: " + str(self.timestepsecs/self.dynsubsteps/self.TsliceDyn) + " seconds")
     self.logger.info("Lower boundary file: " + self.fixed_h_tss)
     self.AdaptiveTimeStepping = int(configget(self.config,"dynamicwave","AdaptiveTimeStepping","0"))
+    self.dynsolver = configget(self.config,"dynamicwave","solver","pcraster")
+    self.maxcourant = float(configget(self.config,"dynamicwave","maxcourant","2.0"))
 
     
     self.basetimestep=86400
@@ -372,6 +419,11 @@ class WflowModel(DynamicModel):
  
     # Make seperate LDD for Dynamic Wave
     self.LddIn= lddrepair(ifthen(boolean(self.DynRiver),self.Ldd))
+    if self.dynsolver == "sparse":
+        self.logger.info("Using the sparse dynamic wave solver, max courant number: " + str(self.maxcourant))
+        self.SparseWave = sparsedynamicwave(getlddgraph(self.LddIn),self.ChannelBottomLevel,self.ChannelLength,
+                                            self.ChannelBottomWidth,self.ChannelDepth,self.ChannelForm,self.FloodplainWidth,
+                                            maxcourant=self.maxcourant,mintimestep=self.mintimestep)
     self.crtsum = self.ZeroMap
  
 